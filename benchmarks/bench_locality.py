@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""
+Simulates the job selection policies of DirJobs on a synthetic job set.
+
+Several hosts with several workers each process jobs (named <source>_<n>.txt)
+from one job folder. Every host has a page cache that holds a fixed number of
+source videos (LRU). A job whose source is in the cache of its host counts as
+cache hit. The jobs are claimed with the real DirJobs and policies, the
+encoding itself is simulated with random durations.
+"""
+
+import os
+import sys
+import json
+import heapq
+import random
+import shutil
+import tempfile
+from collections import OrderedDict, Counter
+from os.path import join as pjoin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dirjobs import DirJobs, RandomPolicy, LocalityPolicy, job_source
+
+
+def make_jobs(jobsdir, sources, jobs_per_source):
+    os.makedirs(pjoin(jobsdir, "00_waiting"), exist_ok=True)
+    for s in range(sources):
+        for j in range(jobs_per_source):
+            open(pjoin(jobsdir, "00_waiting", "src%03d_job%03d.txt" % (s, j)), "w").close()
+
+
+class PageCache(object):
+
+    def __init__(self, capacity):
+        self._capacity = capacity
+        self._lru = OrderedDict()
+
+    def read(self, source):
+        hit = source in self._lru
+        self._lru[source] = True
+        self._lru.move_to_end(source)
+        if len(self._lru) > self._capacity:
+            self._lru.popitem(last=False)
+        return hit
+
+
+def simulate(workdir, policy_name, hosts, workers, sources, jobs_per_source, cache_size, seed):
+
+    random.seed(seed)
+
+    jobsdir = pjoin(workdir, "jobs")
+    make_jobs(jobsdir, sources, jobs_per_source)
+
+    caches = [PageCache(cache_size) for _ in range(hosts)]
+    djs = []
+
+    for h in range(hosts):
+        for w in range(workers):
+            wid = "h%dw%d" % (h, w)
+            if policy_name == "locality":
+                policy = LocalityPolicy(pjoin(workdir, "host%d" % h), wid=wid)
+            else:
+                policy = RandomPolicy()
+            djs.append((h, DirJobs(jobsdir, wid=wid, claim="excl", policy=policy)))
+
+    hits = 0
+    total = 0
+    per_worker = Counter()
+
+    # (simulated finish time, worker index, job)
+    events = [(0.0, i, None) for i in range(len(djs))]
+    now = 0.0
+
+    while events:
+
+        now, i, job = heapq.heappop(events)
+        h, dj = djs[i]
+
+        if job is not None:
+            job.done()
+
+        job = dj.next_and_lock()
+
+        if job is None:
+            continue
+
+        total += 1
+        per_worker[i] += 1
+
+        hit = caches[h].read(job_source(job.name()))
+        hits += hit
+
+        # Reading the source from disk makes the encode slower
+        duration = random.uniform(50, 150) * (1.0 if hit else 1.3)
+
+        heapq.heappush(events, (now + duration, i, job))
+
+    policy_stats = [dj.stats() for _, dj in djs]
+
+    result = {'policy': policy_name, 'jobs': total, 'makespan': now,
+              'page_cache_hit_rate': hits / total if total else 0.0,
+              'jobs_per_worker_min': min(per_worker.values()),
+              'jobs_per_worker_max': max(per_worker.values())}
+
+    if policy_name == "locality":
+        result['policy_hit_rate'] = sum(s['source_hits'] for s in policy_stats) / total
+
+    return result
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Job selection policy simulation.")
+    parser.add_argument('--hosts', help="Number of hosts.", type=int, default=4)
+    parser.add_argument('--workers', help="Workers per host.", type=int, default=4)
+    parser.add_argument('--sources', help="Number of source videos.", type=int, default=20)
+    parser.add_argument('--jobs-per-source', help="Jobs per source video.", type=int, default=30)
+    parser.add_argument('--cache-size', help="Source videos that fit into the page cache of a host.", type=int, default=4)
+    parser.add_argument('--seed', help="Random seed.", type=int, default=1)
+    parser.add_argument('-o', '--output', help="Write the results as json to this file.", default=None)
+
+    args = parser.parse_args()
+
+    results = []
+
+    for policy_name in ["random", "locality"]:
+
+        workdir = tempfile.mkdtemp(prefix="bench_locality_")
+
+        try:
+            results.append(simulate(workdir, policy_name, args.hosts, args.workers, args.sources,
+                                    args.jobs_per_source, args.cache_size, args.seed))
+        finally:
+            shutil.rmtree(workdir)
+
+    print(json.dumps(results, indent=4))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
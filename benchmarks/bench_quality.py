@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark and cross-check of the numpy quality engine (scripts/quality.py)
+against the psnr and ssim filters of ffmpeg.
+
+A synthetic clip (noise over moving gradients, so SSIM is not trivially 1) is
+written as .y4m with numpy and encoded with libx264. The encoded clip is
+compared with the source:
+
+  ffmpeg  - one ffmpeg run with the psnr and ssim filters (stats files)
+  engine  - scripts/quality.py, the encoded clip decoded by ffmpeg through a pipe
+  mmap    - scripts/quality.py on a decoded .y4m copy, both files memory-mapped
+            (the engine without the decoder)
+
+The per-frame values of the engine are checked against ffmpeg (max. absolute
+difference of PSNR and SSIM), so ffmpeg is required. With --engine-only only the
+mmap mode runs (no cross-check), with a distorted clip made by adding noise with
+numpy.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from scripts.y4m import Y4MReader, write_y4m
+from scripts.quality import compute_quality
+
+
+def synthetic_frames(count, width, height, noise, seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    cy, cx = np.mgrid[0:height // 2, 0:width // 2]
+    for i in range(count):
+        y = (xx * 255.0 / width + yy * 0.5 + 3 * i) % 256 + rng.normal(0, noise, (height, width))
+        u = 128 + 60 * np.sin((cx + 2 * i) / 17.0) + rng.normal(0, noise / 2, cx.shape)
+        v = 128 + 60 * np.cos((cy - i) / 11.0) + rng.normal(0, noise / 2, cy.shape)
+        yield [np.clip(p, 0, 255).astype(np.uint8) for p in (y, u, v)]
+
+
+def distort_frames(frames, noise, seed=1):
+    rng = np.random.default_rng(seed)
+    for frame in frames:
+        yield [np.clip(p + rng.normal(0, noise, p.shape), 0, 255).astype(np.uint8) for p in frame]
+
+
+def has_ffmpeg():
+    return shutil.which("ffmpeg") is not None
+
+
+def encode(source, output, crf):
+    subprocess.check_call(["ffmpeg", "-y", "-v", "error", "-i", source, "-c:v", "libx264", "-crf", str(crf),
+                           "-pix_fmt", "yuv420p", output])
+
+
+def decode(source, output):
+    subprocess.check_call(["ffmpeg", "-y", "-v", "error", "-i", source, "-pix_fmt", "yuv420p", output])
+
+
+def parse_stats_file(path):
+    """
+    Parses the stats file of the psnr or ssim filter ("n:1 key:value ..." per frame).
+    """
+    frames = []
+    with open(path) as f:
+        for line in f:
+            values = {}
+            for field in line.split():
+                key, sep, value = field.partition(":")
+                if sep:
+                    try:
+                        values[key] = float(value)
+                    except ValueError:
+                        pass
+            frames.append(values)
+    return frames
+
+
+def ffmpeg_quality(distorted, reference, workdir):
+    psnr_log = os.path.join(workdir, "psnr.log")
+    ssim_log = os.path.join(workdir, "ssim.log")
+    graph = "[0:v]split[d1][d2];[1:v]split[r1][r2];" \
+            "[d1][r1]psnr=stats_file=%s;[d2][r2]ssim=stats_file=%s" % (psnr_log, ssim_log)
+    t = time.perf_counter()
+    subprocess.check_call(["ffmpeg", "-v", "error", "-nostdin", "-i", distorted, "-i", reference,
+                           "-lavfi", graph, "-f", "null", "-"])
+    elapsed = time.perf_counter() - t
+    psnr = parse_stats_file(psnr_log)
+    ssim = parse_stats_file(ssim_log)
+    values = {'psnr_avg': np.array([f['psnr_avg'] for f in psnr]), 'psnr_y': np.array([f['psnr_y'] for f in psnr]),
+              'ssim_avg': np.array([f['All'] for f in ssim]), 'ssim_y': np.array([f['Y'] for f in ssim])}
+    return values, elapsed
+
+
+def max_diff(a, b):
+    n = min(len(a), len(b))
+    finite = np.isfinite(a[:n]) & np.isfinite(b[:n])
+    return float(np.max(np.abs(a[:n][finite] - b[:n][finite]))) if finite.any() else 0.0
+
+
+def run(workdir, frames, width, height, crf, noise, batch, engine_only=False):
+
+    source = os.path.join(workdir, "source.y4m")
+    write_y4m(source, synthetic_frames(frames, width, height, noise))
+    reference = Y4MReader(source)
+
+    results = {'frames': frames, 'size': "%dx%d" % (width, height), 'batch': batch, 'cross_check': not engine_only}
+    pixels = frames * width * height * 1.5
+
+    if not engine_only:
+        encoded = os.path.join(workdir, "encoded.mp4")
+        decoded = os.path.join(workdir, "decoded.y4m")
+        encode(source, encoded, crf)
+        decode(encoded, decoded)
+
+        ff, t_ffmpeg = ffmpeg_quality(encoded, source, workdir)
+        engine, t_engine = compute_quality(encoded, reference, batch=batch)
+        mmap, t_mmap = compute_quality(Y4MReader(decoded), reference, batch=batch)
+
+        results.update({'ffmpeg_s': t_ffmpeg, 'engine_s': t_engine, 'mmap_s': t_mmap,
+                        'speedup_engine': t_ffmpeg / t_engine, 'speedup_mmap': t_ffmpeg / t_mmap,
+                        'psnr_avg_ffmpeg': float(np.mean(ff['psnr_avg'])),
+                        'psnr_avg_engine': float(np.mean(engine['psnr_avg'])),
+                        'ssim_avg_ffmpeg': float(np.mean(ff['ssim_avg'])),
+                        'ssim_avg_engine': float(np.mean(engine['ssim_avg'])),
+                        'frames_compared': min(len(ff['psnr_avg']), len(engine['psnr_avg'])),
+                        'max_diff': {k: max_diff(engine[k], ff[k]) for k in ff},
+                        'mmap_matches_engine': max_diff(engine['psnr_avg'], mmap['psnr_avg']) < 1e-9})
+        # ffmpeg prints 2 (psnr) and 6 (ssim) decimals
+        results['ok'] = results['frames_compared'] == frames and \
+            max(results['max_diff']['psnr_avg'], results['max_diff']['psnr_y']) < 0.01 and \
+            max(results['max_diff']['ssim_avg'], results['max_diff']['ssim_y']) < 1e-5
+    else:
+        distorted = os.path.join(workdir, "distorted.y4m")
+        write_y4m(distorted, distort_frames(synthetic_frames(frames, width, height, noise), noise))
+        mmap, t_mmap = compute_quality(Y4MReader(distorted), reference, batch=batch)
+        results.update({'mmap_s': t_mmap, 'psnr_avg_engine': float(np.mean(mmap['psnr_avg'])),
+                        'ssim_avg_engine': float(np.mean(mmap['ssim_avg'])),
+                        'ok': len(mmap['psnr_avg']) == frames})
+
+    results['mmap_mpixels_per_s'] = pixels / results['mmap_s'] / 1e6
+
+    return results
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Quality engine benchmark and cross-check with ffmpeg.")
+    parser.add_argument('-n', '--frames', help="Frames of the synthetic clip.", type=int, default=120)
+    parser.add_argument('--size', help="Resolution of the synthetic clip.", default="1280x720")
+    parser.add_argument('--crf', help="CRF of the encoded clip.", type=int, default=28)
+    parser.add_argument('--noise', help="Noise (standard deviation) of the synthetic clip.", type=float, default=4.0)
+    parser.add_argument('-b', '--batch', help="Frames per batch of the engine.", type=int, default=16)
+    parser.add_argument('--engine-only', help="Only benchmark the memory-mapped engine, without ffmpeg "
+                                              "(no cross-check).", action='store_true')
+    parser.add_argument('-o', '--output', help="Write the results as json to this file.", default=None)
+
+    args = parser.parse_args()
+
+    if not args.engine_only and not has_ffmpeg():
+        sys.exit("ffmpeg not found, it is needed for the cross-check (use --engine-only to benchmark the engine alone).")
+
+    width, height = [int(x) for x in args.size.split("x")]
+    workdir = tempfile.mkdtemp(prefix="bench_quality_")
+
+    try:
+        results = run(workdir, args.frames, width, height, args.crf, args.noise, args.batch,
+                      engine_only=args.engine_only)
+    finally:
+        shutil.rmtree(workdir)
+
+    print(json.dumps(results, indent=4))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    sys.exit(0 if results['ok'] else 1)
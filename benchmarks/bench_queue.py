@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of the job queue (the orchestration side of the workers).
+
+Creates synthetic job folders (e.g. 1k to 100k jobs) and processes them with many
+concurrent processes. Measured are the jobs per second, the claim latency, the
+conflict rate (rename claims: conflicts found by DirJobs._job_worker_selection,
+lock claims: jobs locked by another worker) and the filesystem operations of
+DirJobs per job.
+
+Modes:
+  dirjobs - every process claims and finishes jobs with DirJobs (optionally
+            simulating --work seconds of encoding per job)
+  worker  - every process runs worker.worker_loop with fake_docker.py as docker
+            command, which sleeps and writes fake results
+
+The results are written as json, so regressions of the queue can be compared.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import multiprocessing
+from collections import Counter
+from os.path import join as pjoin
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+import worker
+from dirjobs import DirJobs
+
+FAKE_DOCKER = pjoin(BENCH_DIR, "fake_docker.py")
+
+
+def make_jobs(workdir, count, sources):
+    """
+    Creates count jobs for the given number of source videos (and the empty videos).
+    """
+
+    jobsdir = pjoin(workdir, "jobs")
+    viddir = pjoin(workdir, "videos")
+
+    for d in ["00_waiting", "02_done", "99_failed"]:
+        os.makedirs(pjoin(jobsdir, d))
+    os.makedirs(viddir)
+
+    for s in range(sources):
+        open(pjoin(viddir, "src%03d.y4m" % s), "w").close()
+
+    for i in range(count):
+        src = "src%03d" % (i % sources)
+        job = {"video": src + ".y4m", "reference_video": src + ".y4m", "crf": 23,
+               "min_length": 2, "max_length": 4, "target_seg_length": 4, "encoder": "h264"}
+        with open(pjoin(jobsdir, "00_waiting", "%s_job%06d.txt" % (src, i)), "w") as f:
+            json.dump(job, f)
+
+    return jobsdir, viddir
+
+
+class TimedDirJobs(DirJobs):
+    """
+    DirJobs that records the latency of every successful claim.
+    """
+
+    instances = []
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.latencies = []
+        TimedDirJobs.instances.append(self)
+
+    def next_and_lock(self, no_wait=False):
+        t = time.perf_counter()
+        job = super().next_and_lock(no_wait=no_wait)
+        if job:
+            self.latencies.append(time.perf_counter() - t)
+        return job
+
+
+def dirjobs_process(jobsdir, wid, claim, sync_time, prefetch, work, queue):
+
+    dj = TimedDirJobs(jobsdir, wid=wid, claim=claim, worker_sync=(claim == "rename"), sync_time=sync_time,
+                      prefetch=prefetch)
+
+    while True:
+        job = dj.next_and_lock()
+        if job is None:
+            break
+        if work:
+            time.sleep(work)
+        job.done()
+
+    dj.release()
+
+    queue.put((wid, dj.latencies, dj.counters()))
+
+
+def worker_process(workdir, jobsdir, viddir, wid, claim, sync_time, prefetch, queue):
+
+    # STOP_WORKERS is looked up in the working directory
+    os.chdir(workdir)
+
+    worker.DirJobs = TimedDirJobs
+
+    args = worker.arg_parser().parse_args(
+        ["-j", jobsdir, "-v", viddir, "-t", pjoin(workdir, "tmp"), "-r", pjoin(workdir, "results"),
+         "-i", wid, "--docker-bin", FAKE_DOCKER, "--claim", claim, "--sync-time", str(sync_time),
+         "--prefetch", str(prefetch), "--select", "random", "--max-wait", "1", "--sshfs-dir", ""])
+
+    worker.worker_loop(args)
+
+    dj = TimedDirJobs.instances[0]
+
+    queue.put((wid, dj.latencies, dj.counters()))
+
+
+def finished_jobs(jobsdir):
+    return len(os.listdir(pjoin(jobsdir, "02_done"))) + len(os.listdir(pjoin(jobsdir, "99_failed")))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+
+def run(workdir, mode, jobs, workers, claim, sync_time=0.1, prefetch=1, sources=10, work=0.0, timeout=3600):
+
+    jobsdir, viddir = make_jobs(workdir, jobs, sources)
+
+    queue = multiprocessing.Queue()
+
+    if mode == "worker":
+        for d in ["tmp", "results"]:
+            os.makedirs(pjoin(workdir, d))
+        procs = [multiprocessing.Process(target=worker_process,
+                                         args=(workdir, jobsdir, viddir, "w%d" % i, claim, sync_time, prefetch, queue))
+                 for i in range(workers)]
+    else:
+        procs = [multiprocessing.Process(target=dirjobs_process,
+                                         args=(jobsdir, "w%d" % i, claim, sync_time, prefetch, work, queue))
+                 for i in range(workers)]
+
+    t = time.perf_counter()
+
+    for p in procs:
+        p.start()
+
+    if mode == "worker":
+        # The workers wait for new jobs, stop them when everything is done
+        while finished_jobs(jobsdir) < jobs and time.perf_counter() - t < timeout:
+            time.sleep(0.2)
+        dur = time.perf_counter() - t
+        open(pjoin(workdir, "STOP_WORKERS"), "w").close()
+
+    results = [queue.get() for _ in procs]
+
+    for p in procs:
+        p.join()
+
+    if mode != "worker":
+        dur = time.perf_counter() - t
+
+    latencies = [l for _, lat, _ in results for l in lat]
+    counters = Counter()
+    for _, _, c in results:
+        counters.update(c)
+
+    claims = counters['claims']
+    done = len(os.listdir(pjoin(jobsdir, "02_done")))
+    failed = len(os.listdir(pjoin(jobsdir, "99_failed")))
+    # Claims lost to other workers, whatever the claim method
+    conflicts = counters['conflicts'] + counters['lock_busy'] + counters['vanished']
+    fs_ops = {k: counters[k] for k in ["listdir", "stat", "move", "rm", "lock", "utime"]}
+
+    return {'mode': mode, 'claim': claim, 'prefetch': prefetch, 'jobs': jobs, 'workers': workers,
+            'duration_s': dur, 'jobs_per_s': (done + failed) / dur,
+            'claims': claims, 'done': done, 'failed': failed,
+            'claim_latency_s': {'mean': sum(latencies) / len(latencies) if latencies else None,
+                                'p50': percentile(latencies, 50), 'p95': percentile(latencies, 95),
+                                'p99': percentile(latencies, 99), 'max': max(latencies) if latencies else None},
+            'conflicts': counters['conflicts'], 'conflicts_lost': counters['conflicts_lost'],
+            'lock_busy': counters['lock_busy'], 'vanished': counters['vanished'],
+            'conflict_rate': conflicts / claims if claims else 0.0,
+            'fs_ops': fs_ops,
+            'fs_ops_per_job': sum(fs_ops.values()) / claims if claims else None,
+            'ok': claims == jobs and done + failed == jobs}
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Job queue benchmark.")
+    parser.add_argument('-n', '--jobs', help="Numbers of jobs to benchmark.", type=int, nargs='+',
+                        default=[1000, 10000])
+    parser.add_argument('-w', '--workers', help="Number of worker processes.", type=int, default=16)
+    parser.add_argument('-m', '--mode', help="Claim with DirJobs only or run the whole worker loop with the "
+                                             "fake docker command.", choices=["dirjobs", "worker"], default="dirjobs")
+    parser.add_argument('-c', '--claim', help="Claim method.", choices=["excl", "link", "rename"], default="excl")
+    parser.add_argument('--sync-time', help="Sync time for the rename claim method.", type=float, default=0.1)
+    parser.add_argument('-p', '--prefetch', help="Jobs reserved per claim round.", type=int, default=1)
+    parser.add_argument('--sources', help="Number of source videos.", type=int, default=10)
+    parser.add_argument('--work', help="Simulated encoding time per job in seconds (dirjobs mode).",
+                        type=float, default=0.0)
+    parser.add_argument('--encode-time', help="Encoding time of the fake docker command in seconds, "
+                                              "\"a\" or \"a-b\" (worker mode).", default="0.05")
+    parser.add_argument('--timeout', help="Maximum time in seconds per run (worker mode).", type=float, default=3600)
+    parser.add_argument('-d', '--workdir', help="Folder for the job folders (e.g. on a shared mount). "
+                                                "Default: temporary folder.", default=None)
+    parser.add_argument('-o', '--output', help="Write the results as json to this file.", default=None)
+
+    args = parser.parse_args()
+
+    # Read by fake_docker.py in the worker processes
+    os.environ["FAKE_DOCKER_SLEEP"] = args.encode_time
+
+    results = []
+
+    for jobs in args.jobs:
+
+        workdir = tempfile.mkdtemp(prefix="bench_queue_", dir=args.workdir)
+
+        try:
+            results.append(run(workdir, args.mode, jobs, args.workers, args.claim, args.sync_time, args.prefetch,
+                               args.sources, args.work, args.timeout))
+        finally:
+            shutil.rmtree(workdir)
+
+    print(json.dumps(results, indent=4))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    sys.exit(0 if all(r['ok'] for r in results) else 1)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Compares the encoding of N renditions with N separate ffmpeg runs (one decode
+of the source per rendition) against one multi-rendition run (one decode).
+
+Requires ffmpeg with libx264. A synthetic source is generated with the
+testsrc filter unless a source video is given.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import video_encode
+
+
+def make_source(path, duration, size):
+    cmd = ["ffmpeg", "-y", "-v", "error", "-f", "lavfi",
+           "-i", "testsrc2=duration=%d:size=%s:rate=24" % (duration, size),
+           "-pix_fmt", "yuv420p", path]
+    subprocess.check_call(cmd)
+
+
+def make_renditions(source, workdir, crfs, seg_length):
+    vid_opts = {'steady_id': os.path.basename(source), 'vid_id': source, 'reference_video': source,
+                'crf_val': crfs[0], 'min_dur': seg_length, 'max_dur': seg_length,
+                'target_seg_length': seg_length, 'codec': 'x264', 'stats_format': 'json',
+                'single_decode': False, 'renditions': [{'crf': crf} for crf in crfs]}
+    video_encode.set_output_paths(vid_opts, os.path.join(workdir, "tmp"),
+                                  os.path.join(workdir, "results"), "crf_%d" % crfs[0])
+    return video_encode.rendition_opts(vid_opts)
+
+
+def timed(f, *args):
+    t = time.perf_counter()
+    f(*args)
+    return time.perf_counter() - t
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Multi-rendition encoding benchmark.")
+    parser.add_argument('-s', '--source', help="Source video (default: synthetic clip).", default=None)
+    parser.add_argument('-d', '--duration', help="Duration of the synthetic clip in seconds.", type=int, default=20)
+    parser.add_argument('--size', help="Resolution of the synthetic clip.", default="1280x720")
+    parser.add_argument('--crf', help="CRF values of the renditions.", type=int, nargs='+', default=[18, 23, 28, 33])
+    parser.add_argument('--seg-length', help="Fixed segment length in seconds.", type=float, default=4.0)
+    parser.add_argument('-o', '--output', help="Write the results as json to this file.", default=None)
+
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_renditions_")
+
+    try:
+        source = args.source
+        if source is None:
+            source = os.path.join(workdir, "synthetic.y4m")
+            make_source(source, args.duration, args.size)
+
+        vid_stats = video_encode.extract_vid_stats(source)
+
+        separate = make_renditions(source, os.path.join(workdir, "separate"), args.crf, args.seg_length)
+        t_separate = sum(timed(video_encode.encode_renditions, [r], vid_stats) for r in separate)
+
+        combined = make_renditions(source, os.path.join(workdir, "combined"), args.crf, args.seg_length)
+        t_combined = timed(video_encode.encode_renditions, combined, vid_stats)
+
+        results = {'source': source, 'renditions': len(args.crf),
+                   'separate_s': t_separate, 'combined_s': t_combined,
+                   'speedup': t_separate / t_combined}
+
+        print(json.dumps(results, indent=4))
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(results, f, indent=4)
+
+    finally:
+        shutil.rmtree(workdir)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+"""
+Measures the time-to-first-claim of idle workers.
+
+Several worker processes run the idle loop of worker.py (DirJobs + Waiter) on an
+empty job folder. After an idle period a job is dropped into 00_waiting/ and the
+time until the first worker claims it is measured, together with the number of
+listings the idle workers did (the polling load on the job folder).
+
+Modes:
+  inotify  - inotify wakeup (local filesystems)
+  backoff  - exponential backoff polling only
+  doorbell - backoff polling, the producer touches the doorbell file
+  random   - the old fixed 30-90s pause (slow!)
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import multiprocessing
+from os.path import join as pjoin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dirjobs import DirJobs
+from wakeup import Waiter, DOORBELL
+
+
+def idle_worker(jobsdir, wid, mode, max_wait, stop, queue):
+
+    dj = DirJobs(jobsdir, wid=wid, claim="excl")
+    waiter = Waiter(jobsdir, max_wait=max_wait, use_inotify=(mode == "inotify"),
+                    doorbell_interval=5 if mode == "doorbell" else 0)
+
+    listings = 0
+
+    while not stop.is_set():
+
+        listings += 1
+        job = dj.next_and_lock()
+
+        if job:
+            queue.put((wid, time.time(), listings))
+            job.done()
+            return
+
+        if mode == "random":
+            stop.wait(random.randint(30, 90))
+        elif waiter.wait(interrupt=stop.is_set) == "doorbell":
+            dj.invalidate()
+
+    queue.put((wid, None, listings))
+
+
+def run(mode, workers, idle, max_wait, timeout):
+
+    jobsdir = tempfile.mkdtemp(prefix="bench_wakeup_")
+
+    try:
+        os.makedirs(pjoin(jobsdir, "00_waiting"))
+
+        queue = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        procs = [multiprocessing.Process(target=idle_worker,
+                                         args=(jobsdir, "w%d" % i, mode, max_wait, stop, queue))
+                 for i in range(workers)]
+
+        for p in procs:
+            p.start()
+
+        t_start = time.time()
+        time.sleep(idle)
+
+        # Write the job next to the folder and move it in (like a well-behaved producer)
+        tmp = pjoin(jobsdir, "video_job.txt.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"video": "video.y4m"}, f)
+        t0 = time.time()
+        os.rename(tmp, pjoin(jobsdir, "00_waiting", "video_job.txt"))
+
+        if mode == "doorbell":
+            open(pjoin(jobsdir, DOORBELL), "w").close()
+
+        results = []
+        try:
+            results.append(queue.get(timeout=timeout))
+        except Exception:
+            pass
+
+        # The first claim ends the measurement
+        stop.set()
+        t_end = time.time()
+        results += [queue.get() for _ in procs[len(results):]]
+
+        for p in procs:
+            p.join()
+
+        claims = [t for _, t, _ in results if t is not None]
+        listings = sum(n for _, _, n in results)
+
+        return {'mode': mode, 'workers': workers, 'idle_s': idle,
+                'time_to_first_claim_s': min(claims) - t0 if claims else None,
+                'listings': listings,
+                'listings_per_worker_minute': listings / workers / ((t_end - t_start) / 60.0)}
+
+    finally:
+        shutil.rmtree(jobsdir)
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Idle wakeup benchmark.")
+    parser.add_argument('-w', '--workers', help="Number of idle worker processes.", type=int, default=8)
+    parser.add_argument('--idle', help="Idle time in seconds before the job is added.", type=float, default=30)
+    parser.add_argument('--max-wait', help="Maximum backoff wait in seconds.", type=int, default=90)
+    parser.add_argument('--timeout', help="Time in seconds to wait for the claim after the job was added.",
+                        type=float, default=100)
+    parser.add_argument('-m', '--modes', help="Modes to measure.", nargs='+',
+                        choices=["inotify", "backoff", "doorbell", "random"],
+                        default=["inotify", "backoff", "doorbell"])
+    parser.add_argument('-o', '--output', help="Write the results as json to this file.", default=None)
+
+    args = parser.parse_args()
+
+    results = [run(mode, args.workers, args.idle, args.max_wait, args.timeout) for mode in args.modes]
+
+    print(json.dumps(results, indent=4))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
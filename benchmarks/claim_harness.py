@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+"""
+Multi-process harness for the job claiming of DirJobs.
+
+Creates a job folder with synthetic jobs and lets several processes claim and
+finish jobs concurrently. Every claim is recorded; the harness fails if a job
+was claimed twice or a job got lost. With --backend sqlite the jobs are
+imported into a SqliteJobs database instead, to compare the claim throughput.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import multiprocessing
+from collections import Counter
+from os.path import join as pjoin
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dirjobs import DirJobs
+from sqlitejobs import SqliteJobs
+
+
+def make_jobs(jobsdir, count):
+    os.makedirs(pjoin(jobsdir, "00_waiting"), exist_ok=True)
+    for i in range(count):
+        with open(pjoin(jobsdir, "00_waiting", "video_job%06d.txt" % i), "w") as f:
+            json.dump({"video": "video.y4m"}, f)
+
+
+def claim_worker(jobsdir, wid, claim, sync_time, prefetch, db, queue):
+    if db:
+        dj = SqliteJobs(db, wid=wid)
+    else:
+        dj = DirJobs(jobsdir, wid=wid, claim=claim, worker_sync=(claim == "rename"), sync_time=sync_time,
+                     prefetch=prefetch)
+    claimed = []
+    t = time.perf_counter()
+    while True:
+        job = dj.next_and_lock()
+        if job is None:
+            break
+        claimed.append(job.name())
+        job.done()
+    dj.release()
+    queue.put((wid, claimed, time.perf_counter() - t))
+
+
+def run(jobsdir, jobs, workers, claim, sync_time=0.1, prefetch=1, backend="dir"):
+
+    make_jobs(jobsdir, jobs)
+
+    db = None
+    if backend == "sqlite":
+        db = pjoin(jobsdir, "jobs.db")
+        SqliteJobs(db).import_dir(jobsdir)
+
+    queue = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=claim_worker, args=(jobsdir, "w%d" % i, claim, sync_time, prefetch, db, queue))
+             for i in range(workers)]
+
+    t = time.perf_counter()
+    for p in procs:
+        p.start()
+    results = [queue.get() for _ in procs]
+    for p in procs:
+        p.join()
+    dur = time.perf_counter() - t
+
+    claims = Counter(name for _, claimed, _ in results for name in claimed)
+    double = sorted(name for name, n in claims.items() if n > 1)
+    lost = jobs - len(claims)
+
+    return {'backend': backend, 'claim': claim, 'prefetch': prefetch, 'jobs': jobs, 'workers': workers,
+            'duration_s': dur, 'jobs_per_s': jobs / dur,
+            'claims': sum(claims.values()), 'double_claims': double, 'lost_jobs': lost,
+            'claims_per_worker': {wid: len(claimed) for wid, claimed, _ in results},
+            'ok': not double and lost == 0}
+
+
+if __name__ == "__main__":
+
+    import argparse
+    parser = argparse.ArgumentParser(description="DirJobs claim harness.")
+    parser.add_argument('-n', '--jobs', help="Number of jobs.", type=int, default=2000)
+    parser.add_argument('-w', '--workers', help="Number of worker processes.", type=int, default=16)
+    parser.add_argument('-b', '--backend', help="Job queue backend.", choices=["dir", "sqlite"], default="dir")
+    parser.add_argument('-c', '--claim', help="Claim method.", choices=["excl", "link", "rename"], default="excl")
+    parser.add_argument('--sync-time', help="Sync time for the rename claim method.", type=float, default=0.1)
+    parser.add_argument('-p', '--prefetch', help="Jobs reserved per claim round.", type=int, default=1)
+    parser.add_argument('-d', '--jobdir', help="Job folder to use (e.g. on a shared mount). Default: temporary folder.")
+
+    args = parser.parse_args()
+
+    jobsdir = args.jobdir or tempfile.mkdtemp(prefix="claim_harness_")
+
+    try:
+        result = run(jobsdir, args.jobs, args.workers, args.claim, args.sync_time, args.prefetch, args.backend)
+    finally:
+        if not args.jobdir:
+            shutil.rmtree(jobsdir)
+
+    print(json.dumps(result, indent=4))
+
+    sys.exit(0 if result['ok'] else 1)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+
+"""
+Stand-in for the docker command, to benchmark the worker without docker and ffmpeg.
+
+Use it with worker.py --docker-bin benchmarks/fake_docker.py. It understands the
+commands the worker uses:
+
+  pull IMAGE            - does nothing
+  image inspect ...     - prints no digest (the worker uses the image name)
+  run [OPTIONS] IMAGE   - sleeps and writes fake results into the folders mounted
+                          as /tmpdir (DASH segments and manifest) and /results
+  kill NAME             - does nothing
+  rm -f NAME            - does nothing
+
+The fake encode is configured with environment variables:
+
+  FAKE_DOCKER_SLEEP         - encoding time in seconds, "a" or a range "a-b" (default 0.1)
+  FAKE_DOCKER_SEGMENTS      - number of segments (default 5)
+  FAKE_DOCKER_SEGMENT_SIZE  - bytes per segment (default 4096)
+  FAKE_DOCKER_FAIL          - probability that a run fails (default 0)
+  FAKE_DOCKER_CGROUP_ROOT   - fake cgroup root. With docker run --cidfile, the container
+                              gets a cgroup folder <root>/docker/<id>/ with cpu.stat,
+                              memory.current, memory.peak and io.stat, updated during the
+                              run and removed at the end (test stand-in for worker.py
+                              --cgroup-stats --cgroup-root <root>)
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+from os.path import join as pjoin
+
+# docker run options with a value
+VALUE_OPTS = ["--user", "-v", "--volume", "--name", "-e", "--env", "--cidfile"]
+
+
+def parse_run(argv):
+    """
+    Returns the options (mounts: container path -> host path, cidfile), the image and the
+    container arguments.
+    """
+
+    mounts = {}
+    opts = {'mounts': mounts}
+    i = 0
+
+    while i < len(argv) and argv[i].startswith("-"):
+
+        opt = argv[i]
+
+        if opt in VALUE_OPTS:
+            if opt in ["-v", "--volume"]:
+                host, container = argv[i + 1].split(":")[:2]
+                mounts[container] = host
+            elif opt == "--cidfile":
+                opts['cidfile'] = argv[i + 1]
+            i += 2
+        else:
+            # --rm, --cpuset-cpus=..
+            i += 1
+
+    return opts, argv[i], argv[i + 1:]
+
+
+def encode_time():
+
+    value = os.environ.get("FAKE_DOCKER_SLEEP", "0.1")
+
+    if "-" in value:
+        low, high = value.split("-")
+        return random.uniform(float(low), float(high))
+
+    return float(value)
+
+
+class FakeCgroup(object):
+    """
+    Cgroup folder of the fake container. Every update adds CPU time, memory and I/O.
+    """
+
+    def __init__(self, root, cid):
+        self.path = pjoin(root, "docker", cid)
+        self._usage = 0
+        self._memory = 0
+        self._peak = 0
+        self._io = 0
+        os.makedirs(self.path)
+        self.update(0)
+
+    def _write(self, name, content):
+        # Like the kernel files: never seen half-written
+        tmp = pjoin(self.path, "." + name)
+        with open(tmp, "w") as f:
+            f.write(content)
+        os.replace(tmp, pjoin(self.path, name))
+
+    def update(self, seconds):
+        self._usage += int(seconds * 0.9e6)
+        self._memory = random.randint(50, 200) * 2 ** 20
+        self._peak = max(self._peak, self._memory)
+        self._io += random.randint(0, 2 ** 20)
+
+        self._write("cpu.stat", "usage_usec %d\nuser_usec %d\nsystem_usec %d\nnr_periods 0\nnr_throttled 0\n"
+                                "throttled_usec 0\n" % (self._usage, self._usage * 0.8, self._usage * 0.2))
+        self._write("memory.current", "%d\n" % self._memory)
+        self._write("memory.peak", "%d\n" % self._peak)
+        self._write("io.stat", "8:0 rbytes=%d wbytes=%d rios=10 wios=5 dbytes=0 dios=0\n" % (self._io, self._io // 2))
+
+    def remove(self):
+        shutil.rmtree(self.path)
+
+
+def run(argv):
+
+    opts, image, args = parse_run(argv)
+    mounts = opts['mounts']
+
+    segments = int(os.environ.get("FAKE_DOCKER_SEGMENTS", 5))
+    size = int(os.environ.get("FAKE_DOCKER_SEGMENT_SIZE", 4096))
+
+    cid = "%064x" % random.getrandbits(256)
+
+    if 'cidfile' in opts:
+        if os.path.exists(opts['cidfile']):
+            print("fake_docker.py: container ID file found, make sure the other container isn't running "
+                  "or delete %s" % opts['cidfile'], file=sys.stderr)
+            return 125
+        with open(opts['cidfile'], "w") as f:
+            f.write(cid)
+
+    cgroup = None
+    if 'cidfile' in opts and os.environ.get("FAKE_DOCKER_CGROUP_ROOT"):
+        cgroup = FakeCgroup(os.environ["FAKE_DOCKER_CGROUP_ROOT"], cid)
+
+    t = time.perf_counter()
+
+    try:
+        duration = encode_time()
+
+        # Let the cgroup grow during the encode
+        steps = max(1, int(duration / 0.1)) if cgroup else 1
+        for _ in range(steps):
+            time.sleep(duration / steps)
+            if cgroup:
+                cgroup.update(duration / steps)
+    finally:
+        if cgroup:
+            cgroup.remove()
+
+    if random.random() < float(os.environ.get("FAKE_DOCKER_FAIL", 0)):
+        print("Fake encoding failed.", file=sys.stderr)
+        return 1
+
+    name = "_".join(a for a in args if not a.startswith("--"))
+
+    if "/tmpdir" in mounts:
+        outdir = pjoin(mounts["/tmpdir"], name)
+        os.makedirs(outdir, exist_ok=True)
+
+        for s in range(1, segments + 1):
+            with open(pjoin(outdir, "segment_%d.m4s" % s), "wb") as f:
+                f.write(os.urandom(size))
+
+        with open(pjoin(outdir, "manifest.mpd"), "w") as f:
+            f.write("<MPD><!-- %d fake segments --></MPD>\n" % segments)
+
+    if "/results" in mounts:
+        with open(pjoin(mounts["/results"], "fake_results.json"), "w") as f:
+            json.dump({'image': image, 'args': args, 'segments': segments,
+                       'encode_time': time.perf_counter() - t}, f, indent=4)
+
+    print("Fake encoding of %s done." % name)
+
+    return 0
+
+
+def main(argv):
+
+    if not argv:
+        print("usage: fake_docker.py {pull,image,run,kill,rm} ...", file=sys.stderr)
+        return 2
+
+    cmd = argv[0]
+
+    if cmd == "run":
+        return run(argv[1:])
+
+    if cmd in ["pull", "image", "kill", "rm"]:
+        return 0
+
+    print("fake_docker.py: unknown command %s" % cmd, file=sys.stderr)
+
+    return 2
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
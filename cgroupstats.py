@@ -0,0 +1,218 @@
+import os
+import time
+import logging
+import threading
+from os.path import join as pjoin
+
+log = logging.getLogger(__name__)
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+# Cgroup (v2) folders of a docker container, for the systemd and the cgroupfs driver
+CONTAINER_CGROUPS = ["system.slice/docker-{id}.scope", "docker/{id}"]
+
+
+def cpuset_size(cpuset):
+    """
+    Returns the number of cores of a CPU set like "1", "1-2" or "0,2-3" (None: all cores).
+    """
+
+    if not cpuset:
+        return os.cpu_count()
+
+    count = 0
+
+    for part in str(cpuset).split(","):
+        if "-" in part:
+            low, high = part.split("-")
+            count += int(high) - int(low) + 1
+        else:
+            count += 1
+
+    return count
+
+
+def _read_keyed(path):
+    """
+    Reads a flat keyed file like cpu.stat ("key value" per line).
+    """
+
+    values = {}
+
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2:
+                values[parts[0]] = int(parts[1])
+
+    return values
+
+
+def _read_int(path):
+    with open(path) as f:
+        return int(f.read().strip())
+
+
+def _read_io(path):
+    """
+    Sums io.stat ("MAJ:MIN rbytes=.. wbytes=.. rios=.. wios=.." per device) over all devices.
+    """
+
+    totals = {}
+
+    with open(path) as f:
+        for line in f:
+            for field in line.split()[1:]:
+                key, _, value = field.partition("=")
+                totals[key] = totals.get(key, 0) + int(value)
+
+    return totals
+
+
+def read_cgroup(path):
+    """
+    Returns one sample of the cgroup: CPU time (usec), current and peak memory (bytes) and I/O (bytes).
+    Files that do not exist (e.g. memory.peak before Linux 5.19) are left out.
+    """
+
+    sample = {'t': time.time()}
+
+    try:
+        cpu = _read_keyed(pjoin(path, "cpu.stat"))
+        sample['cpu_usec'] = cpu.get('usage_usec', 0)
+        sample['user_usec'] = cpu.get('user_usec', 0)
+        sample['system_usec'] = cpu.get('system_usec', 0)
+        sample['throttled_usec'] = cpu.get('throttled_usec', 0)
+    except FileNotFoundError:
+        pass
+
+    for key, name in [('memory', "memory.current"), ('memory_peak', "memory.peak")]:
+        try:
+            sample[key] = _read_int(pjoin(path, name))
+        except (FileNotFoundError, ValueError):
+            pass
+
+    try:
+        io = _read_io(pjoin(path, "io.stat"))
+        sample['io_read_bytes'] = io.get('rbytes', 0)
+        sample['io_write_bytes'] = io.get('wbytes', 0)
+    except FileNotFoundError:
+        pass
+
+    return sample
+
+
+class CgroupSampler(object):
+
+    def __init__(self, cidfile, cgroup_root=CGROUP_ROOT, interval=1.0, cpus=None):
+        """
+        Samples the cgroup (v2) of a container while it runs. The container is found via
+        the file docker writes with docker run --cidfile. The sampling ends with stop() or
+        when the cgroup is gone (the container exited).
+
+        @param cidfile: Container ID file of docker run
+        @param cgroup_root: Root of the cgroup hierarchy (a fake folder for tests)
+        @param interval: Time in seconds between two samples
+        @param cpus: Number of cores the container may use (for the CPU efficiency)
+        """
+
+        self._cidfile = cidfile
+        self._cgroup_root = cgroup_root
+        self._interval = interval
+        self._cpus = cpus or os.cpu_count()
+        self._path = None
+        self._samples = []
+        self._started = None
+        self._stopped = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="cgroup", daemon=True)
+
+    def start(self):
+        self._started = time.time()
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = time.time()
+        self._stop.set()
+        self._thread.join()
+
+    def _find_cgroup(self):
+
+        try:
+            with open(self._cidfile) as f:
+                cid = f.read().strip()
+        except FileNotFoundError:
+            return None
+
+        if not cid:
+            return None
+
+        for pattern in CONTAINER_CGROUPS:
+            path = pjoin(self._cgroup_root, pattern.format(id=cid))
+            if os.path.isdir(path):
+                return path
+
+        return None
+
+    def _run(self):
+
+        while not self._stop.is_set():
+
+            if self._path is None:
+                self._path = self._find_cgroup()
+
+            if self._path is not None:
+                if not os.path.isdir(self._path):
+                    # The container exited
+                    break
+                try:
+                    self._samples.append(read_cgroup(self._path))
+                except OSError as e:
+                    log.debug("Could not read the cgroup %s: %s" % (self._path, e))
+                    break
+
+            # Look for the container id more often at the start
+            self._stop.wait(self._interval if self._path else min(self._interval, 0.1))
+
+        if self._path is None:
+            log.warning("Did not find the cgroup of the container (%s in %s)." % (self._cidfile, self._cgroup_root))
+
+    def samples(self):
+        return list(self._samples)
+
+    def summary(self):
+        """
+        Returns the resource usage of the container: CPU time, CPU efficiency (CPU time per
+        wall time and allowed core), peak memory and I/O bytes.
+        """
+
+        samples = self._samples
+
+        if not samples:
+            return {'cgroup': self._path, 'samples': 0}
+
+        first, last = samples[0], samples[-1]
+        wall = (self._stopped or time.time()) - self._started
+
+        summary = {'cgroup': self._path, 'samples': len(samples), 'wall_s': wall, 'cpus': self._cpus}
+
+        if 'cpu_usec' in last:
+            cpu_s = last['cpu_usec'] / 1e6
+            summary.update({'cpu_s': cpu_s, 'user_s': last['user_usec'] / 1e6,
+                            'system_s': last['system_usec'] / 1e6, 'throttled_s': last['throttled_usec'] / 1e6,
+                            'cpu_efficiency': cpu_s / (wall * self._cpus) if wall > 0 else None})
+
+        # memory.peak is exact, the maximum of the samples misses short peaks
+        peaks = [s['memory_peak'] for s in samples if 'memory_peak' in s] or \
+                [s['memory'] for s in samples if 'memory' in s]
+        if peaks:
+            summary['memory_peak_bytes'] = max(peaks)
+            summary['memory_peak_exact'] = 'memory_peak' in last
+
+        if 'io_read_bytes' in last:
+            summary['io_read_bytes'] = last['io_read_bytes']
+            summary['io_write_bytes'] = last['io_write_bytes']
+
+        summary['sample_span_s'] = last['t'] - first['t']
+
+        return summary
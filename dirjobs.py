@@ -1,13 +1,218 @@
 import os
+import json
 import shutil
 import logging
 import random
 import time
 import re
+from urllib.parse import unquote
+from collections import deque, Counter
 from os.path import join as pjoin
 
 log = logging.getLogger(__name__)
 
+CLAIM_METHODS = ["rename", "excl", "link"]
+
+# Folder of the lock files (claim methods "excl" and "link")
+LOCK_DIR = ".locks"
+
+# Folder of the jobs reserved by a worker but not started yet (prefetch > 1)
+RESERVED_DIR = "01_reserved"
+
+
+def job_source(name):
+    """
+    Returns the source video of a job (jobs are named <video>_<anything>.txt).
+    """
+    return name.split("_")[0]
+
+
+class RandomPolicy(object):
+    """
+    Selects the waiting jobs in random order (spreads the workers over the jobs).
+    """
+
+    def order(self, jobs):
+        """
+        Returns the jobs in the order they should be claimed.
+        """
+        return random.sample(jobs, len(jobs))
+
+    def first(self, jobs):
+        return random.choice(jobs)
+
+    def started(self, job):
+        pass
+
+    def finished(self, job):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class OrderedPolicy(RandomPolicy):
+    """
+    Selects the waiting jobs in alphabetical order.
+    """
+
+    def order(self, jobs):
+        return sorted(jobs)
+
+    def first(self, jobs):
+        return min(jobs)
+
+
+def _quote(field):
+    # escapes the dots of a field of a marker name (sources, worker IDs and jobs may contain dots)
+    return field.replace("%", "%25").replace(".", "%2E")
+
+
+class LocalityPolicy(RandomPolicy):
+
+    def __init__(self, state_dir, wid="w1", ttl=3600, source=job_source):
+        """
+        Prefers jobs whose source video is processed right now or was processed recently
+        on this host, so the source is likely still in the page cache. Jobs of the same
+        preference are taken in random order to spread the workers.
+
+        The state is kept as empty files in a host-local folder shared by the workers of
+        the host: <source>.<wid>.<job>.active while a job of the source runs (dots in the
+        fields escaped as %2E), <source> with the time of the last use as mtime.
+
+        @param state_dir: Host-local folder for the state files (e.g. in the tmp folder)
+        @param wid: Worker ID
+        @param ttl: Time in seconds a source counts as recently used
+        @param source: A function f(name) -> source of the job
+        """
+
+        self._state_dir = state_dir
+        self._wid = wid
+        self._ttl = ttl
+        self._source = source
+        self._hits = 0
+        self._misses = 0
+
+        os.makedirs(self._state_dir, exist_ok=True)
+
+        # Markers of a previous run of this worker
+        for f in os.listdir(self._state_dir):
+            marker = self._parse_marker(f)
+            if marker is not None and marker[1] == self._wid:
+                os.remove(pjoin(self._state_dir, f))
+
+    def _marker(self, job):
+        return pjoin(self._state_dir, "%s.%s.%s.active" %
+                     (_quote(self._source(job)), _quote(self._wid), _quote(os.path.splitext(job)[0])))
+
+    @staticmethod
+    def _parse_marker(f):
+        """
+        Returns (source, wid) of a marker file name, None for other files.
+        """
+
+        if not f.endswith(".active"):
+            return None
+
+        fields = f[:-len(".active")].split(".")
+        if len(fields) != 3:
+            return None
+
+        return unquote(fields[0]), unquote(fields[1])
+
+    def _state(self):
+        """
+        Returns the sources active on this host and the recently used ones (source -> last use).
+        """
+
+        active = set()
+        recent = {}
+        now = time.time()
+
+        for f in os.listdir(self._state_dir):
+
+            if f.endswith(".active"):
+                marker = self._parse_marker(f)
+                if marker is not None:
+                    active.add(marker[0])
+                continue
+
+            try:
+                mtime = os.stat(pjoin(self._state_dir, f)).st_mtime
+            except FileNotFoundError:
+                continue
+
+            if now - mtime > self._ttl:
+                try:
+                    os.remove(pjoin(self._state_dir, f))
+                except FileNotFoundError:
+                    pass
+                continue
+
+            recent[f] = mtime
+
+        return active, recent
+
+    def order(self, jobs):
+
+        active, recent = self._state()
+
+        def key(job):
+            src = self._source(job)
+            if src in active:
+                return (0, 0)
+            if src in recent:
+                return (1, -recent[src])
+            return (2, 0)
+
+        # Random order within the same preference
+        return sorted(random.sample(jobs, len(jobs)), key=key)
+
+    def first(self, jobs):
+        return self.order(jobs)[0]
+
+    def preferred_sources(self):
+        """
+        Returns the sources in the order of preference: the active ones (in random order),
+        then the recently used ones, the most recent first. For queues that select in a query.
+        """
+
+        active, recent = self._state()
+
+        return random.sample(sorted(active), len(active)) + \
+            sorted((s for s in recent if s not in active), key=lambda s: -recent[s])
+
+    def started(self, job):
+
+        src = self._source(job)
+        active, recent = self._state()
+
+        if src in active or src in recent:
+            self._hits += 1
+        else:
+            self._misses += 1
+
+        log.debug("Source %s of job %s %s on this host." %
+                  (src, job, "is cached" if src in active or src in recent else "was not used recently"))
+
+        open(self._marker(job), "w").close()
+
+    def finished(self, job):
+
+        src = self._source(job)
+
+        open(pjoin(self._state_dir, src), "w").close()
+
+        try:
+            os.remove(self._marker(job))
+        except FileNotFoundError:
+            pass
+
+    def stats(self):
+        total = self._hits + self._misses
+        return {'source_hits': self._hits, 'source_misses': self._misses,
+                'source_hit_rate': self._hits / total if total else 0.0}
+
 
 class Job(object):
 
@@ -22,6 +227,9 @@ class Job(object):
     def failed(self):
         return self._dj.on_job_failed(self)
 
+    def release(self):
+        return self._dj.on_job_released(self)
+
     def __str__(self):
         return "Job(%s)" % self.path()
 
@@ -50,20 +258,44 @@ class Job(object):
         """
         return "%s.%s" % (self._dj._wid, self._job)
 
+    def load(self):
+        """
+        Returns the job dict.
+        """
+        with open(self.path()) as f:
+            return json.load(f)
+
 
 class DirJobs(object):
 
     def __init__(self, jobsdir, wid="w1", rnd_job=True, job_ext=".txt",
                        worker_sync=False, sync_time=1,
-                       job_filter=None):
+                       job_filter=None, claim="rename", lock_timeout=600,
+                       index_max_age=60, prefetch=1, reservation_timeout=3600,
+                       policy=None, max_active=1):
         """
 
         @param jobsidr: Directory where the jobs are in the folder 00_waiting/.
-        @param rnd_job: Choose the job randomly from the waiting ones.
+        @param rnd_job: Choose the job randomly from the waiting ones (if no policy is given).
         @param job_ext: File extension of the jobs (default: .txt)
         @param worker_sync: Sync multiple workers
         @param sync_time: Time until sync to all workers is done (for samba, webdav, etc.)
         @param job_filter: A function with the signature f(path, name) -> boolean to filter jobs
+        @param claim: How a job is claimed. "rename": move the job and (with worker_sync)
+                      wait sync_time for conflicting workers. "excl": exclusively create
+                      a lock file for the job before moving it. "link": like "excl", but
+                      the lock is taken with a hard link (for filesystems where exclusive
+                      create is not atomic, e.g. old NFS).
+        @param lock_timeout: Age in seconds after which a lock file is considered stale.
+        @param index_max_age: Maximum age in seconds of the cached listing of the waiting
+                              jobs (in case the mtime of the folder is not reliable).
+        @param prefetch: Number of jobs reserved per claim round. The reserved jobs are kept
+                         in 01_reserved/ and in a local run queue. Needs a lock claim method.
+        @param reservation_timeout: Age in seconds after which a reservation of another
+                                    worker is considered expired and moved back to 00_waiting/.
+        @param policy: Job selection policy (RandomPolicy, OrderedPolicy, LocalityPolicy).
+                       Default: RandomPolicy, or OrderedPolicy if rnd_job is False.
+        @param max_active: Number of jobs the worker may process at the same time.
         """
 
         self._jobsdir = jobsdir
@@ -73,45 +305,131 @@ class DirJobs(object):
         self._worker_sync = worker_sync
         self._sync_time = sync_time
         self._job_filter = job_filter
-        self._cur_job = None
+        self._claim = claim
+        self._lock_timeout = lock_timeout
+        self._index_max_age = index_max_age
+        self._prefetch = prefetch
+        self._reservation_timeout = reservation_timeout
+        self._max_active = max_active
+        self._active = set()
+
+        # Claims, conflicts and filesystem operations (see counters())
+        self._counters = Counter()
+
+        if policy is None:
+            policy = RandomPolicy() if rnd_job else OrderedPolicy()
+        self._policy = policy
+
+        # Local run queue of reserved jobs: [job, time of the last lease renewal]
+        self._reserved = deque()
+        self._last_reclaim = 0
+
+        # Cached listing of 00_waiting/ and the filtered jobs
+        self._listing = None
+        self._listing_mtime = None
+        self._listing_time = 0
+        self._filtered = None
+        self._filtered_generation = None
+
+        if self._claim not in CLAIM_METHODS:
+            raise Exception("Unknown claim method %s. Use one of %s." % (claim, CLAIM_METHODS))
+
+        if self._prefetch > 1 and self._claim == "rename":
+            raise Exception("Prefetching jobs needs the claim method excl or link.")
 
         # Sanity check for worker ID
         if not re.match('^[a-zA-Z0-9]+$', self._wid):
                 raise Exception("Worker ID is only allowed to contain numbers and letters.")
 
         # Make sure job directories exist.
-        for d in ["00_waiting", "01_running", "02_done", "99_failed"]:
+        for d in ["00_waiting", RESERVED_DIR, "01_running", "02_done", "99_failed"]:
             os.makedirs(pjoin(self._jobsdir, d), exist_ok=True)
 
+        if self._claim != "rename":
+            os.makedirs(pjoin(self._jobsdir, LOCK_DIR), exist_ok=True)
+
+    def stats(self):
+        """
+        Returns the statistics of the selection policy.
+        """
+        return self._policy.stats()
+
+    def counters(self):
+        """
+        Returns the queue counters: claims and the time spent claiming (claim_s), conflicts
+        (rename: conflicts and conflicts_lost, lock: lock_busy), vanished jobs and the
+        filesystem operations (listdir, stat, move, rm, lock, utime).
+        """
+        return dict(self._counters)
+
+    def waiting(self):
+        """
+        Returns the number of waiting jobs that pass the filter (from the cached listing).
+        """
+        return len(self._ls_waiting_jobs())
+
     def on_job_failed(self, job):
 
         log.debug("Job failed: %s" % job)
+
+        self._policy.finished(job.name())
         
         dst = pjoin(self._jobsdir, "99_failed", job.name())
        
         self._move(job.path(), dst)
-        
-        self._cur_job = None
+
+        self._active.discard(job.name())
 
     def on_job_success(self, job):
 
         log.debug("Job finished: %s" % job)
 
+        self._policy.finished(job.name())
+
         dst = pjoin(self._jobsdir, "02_done", job.name())
 
         self._move(job.path(), dst)
-        
-        self._cur_job = None
+
+        self._active.discard(job.name())
+
+    def on_job_released(self, job):
+        """
+        Puts a claimed job back to 00_waiting/ (it could not be started, e.g. the job
+        server is down).
+        """
+
+        log.debug("Job released: %s" % job)
+
+        self._policy.finished(job.name())
+
+        self._move(job.path(), pjoin(self._jobsdir, "00_waiting", job.name()))
+
+        self._active.discard(job.name())
 
     def next_and_lock(self, no_wait=False):
         """
         Get the next job to process and locks it for the worker.
         """
 
-        if self._cur_job:
-            log.error("There is already an active job! Please call done() or failed() on the job first.")
+        if len(self._active) >= self._max_active:
+            log.error("There are already %d active jobs! Please call done() or failed() on a job first." %
+                      len(self._active))
             return None
 
+        t = time.perf_counter()
+
+        if self._prefetch > 1:
+            job = self._next_reserved()
+        else:
+            job = self._next(no_wait)
+
+        self._counters['claim_s'] += time.perf_counter() - t
+        self._counters['claims' if job else 'empty_claims'] += 1
+
+        return job
+
+    def _next(self, no_wait=False):
+
         # Loop until we found a job
         while True:
 
@@ -121,44 +439,373 @@ class DirJobs(object):
             if not jobs:
                 return None
 
-            if self._rnd_job:
-                    job = random.choice(jobs)
-            else:
-                job = sorted(jobs)[0]
+            job = self._policy.first(jobs)
 
             log.debug("Selected job: %s" % job)
 
+            if self._claim != "rename":
+
+                if self._claim_locked(job, "01_running"):
+                    return self._start(job)
+
+                continue
+
             wjob = "%s.%s" % (self._wid, job)
 
             src = pjoin(self._jobsdir, "00_waiting", job)
             dst = pjoin(self._jobsdir, "01_running", wjob)
 
+            mtime = self._waiting_mtime()
+
             try:
                 self._move(src, dst)
             except FileNotFoundError:
                 log.warning("Job %s does not exist anymore. Moving on" % src)
+                self._counters['vanished'] += 1
+                self._remove_from_index(job)
                 continue
 
+            self._remove_from_index(job, moved_from=mtime)
+
             if not self._worker_sync:
-                return Job(self, "01_running", job)
+                return self._start(job)
             else:
 
-                job = self._job_worker_selection(job, no_wait=no_wait)
+                if self._job_worker_selection(job, no_wait=no_wait) is not None:
+                    return self._start(job)
 
-                if job is not None:
-                    return job
+    def _start(self, job):
+
+        self._active.add(job)
+        self._policy.started(job)
+
+        return Job(self, "01_running", job)
+
+    def _claim_locked(self, job, status):
+        """
+        Claims the job while holding its lock file and moves it to status/. Only the
+        lock holder moves the job, so there is no need to wait for other workers and the
+        move itself does not have to be atomic.
+
+        @return: True if the job was claimed.
+        """
+
+        lock = pjoin(self._jobsdir, LOCK_DIR, job + ".lock")
+
+        if not self._acquire_lock(lock):
+            log.debug("Job %s is locked by another worker. Moving on" % job)
+            self._counters['lock_busy'] += 1
+            return False
+
+        try:
+            src = pjoin(self._jobsdir, "00_waiting", job)
+            dst = pjoin(self._jobsdir, status, "%s.%s" % (self._wid, job))
+            mtime = self._waiting_mtime()
+
+            try:
+                self._move(src, dst)
+            except FileNotFoundError:
+                # Another worker claimed it after we listed the jobs
+                log.debug("Job %s does not exist anymore. Moving on" % src)
+                self._counters['vanished'] += 1
+                self._remove_from_index(job)
+                return False
+
+            self._remove_from_index(job, moved_from=mtime)
+        finally:
+            self._rm(lock)
+
+        return True
+
+    def reserve(self, n):
+        """
+        Claims up to n waiting jobs in one round and appends them to the local run queue.
+        The jobs are moved to 01_reserved/ until they are started by next_and_lock().
+        Expired reservations of other workers are put back to 00_waiting/ first.
+
+        @return: Number of reserved jobs.
+        """
+
+        # Expired reservations are rare, no need to look for them in every round
+        if time.time() - self._last_reclaim > self._reservation_timeout / 2:
+            self.reclaim_expired()
+            self._last_reclaim = time.time()
+
+        count = 0
+
+        for job in self._policy.order(self._ls_waiting_jobs()):
+
+            if count >= n:
+                break
+
+            if self._claim_locked(job, RESERVED_DIR):
+                self._reserved.append([job, time.time()])
+                count += 1
+
+        log.debug("Reserved %d jobs: %s" % (count, [j for j, _ in self._reserved]))
+
+        return count
+
+    def _next_reserved(self):
+        """
+        Starts the next job of the local run queue. Refills the queue if it is empty.
+        """
+
+        while True:
+
+            if not self._reserved and not self.reserve(self._prefetch):
+                return None
+
+            job, _ = self._reserved.popleft()
+
+            src = pjoin(self._jobsdir, RESERVED_DIR, "%s.%s" % (self._wid, job))
+            dst = pjoin(self._jobsdir, "01_running", "%s.%s" % (self._wid, job))
+
+            try:
+                self._move(src, dst)
+            except FileNotFoundError:
+                log.warning("Reservation of job %s expired and was taken back. Moving on" % job)
+                continue
+
+            self.renew_reservations()
+
+            return self._start(job)
+
+    def renew_reservations(self):
+        """
+        Touches the reserved jobs whose lease is older than half of the reservation
+        timeout, so other workers do not take them back while we are busy. Call it
+        regularly while a job runs (jobs may take longer than the timeout).
+        """
+
+        now = time.time()
+
+        for entry in list(self._reserved):
+
+            job, renewed = entry
+
+            if now - renewed < self._reservation_timeout / 2:
+                continue
+
+            self._counters['utime'] += 1
+
+            try:
+                os.utime(pjoin(self._jobsdir, RESERVED_DIR, "%s.%s" % (self._wid, job)))
+                entry[1] = now
+            except FileNotFoundError:
+                pass
+
+    def reclaim_expired(self):
+        """
+        Moves reservations that were not renewed within the reservation timeout (the
+        worker died or hangs) back to 00_waiting/.
+        """
+
+        reserved = pjoin(self._jobsdir, RESERVED_DIR)
+        queued = set(j for j, _ in self._reserved)
+        now = time.time()
+
+        self._counters['listdir'] += 1
+
+        for f in os.listdir(reserved):
+
+            wid, _, job = f.partition(".")
+
+            if wid == self._wid and job in queued:
+                continue
+
+            self._counters['stat'] += 1
+
+            try:
+                age = now - os.stat(pjoin(reserved, f)).st_mtime
+            except FileNotFoundError:
+                continue
+
+            if age < self._reservation_timeout:
+                continue
+
+            log.warning("Taking back expired reservation %s (%.0fs old)." % (f, age))
+
+            try:
+                self._move(pjoin(reserved, f), pjoin(self._jobsdir, "00_waiting", job))
+            except FileNotFoundError:
+                pass
+
+    def release(self):
+        """
+        Moves the reserved but not started jobs back to 00_waiting/. Call this before
+        the worker quits.
+        """
+
+        while self._reserved:
+
+            job, _ = self._reserved.popleft()
+
+            log.debug("Releasing reserved job %s" % job)
+
+            try:
+                self._move(pjoin(self._jobsdir, RESERVED_DIR, "%s.%s" % (self._wid, job)),
+                           pjoin(self._jobsdir, "00_waiting", job))
+            except FileNotFoundError:
+                log.warning("Reserved job %s does not exist anymore." % job)
+
+    def _acquire_lock(self, lock):
+
+        content = "%s %f\n" % (self._wid, time.time())
+
+        self._counters['lock'] += 1
+
+        # Second try if a stale lock was removed
+        for _ in range(2):
+
+            if self._claim == "link":
+                locked = self._lock_link(lock, content)
+            else:
+                locked = self._lock_excl(lock, content)
+
+            if locked:
+                return True
+
+            if not self._break_stale_lock(lock):
+                return False
+
+        return False
+
+    def _lock_excl(self, lock, content):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+
+        return True
+
+    def _lock_link(self, lock, content):
+        # Link count check instead of the return value of link() (unreliable on NFS)
+        tmp = "%s.%s.%d" % (lock, self._wid, os.getpid())
+
+        with open(tmp, "w") as f:
+            f.write(content)
+
+        try:
+            os.link(tmp, lock)
+        except OSError:
+            pass
+
+        locked = os.stat(tmp).st_nlink == 2
+        os.remove(tmp)
+
+        return locked
+
+    def _break_stale_lock(self, lock):
+        """
+        Removes the lock if it is older than the lock timeout (the holder died while
+        claiming). Returns True if the lock is gone.
+        """
+
+        try:
+            age = time.time() - os.stat(lock).st_mtime
+        except FileNotFoundError:
+            return True
+
+        if age < self._lock_timeout:
+            return False
+
+        log.warning("Removing stale lock %s (%.0fs old)." % (lock, age))
+
+        # Rename first, so only one worker removes the stale lock.
+        stale = "%s.stale.%s" % (lock, self._wid)
+        try:
+            os.rename(lock, stale)
+        except FileNotFoundError:
+            return True
+
+        # Another worker may have broken the stale lock and taken a new one between our
+        # stat and rename, then we got the new lock: give it back
+        try:
+            age = time.time() - os.stat(stale).st_mtime
+        except FileNotFoundError:
+            return True
+
+        if age < self._lock_timeout:
+
+            log.warning("Lock %s was renewed meanwhile. Putting it back." % lock)
+
+            try:
+                # Not rename, it would replace a lock taken after ours was gone
+                os.link(stale, lock)
+            except FileExistsError:
+                pass
+
+            self._rm(stale)
+
+            return False
+
+        self._rm(stale)
+
+        return True
 
     def _ls_waiting_jobs(self):
         """
         Returns a (filtered) list of the waiting jobs.
+
+        The listing is cached and only renewed if the mtime of 00_waiting/ changed or
+        the listing is older than index_max_age. The filter results are cached as long
+        as the listing and the generation of the filter (if it has one) do not change.
         """
-        
-        jobs = [j for j in os.listdir(pjoin(self._jobsdir, "00_waiting")) if j.endswith(self._job_ext)]
-        
-        if self._job_filter:
-            jobs = [j for j in jobs if self._job_filter(pjoin(self._jobsdir, "00_waiting", j), j)]
-        
-        return jobs
+
+        waiting = pjoin(self._jobsdir, "00_waiting")
+        mtime = self._waiting_mtime()
+
+        if self._listing is None or mtime != self._listing_mtime or \
+           time.time() - self._listing_time > self._index_max_age:
+
+            self._listing = [j for j in os.listdir(waiting) if j.endswith(self._job_ext)]
+            self._counters['listdir'] += 1
+            self._listing_mtime = mtime
+            self._listing_time = time.time()
+            self._filtered = None
+
+        if not self._job_filter:
+            return self._listing
+
+        generation = getattr(self._job_filter, "generation", None)
+
+        if self._filtered is None or generation is None or generation != self._filtered_generation:
+            self._filtered = [j for j in self._listing if self._job_filter(pjoin(waiting, j), j)]
+            self._filtered_generation = generation
+
+        return self._filtered
+
+    def invalidate(self):
+        """
+        Forces a new listing of 00_waiting/ (e.g. after a wakeup by inotify or the
+        doorbell, the mtime of the folder may not have changed in its resolution).
+        """
+        self._listing = None
+
+    def _remove_from_index(self, job, moved_from=None):
+        """
+        Removes a claimed (or vanished) job from the cached listing. If we moved it
+        ourselves and 00_waiting/ had the mtime of the listing right before the move
+        (moved_from, see _waiting_mtime), nobody else changed the folder since the
+        listing and its new mtime is taken over to avoid a new listing.
+        """
+
+        for jobs in [self._listing, self._filtered]:
+            if jobs is not None and job in jobs:
+                jobs.remove(job)
+
+        if moved_from is not None and self._listing is not None and moved_from == self._listing_mtime:
+            self._listing_mtime = self._waiting_mtime()
+
+    def _waiting_mtime(self):
+
+        self._counters['stat'] += 1
+
+        return os.stat(pjoin(self._jobsdir, "00_waiting")).st_mtime
 
     def _job_worker_selection(self, job, no_wait=False):
 
@@ -167,40 +814,45 @@ class DirJobs(object):
             time.sleep(self._sync_time)
 
         job_workers = [j.split(".")[0] for j in os.listdir(pjoin(self._jobsdir, "01_running")) if job in j]
+        self._counters['listdir'] += 1
 
         assert(len(job_workers) > 0 and (self._wid in job_workers))
 
         if len(job_workers) == 1:
-            self._cur_job = Job(self, "01_running", job)
+            return job
         else:
 
                 log.warning("Conflicting workers for job %s! Workers: %s " % (job, job_workers))
 
+                self._counters['conflicts'] += 1
+
                 me_idx = sorted(job_workers).index(self._wid)
 
-                log.debug("me idx:" + me_idx)
-                log.debug("job_workers:" + job_workers)
+                log.debug("me idx: %d" % me_idx)
+                log.debug("job_workers: %s" % job_workers)
 
                 if me_idx == 0:
                     log.info("I am index %d, taking the job!" % me_idx)
 
-                    self._cur_job = Job(self, "01_running", job)
+                    return job
                 else:
                     log.info("I am index %d, giving up on the job" % me_idx)
 
+                    self._counters['conflicts_lost'] += 1
+
                     wjob = "%s.%s" % (self._wid, job)
                     self._rm(pjoin(self._jobsdir, "01_running", wjob))
 
-                    self._cur_job = None
-                
-        return self._cur_job
+                    return None
 
     def _rm(self, f):
         log.debug("RM: %s" % f)
+        self._counters['rm'] += 1
         os.remove(f)
     
     def _move(self, src, dst):
         log.debug("MOVE: %s to %s" % (src, dst))
+        self._counters['move'] += 1
         shutil.move(src, dst)
         os.utime(dst)
 
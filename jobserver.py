@@ -0,0 +1,204 @@
+import os
+import sys
+import json
+import time
+import logging
+import subprocess
+from os.path import join as pjoin
+
+log = logging.getLogger(__name__)
+
+
+def resolve_digest(container, resultdir=None, dryrun=False, docker="docker"):
+    """
+    Pulls the container once and returns the image reference pinned by digest
+    (name@sha256:...). Falls back to the given name for local images without digest.
+
+    @param docker: Docker command (e.g. a stub for benchmarks)
+    """
+
+    if dryrun:
+        log.warning("Dryrun selected. Not pulling docker container!")
+        return container
+
+    log.info("Pulling %s" % container)
+
+    out = subprocess.DEVNULL if resultdir is None else open(pjoin(resultdir, "docker_pull_stdout.txt"), "wt")
+
+    try:
+        subprocess.check_call([docker, "pull", container], stdout=out, stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        log.error("Docker pull failed !!")
+        return None
+    finally:
+        if resultdir is not None:
+            out.close()
+
+    try:
+        digest = subprocess.check_output([docker, "image", "inspect", "--format",
+                                          "{{index .RepoDigests 0}}", container]).decode().strip()
+    except subprocess.CalledProcessError:
+        digest = ""
+
+    if not digest:
+        log.warning("No digest for %s (local image?). Using the name." % container)
+        return container
+
+    log.info("Using image %s" % digest)
+
+    return digest
+
+
+class JobServerError(Exception):
+    """
+    The job server exited before it took the job, the job was not started.
+    """
+    pass
+
+
+class JobServer(object):
+
+    def __init__(self, wid, tmpdir, viddir, resultdir, container,
+                 processor=None, dryrun=False, poll=0.2, docker="docker"):
+        """
+        Long-lived encoding container. video_encode.py runs as a server in the container
+        and processes the job specs that are written to a spool folder.
+
+        @param wid: Worker ID (used for the container name and the spool folder)
+        @param tmpdir: Root of the temporary folders, mounted as /tmpdir
+        @param viddir: Video folder, mounted as /videos
+        @param resultdir: Root of the result folders, mounted as /results
+        @param container: Image to use, ideally pinned by digest (see resolve_digest)
+        @param processor: CPU set of the container
+        @param dryrun: Run video_encode.py as local process in dry-run mode instead of docker.
+        @param poll: Poll interval for the job results in seconds
+        @param docker: Docker command
+        """
+
+        self._wid = wid
+        self._tmpdir = os.path.abspath(tmpdir)
+        self._viddir = os.path.abspath(viddir)
+        self._resultdir = os.path.abspath(resultdir)
+        self._container = container
+        self._processor = processor
+        self._dryrun = dryrun
+        self._poll = poll
+        self._docker = docker
+
+        self._name = "video-encoding-%s" % wid
+        # The spool folder lives in the tmp root, so it is visible in the container as well.
+        self._spool_name = ".spool-%s" % wid
+        self._spool = pjoin(self._tmpdir, self._spool_name)
+        self._proc = None
+        self._jobs = 0
+
+    def start(self):
+
+        os.makedirs(self._spool, exist_ok=True)
+
+        stop = pjoin(self._spool, "STOP")
+        if os.path.exists(stop):
+            os.remove(stop)
+
+        if self._dryrun:
+            cmd = [sys.executable, pjoin(os.path.dirname(os.path.abspath(__file__)), "video_encode.py"),
+                   "--serve=%s" % self._spool, "--tmp-root=%s" % self._tmpdir,
+                   "--results-root=%s" % self._resultdir, "--dry-run"]
+        else:
+            docker_opts = ["--rm", "--name", self._name,
+                           "--user", "%d:%d" % (os.geteuid(), os.getegid()),
+                           "-v", "%s:/videos" % self._viddir,
+                           "-v", "%s:/tmpdir" % self._tmpdir,
+                           "-v", "%s:/results" % self._resultdir]
+
+            if self._processor:
+                docker_opts += ["--cpuset-cpus=%s" % self._processor]
+
+            cmd = [self._docker, "run"] + docker_opts + [self._container, "--serve=/tmpdir/%s" % self._spool_name]
+
+            # A container of a previous run of this worker (killed or crashed) blocks the name
+            subprocess.call([self._docker, "rm", "-f", self._name],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        log.info("Starting job server: %s" % " ".join(cmd))
+
+        with open(pjoin(self._spool, "server.log"), "ab") as f:
+            self._proc = subprocess.Popen(cmd, stdout=f, stderr=subprocess.STDOUT)
+
+    def alive(self):
+        return self._proc is not None and self._proc.poll() is None
+
+    def run_job(self, stats, dirname, args):
+        """
+        Runs a job in the server and waits for it to finish.
+
+        @param stats: Job statistics, the result of the server is added
+        @param dirname: Name of the job folder in the tmp and result root
+        @param args: Arguments for video_encode.py
+        @return: True if the job was successful.
+        @raise JobServerError: The server exited before it took the job (e.g. it could not be restarted)
+        """
+
+        if not self.alive():
+            log.warning("Job server is not running. Restarting it.")
+            self.start()
+
+        self._jobs += 1
+        job_id = "%d.%s" % (self._jobs, dirname)
+
+        spec = pjoin(self._spool, job_id + ".json")
+        with open(spec + ".tmp", "w") as f:
+            json.dump({'dir': dirname, 'args': args}, f)
+        os.rename(spec + ".tmp", spec)
+
+        stats['server_cmd'] = " ".join(args)
+
+        result_file = pjoin(self._spool, job_id + ".result")
+
+        while not os.path.exists(result_file):
+
+            if not self.alive() and not os.path.exists(result_file):
+
+                log.error("Check %s for details." % pjoin(self._spool, "server.log"))
+
+                # The server renames the spec when it starts the job
+                if os.path.exists(spec):
+                    os.remove(spec)
+                    raise JobServerError("Job server exited before it started %s" % job_id)
+
+                log.error("Job server died while processing %s !!" % job_id)
+                return False
+
+            time.sleep(self._poll)
+
+        with open(result_file) as f:
+            result = json.load(f)
+
+        os.remove(result_file)
+
+        stats['server_result'] = result
+
+        if not result['ok']:
+            log.error("Job failed in the job server: %s" % result.get('error'))
+            log.error("Check the logs in %s for details." % pjoin(self._resultdir, dirname))
+
+        return result['ok']
+
+    def stop(self, timeout=60):
+
+        if self._proc is None:
+            return
+
+        log.info("Stopping job server.")
+
+        open(pjoin(self._spool, "STOP"), "w").close()
+
+        try:
+            self._proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            log.warning("Job server did not stop. Killing it.")
+            if not self._dryrun:
+                subprocess.call([self._docker, "kill", self._name])
+            self._proc.kill()
+
+        self._proc = None
@@ -48,3 +48,8 @@ do
         echo screen -dm -S "$WID" bash -c "${WORKER_CMD}; exec bash"
 done
 
+
+# Alternative: one supervisor process with one slot per core (polls the job folder and pulls the image only once)
+# echo screen -dm -S "$HOST" bash -c "python3 worker.py -v \"$VIDEOS\" -t \"$TMP\" -r \"$RESULTS\" -j \"$JOBS\" \
+#     -c \"$IMAGE\" -i \"$HOST\" --slots $((CORES-1)) --log \
+#     --sshfs-dir=\"$SSHFS_DIR\"; exec bash"
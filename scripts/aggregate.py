@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+
+"""
+Incremental aggregation of the result folders of the workers.
+
+Every job leaves a <ts>.<wid>.<job> folder in the result folder (one subfolder
+per rendition for multi-rendition jobs). The folders are parsed in a process
+pool and written into one SQLite database:
+
+  jobs     - one row per job (and rendition) with the scalar values of stats.json,
+             timings.json, vid_opts.json, vid_stats.json, video_statistics.json and
+             the mean/min of the per-frame quality metrics (and metrics_frames.json
+             of the sampled evaluations)
+  frames   - optional, the per-frame metrics of psnr_ssim_vmaf.csv
+  segments - optional, size, duration and average bitrate of every segment
+  seen     - the parsed folders (the manifest of the incremental scan)
+
+Only folders that were not parsed yet (or whose stats.json changed) are read on
+the next run. A folder without stats.json belongs to a running job and is left
+for later. The database can be queried without the result folders, e.g.
+
+  sqlite3 results.db "SELECT opt_codec, avg(metric_vmaf_mean) FROM jobs GROUP BY opt_codec"
+"""
+
+import os, json, csv
+import time
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scripts.statsfile import load_stats, save_arrays
+
+# file of the worker, written last -> the folder is complete
+WORKER_STATS = 'stats.json'
+
+# per rendition: file -> column prefix of its scalar values
+RENDITION_FILES = [('timings.json', 'time_'), ('vid_stats.json', 'vid_'), ('vid_opts.json', 'opt_'),
+    ('video_statistics.json', 'stat_'), ('metrics_frames.json', 'sampling_')]
+
+METRICS_CSV = 'psnr_ssim_vmaf.csv'
+
+# csv columns that are not metrics
+CSV_SKIP = ['n', 'input_file_dist', 'input_file_ref']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS seen (folder TEXT PRIMARY KEY, mtime REAL, parsed REAL);
+CREATE TABLE IF NOT EXISTS jobs (folder TEXT, rendition TEXT);
+CREATE INDEX IF NOT EXISTS jobs_folder ON jobs (folder);
+CREATE TABLE IF NOT EXISTS frames (folder TEXT, rendition TEXT, n INTEGER);
+CREATE INDEX IF NOT EXISTS frames_folder ON frames (folder, rendition);
+CREATE TABLE IF NOT EXISTS segments (folder TEXT, rendition TEXT, seg INTEGER, size REAL, duration REAL,
+    bitrate REAL);
+CREATE INDEX IF NOT EXISTS segments_folder ON segments (folder, rendition);
+"""
+
+def _scalars(d, prefix, out):
+    # flattens nested dicts, lists are left out (they go into the frames/segments tables)
+    for k, v in d.items():
+        key = '{prefix}{k}'.format(prefix=prefix, k=k)
+        if isinstance(v, dict):
+            _scalars(v, key + '_', out)
+        elif isinstance(v, (bool, int, float, str)) or v is None:
+            out[key] = v
+    return out
+
+def _load_json(path):
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return None
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def read_metrics(path):
+    """
+    Returns the frame numbers (column n, only some frames if the evaluation was sampled)
+    and the per-frame metrics of a psnr_ssim_vmaf.csv as dict column -> list.
+    """
+    numbers = []
+    columns = {}
+    with open(path, newline='') as fp:
+        for i, row in enumerate(csv.DictReader(fp)):
+            n = _to_float(row.get('n'))
+            numbers.append(int(n) if n is not None else i + 1)
+            for k, v in row.items():
+                if k in CSV_SKIP or k is None:
+                    continue
+                columns.setdefault(k, []).append(_to_float(v))
+    return numbers, columns
+
+def _segments(stats_path):
+    stats, arrays = load_stats(stats_path)
+    source = arrays if arrays is not None else stats
+    if not all(k in source for k in ['sizes', 'durations', 'bitrates_segs_avg']):
+        return []
+    return [(i, float(size), float(duration), float(bitrate)) for i, (size, duration, bitrate) in \
+        enumerate(zip(source['sizes'], source['durations'], source['bitrates_segs_avg']))]
+
+def rendition_dirs(folder):
+    """
+    Returns (rendition, path) of the renditions of a job folder ('' for single-rendition jobs).
+    """
+    renditions = sorted(d for d in os.listdir(folder) \
+        if os.path.isfile(os.path.join(folder, d, 'vid_opts.json')))
+    if not renditions:
+        return [('', folder)]
+    return [(r, os.path.join(folder, r)) for r in renditions]
+
+def parse_folder(resultdir, name, frames=False, segments=False):
+    """
+    Parses one job folder.
+
+    @return: (name, mtime of stats.json, job rows, frame rows, segment rows)
+    """
+    folder = os.path.join(resultdir, name)
+    mtime = os.stat(os.path.join(folder, WORKER_STATS)).st_mtime
+
+    base = {'folder': name}
+    ts, _, rest = name.partition('.')
+    wid, _, job = rest.partition('.')
+    base.update({'ts': _to_float(ts), 'wid': wid, 'job': job})
+
+    worker_stats = _load_json(os.path.join(folder, WORKER_STATS)) or {}
+    # the cgroup samples are a time series, only the summary is a job value
+    cgroup = worker_stats.pop('cgroup', None)
+    _scalars(worker_stats, 'worker_', base)
+    if cgroup:
+        _scalars(cgroup.get('summary', {}), 'cgroup_', base)
+
+    rows, frame_rows, segment_rows = [], [], []
+    for rendition, path in rendition_dirs(folder):
+        row = dict(base, rendition=rendition)
+        for filename, prefix in RENDITION_FILES:
+            data = _load_json(os.path.join(path, filename))
+            if isinstance(data, dict):
+                _scalars(data, prefix, row)
+
+        csv_path = os.path.join(path, METRICS_CSV)
+        if os.path.exists(csv_path):
+            numbers, metrics = read_metrics(csv_path)
+            row['frame_count'] = max((len(v) for v in metrics.values()), default=0)
+            for k, values in metrics.items():
+                values = np.array([np.nan if v is None else v for v in values])
+                if len(values) and not np.isnan(values).all():
+                    row['metric_{k}_mean'.format(k=k)] = float(np.nanmean(values))
+                    row['metric_{k}_min'.format(k=k)] = float(np.nanmin(values))
+            if frames:
+                keys = sorted(metrics)
+                for i in range(row['frame_count']):
+                    frame = {'folder': name, 'rendition': rendition, 'n': numbers[i] if i < len(numbers) else i + 1}
+                    frame.update({k: metrics[k][i] for k in keys if i < len(metrics[k])})
+                    frame_rows.append(frame)
+
+        stats_path = os.path.join(path, 'video_statistics.json')
+        if segments and os.path.exists(stats_path):
+            segment_rows += [(name, rendition) + seg for seg in _segments(stats_path)]
+
+        rows.append(row)
+
+    return name, mtime, rows, frame_rows, segment_rows
+
+def _parse(task):
+    resultdir, name, frames, segments = task
+    try:
+        return parse_folder(resultdir, name, frames, segments)
+    except Exception as e:
+        print('Could not parse {name}: {e}'.format(name=name, e=e))
+        return name, None, [], [], []
+
+def new_folders(con, resultdir, rescan=False):
+    """
+    Returns the complete job folders that were not parsed yet (and with rescan the
+    ones whose stats.json changed).
+    """
+    seen = dict(con.execute('SELECT folder, mtime FROM seen'))
+    folders = []
+    with os.scandir(resultdir) as it:
+        for entry in it:
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            if entry.name in seen and not rescan:
+                continue
+            try:
+                mtime = os.stat(os.path.join(entry.path, WORKER_STATS)).st_mtime
+            except FileNotFoundError:
+                continue
+            if seen.get(entry.name) != mtime:
+                folders.append(entry.name)
+    return sorted(folders)
+
+def _columns(con, table):
+    return set(r[1] for r in con.execute('PRAGMA table_info({table})'.format(table=table)))
+
+def _quote(name):
+    return '"{name}"'.format(name=name.replace('"', '""'))
+
+def insert_rows(con, table, rows, columns):
+    """
+    Inserts dict rows, new keys are added as columns first.
+    """
+    for key in sorted(set(k for row in rows for k in row) - columns):
+        con.execute('ALTER TABLE {table} ADD COLUMN {col}'.format(table=table, col=_quote(key)))
+        columns.add(key)
+    # one statement per set of keys
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    for keys, group in groups.items():
+        con.executemany('INSERT INTO {table} ({cols}) VALUES ({marks})'.format(table=table, \
+            cols=','.join(_quote(k) for k in keys), marks=','.join('?' * len(keys))), \
+            [[row[k] for k in keys] for row in group])
+
+def aggregate(resultdir, db, processes=None, frames=False, segments=False, rescan=False, batch=500):
+    """
+    Parses the new job folders of resultdir into the database.
+
+    @return: Number of parsed folders
+    """
+    con = sqlite3.connect(db, isolation_level=None)
+    con.executescript(SCHEMA)
+
+    folders = new_folders(con, resultdir, rescan=rescan)
+    print('{n} new result folders in {resultdir}'.format(n=len(folders), resultdir=resultdir))
+    if not folders:
+        return 0
+
+    columns = {t: _columns(con, t) for t in ['jobs', 'frames']}
+    tasks = [(resultdir, name, frames, segments) for name in folders]
+    start = time.time()
+    count = 0
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        con.execute('BEGIN')
+        for name, mtime, rows, frame_rows, segment_rows in pool.map(_parse, tasks, chunksize=16):
+            if mtime is None:
+                continue
+            # a changed folder replaces its old rows
+            for table in ['jobs', 'frames', 'segments']:
+                con.execute('DELETE FROM {table} WHERE folder = ?'.format(table=table), (name,))
+            insert_rows(con, 'jobs', rows, columns['jobs'])
+            insert_rows(con, 'frames', frame_rows, columns['frames'])
+            con.executemany('INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?)', segment_rows)
+            con.execute('INSERT OR REPLACE INTO seen VALUES (?, ?, ?)', (name, mtime, time.time()))
+            count += 1
+            # commit in batches, an interrupted run keeps what it parsed
+            if count % batch == 0:
+                con.execute('COMMIT')
+                con.execute('BEGIN')
+                print('{count}/{total} folders ({rate:.0f}/s)'.format(count=count, total=len(tasks), \
+                    rate=count / (time.time() - start)))
+        con.execute('COMMIT')
+
+    print('Parsed {count} folders in {dur:.1f}s'.format(count=count, dur=time.time() - start))
+    return count
+
+def export_npz(db, path, table='jobs'):
+    """
+    Writes a table column by column into an .npz file (see statsfile.load_arrays): numeric
+    columns as float64 (NULL -> nan), the others as strings.
+    """
+    con = sqlite3.connect(db)
+    cursor = con.execute('SELECT * FROM {table}'.format(table=table))
+    names = [d[0] for d in cursor.description]
+    rows = cursor.fetchall()
+    arrays = {}
+    for i, name in enumerate(names):
+        values = [r[i] for r in rows]
+        if all(v is None or isinstance(v, (int, float)) for v in values):
+            arrays[name] = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        else:
+            arrays[name] = np.array(['' if v is None else str(v) for v in values])
+    save_arrays(path, arrays)
+    return len(rows)
+
+if __name__== "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Aggregate the result folders into a SQLite database.')
+    parser.add_argument('resultdir', help='Result folder of the workers.')
+    parser.add_argument('-o', '--output', help='Database file.', default='results.db')
+    parser.add_argument('-j', '--processes', help='Parser processes (default: number of cores).', type=int,
+        default=None)
+    parser.add_argument('--frames', help='Also store the per-frame metrics (frames table).', action='store_true')
+    parser.add_argument('--segments', help='Also store the per-segment statistics (segments table).',
+        action='store_true')
+    parser.add_argument('--rescan', help='Parse folders again whose stats.json changed.', action='store_true')
+    parser.add_argument('--npz', help='Write the jobs table column by column into this .npz file.', default=None)
+    args = parser.parse_args()
+
+    aggregate(args.resultdir, args.output, processes=args.processes, frames=args.frames,
+        segments=args.segments, rescan=args.rescan)
+
+    if args.npz:
+        print('Wrote {n} jobs to {path}'.format(n=export_npz(args.output, args.npz), path=args.npz))
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+
+"""
+Combined analysis of an encoded representation.
+
+The representation is decoded only once: a single ffprobe run on a lavfi
+graph decodes it together with the reference, computes PSNR, SSIM and VMAF
+per frame and reports the frame type and the metrics of every frame. The
+packet sizes needed for the segment statistics are read by demuxing only.
+
+For approximate quality (e.g. bitrate ladder sweeps) a subset of the metrics
+can be evaluated on a subset of the frames (every n-th frame or a few frames
+per segment, see sampled_quality). A select filter in the graph drops the
+other frames before the metric filters, so they are decoded but not compared.
+"""
+
+import os, json
+import time
+import tempfile
+from array import array
+import numpy as np
+from scripts.getStats import iter_ffprobe_compact, get_vid_stream_packets, parse_float, get_durations
+
+VMAF_MODEL = '/usr/local/share/model/vmaf_4k_v0.6.1.json'
+
+# frame tags set by the psnr and ssim filters -> csv column
+PSNR_TAGS = [('mse_avg', 'mse_avg'), ('mse.u', 'mse_u'), ('mse.v', 'mse_v'), ('mse.y', 'mse_y'),
+             ('psnr_avg', 'psnr_avg'), ('psnr.u', 'psnr_u'), ('psnr.v', 'psnr_v'), ('psnr.y', 'psnr_y')]
+SSIM_TAGS = [('All', 'ssim_avg'), ('U', 'ssim_u'), ('V', 'ssim_v'), ('Y', 'ssim_y')]
+
+METRICS = ['psnr', 'ssim', 'vmaf']
+
+# csv column compared in the validation per metric
+MAIN_COLUMNS = {'psnr': 'psnr_avg', 'ssim': 'ssim_avg', 'vmaf': 'vmaf'}
+
+def _escape(path):
+    # escaping for a filename inside a filter graph
+    return path.replace('\\', '\\\\').replace(':', '\\:').replace("'", "\\'")
+
+def quality_graph(distorted, reference, vmaf_log, model=VMAF_MODEL, metrics=METRICS, select=None):
+    """
+    Returns the lavfi graph that compares distorted with reference with the given
+    metrics (in the order of METRICS). With select (an expression of the select
+    filter, e.g. "not(mod(n\\,4))") only the selected frames of both are compared.
+    """
+    metrics = [m for m in METRICS if m in metrics]
+    if not metrics:
+        raise ValueError('No metric selected, use some of {metrics}.'.format(metrics=METRICS))
+    sel = ",select='{expr}'".format(expr=select) if select else ''
+    refs = ''.join('[ref{i}]'.format(i=i + 1) for i in range(len(metrics)))
+    graph = 'movie={dist}{sel}[dist];movie={ref}{sel}{split}{refs};'.format(dist=_escape(distorted), \
+        ref=_escape(reference), sel=sel, split=',split={n}'.format(n=len(metrics)) if len(metrics) > 1 else '', \
+        refs=refs)
+    filters = {
+        'psnr': 'psnr',
+        'ssim': 'ssim',
+        'vmaf': 'libvmaf=model=\'path={model}\':log_fmt=json:log_path={log}'.format(model=model, log=_escape(vmaf_log))
+    }
+    chain = []
+    for i, metric in enumerate(metrics):
+        src = 'dist' if i == 0 else 'dist{i}'.format(i=i)
+        out = 'out0' if i == len(metrics) - 1 else 'dist{i}'.format(i=i + 1)
+        chain.append('[{src}][ref{i}]{filter}[{out}]'.format(src=src, i=i + 1, filter=filters[metric], out=out))
+    return graph + ';'.join(chain)
+
+def _read_vmaf_log(vmaf_log):
+    with open(vmaf_log) as fp:
+        frames = json.load(fp)['frames']
+    return [frame['metrics'] for frame in frames]
+
+def _tags(metrics):
+    # (frame tag, csv column) of the psnr and ssim filters in the graph
+    tags = []
+    if 'psnr' in metrics:
+        tags += [('tag:lavfi.psnr.' + t, c) for t, c in PSNR_TAGS]
+    if 'ssim' in metrics:
+        tags += [('tag:lavfi.ssim.' + t, c) for t, c in SSIM_TAGS]
+    return tags
+
+def write_metrics_csv(path, metrics, vmaf, distorted, reference, tags=None, numbers=None):
+    """
+    Writes the per-frame metrics in the csv layout of ffmpeg_quality_metrics.
+
+    @param tags: (frame tag, csv column) of the values in metrics (default: psnr and ssim)
+    @param numbers: Frame number (n) of every row, if only some frames were evaluated
+    """
+    if tags is None:
+        tags = _tags(METRICS)
+    vmaf_keys = sorted(vmaf[0].keys()) if vmaf else []
+    columns = ['n'] + [c for _, c in tags] + vmaf_keys + ['input_file_dist', 'input_file_ref']
+    with open(path, 'w') as f:
+        f.write(','.join(columns) + '\n')
+        for i, row in enumerate(metrics):
+            values = [str(numbers[i] if numbers is not None else i + 1)] + row
+            if i < len(vmaf):
+                values += [str(vmaf[i].get(k, '')) for k in vmaf_keys]
+            else:
+                values += [''] * len(vmaf_keys)
+            values += [distorted, reference]
+            f.write(','.join(values) + '\n')
+
+def _join_packets(timestamps, pts, sizes):
+    # packet sizes per decoded frame (frames are in presentation order)
+    order = np.argsort(pts, kind='stable')
+    pts, sizes = pts[order], sizes[order]
+    if len(pts) == len(timestamps):
+        return pts, sizes
+    if len(pts) == 0:
+        return timestamps, np.zeros(len(timestamps), dtype=np.int64)
+    # frames and packets do not match up, use the packet closest in time
+    right = np.clip(np.searchsorted(pts, timestamps), 0, len(pts) - 1)
+    left = np.clip(right - 1, 0, len(pts) - 1)
+    nearest = np.where(np.abs(pts[left] - timestamps) <= np.abs(pts[right] - timestamps), left, right)
+    return timestamps, sizes[nearest]
+
+def _run_quality(distorted, reference, metrics_csv, model=VMAF_MODEL, metrics=METRICS, select=None, numbers=None):
+    # one ffprobe run on the quality graph, returns timestamps and frame types of the compared frames
+    fd, vmaf_log = tempfile.mkstemp(suffix='.json')
+    os.close(fd)
+    # the graph is read from a file, a long select expression would exceed the argument size limit
+    fd, graph_file = tempfile.mkstemp(suffix='.lavfi')
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(quality_graph(distorted, reference, vmaf_log, model=model, metrics=metrics, select=select))
+    tags = _tags(metrics)
+    command = ['ffprobe', '-v', 'error', '-f', 'lavfi', '-graph_file', graph_file,
+            '-show_entries', 'frame=best_effort_timestamp_time,pict_type:frame_tags',
+            '-print_format', 'compact=print_section=0',
+            '-i', 'quality']
+    print('Exec: ', ' '.join(command))
+
+    timestamps = array('d')
+    pict_types = bytearray()
+    values = []
+    try:
+        for frame in iter_ffprobe_compact(command):
+            timestamps.append(parse_float(frame.get('best_effort_timestamp_time', 'N/A')))
+            pict_types += frame.get('pict_type', '?')[:1].encode('ascii') or b'?'
+            values.append([frame.get(t, '') for t, _ in tags])
+        vmaf = _read_vmaf_log(vmaf_log) if 'vmaf' in metrics else []
+    finally:
+        os.remove(vmaf_log)
+        os.remove(graph_file)
+
+    write_metrics_csv(metrics_csv, values, vmaf, distorted, reference, tags=tags, numbers=numbers)
+
+    return np.frombuffer(timestamps, dtype=np.float64), np.frombuffer(bytes(pict_types), dtype='S1')
+
+def analyse_representation(distorted, reference, metrics_csv, model=VMAF_MODEL, metrics=METRICS):
+    """
+    Decodes the distorted video once and computes PSNR, SSIM and VMAF (or the given
+    subset of them) against the reference. The metrics are written to metrics_csv.
+
+    @return: frames dict as returned by getStats.get_vid_stream_frames
+    """
+    timestamps, pict_types = _run_quality(distorted, reference, metrics_csv, model=model, metrics=metrics)
+
+    pts, sizes = get_vid_stream_packets(distorted)
+    timestamps, pkt_sizes = _join_packets(timestamps, pts, sizes)
+    return {
+        'timestamps': timestamps,
+        'pkt_sizes': pkt_sizes,
+        'pict_types': pict_types
+    }
+
+def segment_of(timestamps, durations):
+    """
+    Returns the segment of every frame, by the segment durations of the playlist.
+    """
+    ends = np.cumsum(durations)
+    return np.minimum(np.searchsorted(ends, timestamps - timestamps.min(), side='right'), len(durations) - 1)
+
+def sample_ranges(timestamps, durations=None, frame_step=1, segment_samples=0):
+    """
+    Returns the frames (indices in presentation order) to evaluate as ranges
+    (first, last, step): segment_samples evenly spaced frames of every segment
+    (starting with the first frame of the segment) if durations are given, else
+    every frame_step-th frame.
+    """
+    count = len(timestamps)
+    if segment_samples and durations:
+        segments = segment_of(np.sort(timestamps), durations)
+        seg = np.arange(len(durations))
+        ranges = []
+        for first, end in zip(np.searchsorted(segments, seg, side='left'), np.searchsorted(segments, seg, side='right')):
+            size = int(end - first)
+            if size == 0:
+                continue
+            samples = min(segment_samples, size)
+            step = max(1, size // samples)
+            ranges.append((int(first), int(first) + (samples - 1) * step, step))
+        return ranges
+    step = max(1, int(frame_step))
+    return [(0, (count - 1) // step * step, step)] if count else []
+
+def range_frames(ranges):
+    return [n for first, last, step in ranges for n in range(first, last + 1, step)]
+
+def select_expression(ranges, count):
+    """
+    Returns the expression of the select filter for the frame ranges (one term per
+    range), None for all frames.
+    """
+    if sum((last - first) // step + 1 for first, last, step in ranges) == count:
+        return None
+    if len(ranges) == 1 and ranges[0][0] == 0 and ranges[0][1] + ranges[0][2] >= count:
+        return 'not(mod(n\\,{step}))'.format(step=ranges[0][2])
+    terms = []
+    for first, last, step in ranges:
+        term = 'between(n\\,{first}\\,{last})'.format(first=first, last=last)
+        if step > 1:
+            term += '*not(mod(n-{first}\\,{step}))'.format(first=first, step=step)
+        terms.append(term)
+    return '+'.join(terms)
+
+def read_metrics_csv(path):
+    """
+    Returns the frame numbers and the columns (column -> float array) of a metrics csv.
+    """
+    with open(path) as f:
+        columns = f.readline().strip().split(',')
+        rows = [line.strip().split(',') for line in f if line.strip()]
+    numbers = np.array([int(r[0]) for r in rows], dtype=np.int64)
+    values = {}
+    for i, column in enumerate(columns):
+        if column in ['n', 'input_file_dist', 'input_file_ref']:
+            continue
+        values[column] = np.array([parse_float(r[i]) if r[i] else np.nan for r in rows])
+    return numbers, values
+
+def compare_metrics(sampled_csv, full_csv, metrics, segments=None):
+    """
+    Measures the error of the sampled evaluation against the full one: the error of
+    the mean of every metric, the mean error of the per-segment means and the largest
+    difference at the same frame (VMAF uses the motion to the previous compared frame,
+    so it changes when frames are skipped).
+
+    @param segments: Segment of every frame (index n - 1), for the per-segment errors
+    """
+    numbers, sampled = read_metrics_csv(sampled_csv)
+    full_numbers, full = read_metrics_csv(full_csv)
+    index = {n: i for i, n in enumerate(full_numbers.tolist())}
+    at = np.array([index.get(n, -1) for n in numbers.tolist()])
+    errors = {}
+    for metric in metrics:
+        column = MAIN_COLUMNS[metric]
+        if column not in sampled or column not in full:
+            continue
+        s, f = sampled[column], full[column]
+        error = {
+            'full_mean': float(np.nanmean(f)),
+            'sampled_mean': float(np.nanmean(s)),
+        }
+        error['abs_error'] = abs(error['sampled_mean'] - error['full_mean'])
+        error['rel_error'] = error['abs_error'] / abs(error['full_mean']) if error['full_mean'] else None
+        valid = at >= 0
+        if valid.any():
+            error['max_frame_diff'] = float(np.nanmax(np.abs(s[valid] - f[at[valid]])))
+        if segments is not None:
+            seg_f = segments[np.clip(full_numbers - 1, 0, len(segments) - 1)]
+            seg_s = segments[np.clip(numbers - 1, 0, len(segments) - 1)]
+            seg_errors = [abs(np.nanmean(s[seg_s == seg]) - np.nanmean(f[seg_f == seg])) \
+                for seg in np.unique(seg_s)]
+            error['segment_abs_error_mean'] = float(np.mean(seg_errors))
+            error['segment_abs_error_max'] = float(np.max(seg_errors))
+        errors[metric] = error
+    return errors
+
+def sampled_quality(distorted, reference, metrics_csv, playlist=None, model=VMAF_MODEL, metrics=METRICS,
+        frame_step=1, segment_samples=0, validate=False):
+    """
+    Computes the given metrics on a subset of the frames (every frame_step-th frame or
+    segment_samples frames per segment of the m3u8 playlist) and writes them to
+    metrics_csv. The csv has the real frame numbers in the column n.
+
+    @param validate: Also evaluate all frames (written next to metrics_csv as *_full.csv)
+                     and report the error of the sampled evaluation
+    @return: report with the evaluated frames (indices in presentation order) and the timing
+    """
+    pts, _ = get_vid_stream_packets(distorted)
+    timestamps = np.sort(pts[~np.isnan(pts)])
+    durations = get_durations(playlist) if playlist else None
+    ranges = sample_ranges(timestamps, durations, frame_step=frame_step, segment_samples=segment_samples)
+    frames = range_frames(ranges)
+    select = select_expression(ranges, len(timestamps))
+
+    report = {
+        'metrics': [m for m in METRICS if m in metrics],
+        'frame_step': frame_step,
+        'segment_samples': segment_samples,
+        'frame_count': len(timestamps),
+        'evaluated': len(frames),
+        'frames': frames
+    }
+
+    start = time.time()
+    _run_quality(distorted, reference, metrics_csv, model=model, metrics=metrics, select=select,
+        numbers=[n + 1 for n in frames])
+    report['time'] = time.time() - start
+
+    if validate:
+        full_csv = os.path.splitext(metrics_csv)[0] + '_full.csv'
+        start = time.time()
+        _run_quality(distorted, reference, full_csv, model=model, metrics=metrics)
+        report['full_time'] = time.time() - start
+        segments = segment_of(timestamps, durations) if durations else None
+        report['validation'] = compare_metrics(metrics_csv, full_csv, report['metrics'], segments=segments)
+
+    return report
+
+if __name__== "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Quality metrics of an encoded representation.')
+    parser.add_argument('distorted', help='Encoded video (e.g. the m3u8 playlist).')
+    parser.add_argument('reference', help='Reference video.')
+    parser.add_argument('csv', help='Output csv.')
+    parser.add_argument('--metrics', help='Metrics to compute.', nargs='+', choices=METRICS, default=METRICS)
+    parser.add_argument('--frame-step', help='Evaluate every n-th frame.', type=int, default=1)
+    parser.add_argument('--segment-samples', help='Evaluate this many frames per segment of the playlist.',
+        type=int, default=0)
+    parser.add_argument('--validate', help='Also evaluate all frames and report the error.', action='store_true')
+    args = parser.parse_args()
+    if args.frame_step > 1 or args.segment_samples or args.validate or args.metrics != METRICS:
+        playlist = args.distorted if args.distorted.endswith('.m3u8') else None
+        report = sampled_quality(args.distorted, args.reference, args.csv, playlist=playlist, metrics=args.metrics,
+            frame_step=args.frame_step, segment_samples=args.segment_samples, validate=args.validate)
+        print(json.dumps({k: v for k, v in report.items() if k != 'frames'}, indent=4))
+    else:
+        frames = analyse_representation(args.distorted, args.reference, args.csv)
+        print('Frames: ', len(frames['timestamps']))
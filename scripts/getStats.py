@@ -4,129 +4,288 @@
 This script allows to calculate the stats per segment from a m3u8 file.
 """
 
-import os, sys, re, time, json
+import sys, json
 import subprocess
+from array import array
+from bisect import bisect_left
 import numpy as np
 
-def calc_stats(framelist,fps, durations):
-    bitrates_segs_avg = []
-    bitrates_segs = []
-    sizes = []
-    framecount = 0
-    for frames in framelist:
-        framecount += len(frames)
-        bitrate_seg_avg, bitrates_seg, size = calc_avg_bitrate_filesize(frames,fps)
-        bitrates_segs_avg.append(bitrate_seg_avg)
-        bitrates_segs.append(bitrates_seg.tolist())
-        sizes.append(size)
-    # get bitrates per frame
-    bitrates = np.concatenate(bitrates_segs, axis=0)
-
-    # get avg bitrates per segment
-    bitrates_segs_avg = np.array(bitrates_segs_avg)
-    
-    sizes = np.array(sizes)
-    durations = np.array(durations)
+def _stats_dict(bitrates_segs_avg, bitrates, bitrates_segs, sizes, durations):
     ret_data = {
         # on segment basis
         'bitrates_segs_avg_mean': bitrates_segs_avg.mean(),
         'bitrates_segs_avg_std' : bitrates_segs_avg.std(),
-        'bitrates_segs_avg_min' : min(bitrates_segs_avg),
-        'bitrates_segs_avg_max' : max(bitrates_segs_avg),
-        'bitrates_segs_avg' : bitrates_segs_avg.tolist(),
+        'bitrates_segs_avg_min' : bitrates_segs_avg.min(),
+        'bitrates_segs_avg_max' : bitrates_segs_avg.max(),
 
         # on frame basis
         'bitrate_mean': bitrates.mean(),
         'bitrate_std' : bitrates.std(),
-        'bitrate_min' : min(bitrates),
-        'bitrate_max' : max(bitrates),
-        'bitrates' : bitrates.tolist(),
+        'bitrate_min' : bitrates.min(),
+        'bitrate_max' : bitrates.max(),
 
-        'bitrates_segs' : bitrates_segs,
         'size_total' : np.sum(sizes),
         'size_seg_mean' : sizes.mean(),
         'size_seg_std' : sizes.std(),
-        'size_seg_min' : min(sizes),
-        'size_seg_max' : max(sizes),
-        'sizes' : sizes.tolist(),
+        'size_seg_min' : sizes.min(),
+        'size_seg_max' : sizes.max(),
         'durations_mean' : durations.mean(),
         'durations_std' : durations.std(),
-        'durations_min' : min(durations),
-        'durations_max' : max(durations),
-        'durations' : durations.tolist()
+        'durations_min' : durations.min(),
+        'durations_max' : durations.max(),
     }
-    #print('Framecount: ', framecount)
+    if bitrates_segs is None:
+        ret_data['segment_count'] = len(sizes)
+        ret_data['frame_count'] = len(bitrates)
+    else:
+        ret_data['bitrates_segs_avg'] = bitrates_segs_avg.tolist()
+        ret_data['bitrates'] = bitrates.tolist()
+        ret_data['bitrates_segs'] = bitrates_segs
+        ret_data['sizes'] = sizes.tolist()
+        ret_data['durations'] = durations.tolist()
     return ret_data
 
-def calc_avg_bitrate_filesize(frames,fps):
-    bitrates = []
-    pkt_sizes = []
-    for frame in frames:
-        size = float(frame['pkt_size'])*8 # now b
-        pkt_sizes.append(float(frame['pkt_size'])*8)
-        bitrates.append(size*fps)
-    # avg bitrate, segment size
-    bitrates = np.array(bitrates)
-    pkt_sizes = np.array(pkt_sizes)
-    return bitrates.mean(), bitrates, np.sum(pkt_sizes)
+def _segment_sums(values, offsets, lengths):
+    # sum per segment of the concatenated values, empty segments sum up to 0
+    sums = np.zeros(len(lengths))
+    nonempty = lengths > 0
+    if nonempty.any():
+        sums[nonempty] = np.add.reduceat(values, offsets[nonempty])
+    return sums
+
+def calc_stats_arrays(pkt_sizes, bounds, fps):
+    """
+    Calculates the per-frame and per-segment arrays the statistics are based on.
+
+    @param pkt_sizes: Packet size in bytes per frame
+    @param bounds: [begin, end) frame indices per segment (see get_segment_bounds)
+    @param fps: Frame rate of the video
+    @return: dict with the bitrates per frame of all segments concatenated, the
+             offsets of the segments in them, the average bitrates and the sizes
+             of the segments.
+    """
+    bounds = np.asarray(bounds, dtype=np.int64).reshape(-1, 2)
+    begins, ends = bounds[:, 0], bounds[:, 1]
+    lengths = ends - begins
+    offsets = np.cumsum(lengths) - lengths
+
+    # concatenate the frames of all segments (segments may overlap)
+    idx = np.arange(lengths.sum()) - np.repeat(offsets - begins, lengths)
+    sizes_frames = np.asarray(pkt_sizes, dtype=np.float64)[idx]*8 # now b
+    bitrates = sizes_frames*fps
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        bitrates_segs_avg = _segment_sums(bitrates, offsets, lengths) / lengths
+    return {
+        'bitrates': bitrates,
+        'seg_offsets': offsets,
+        'bitrates_segs_avg': bitrates_segs_avg,
+        'sizes': _segment_sums(sizes_frames, offsets, lengths)
+    }
+
+def calc_stats_full_clean(pkt_sizes, bounds, fps, durations, arrays=None, summary_only=False):
+    """
+    Calculates the statistics for all segments and the "clean" statistics without
+    the last segment in one pass.
+
+    @param pkt_sizes: Packet size in bytes per frame
+    @param bounds: [begin, end) frame indices per segment (see get_segment_bounds)
+    @param fps: Frame rate of the video
+    @param durations: Segment durations from the m3u8 file
+    @param arrays: Result of calc_stats_arrays, if already calculated
+    @param summary_only: Leave out the per-frame/per-segment lists (bitrates_segs_avg, bitrates,
+                         bitrates_segs, sizes, durations)
+    @return: (stats, stats_clean)
+    """
+    if arrays is None:
+        arrays = calc_stats_arrays(pkt_sizes, bounds, fps)
+    bitrates = arrays['bitrates']
+    offsets = arrays['seg_offsets']
+    bitrates_segs_avg = arrays['bitrates_segs_avg']
+    sizes = arrays['sizes']
+    durations = np.array(durations)
+
+    if summary_only:
+        bitrates_segs = None
+    else:
+        bitrates_segs = [seg.tolist() for seg in np.split(bitrates, offsets[1:])]
+
+    # the clean statistics work on a prefix of the same arrays
+    n_clean = len(sizes) - 1
+    stats = _stats_dict(bitrates_segs_avg, bitrates, bitrates_segs, sizes, durations)
+    stats_clean = _stats_dict(bitrates_segs_avg[:n_clean], bitrates[:offsets[-1]],
+            None if summary_only else bitrates_segs[:n_clean], sizes[:n_clean], durations)
+    return stats, stats_clean
+
+def calc_stats(pkt_sizes, bounds, fps, durations):
+    return calc_stats_full_clean(pkt_sizes, bounds, fps, durations)[0]
+
+# Only the frame fields that are needed for the segment statistics are probed.
+PROBE_FIELDS = ['best_effort_timestamp_time', 'pkt_size', 'pict_type']
+
+def iter_ffprobe_compact(command):
+    """
+    Runs a ffprobe command with compact output (print_section=0) and yields one
+    dict (key -> string) per printed section. The output of ffprobe is consumed
+    line by line and never held in memory as a whole.
+    """
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        for line in proc.stdout:
+            line = line.decode('utf-8').strip()
+            if not line:
+                continue
+            section = {}
+            for entry in line.split('|'):
+                key, _, value = entry.partition('=')
+                section[key] = value
+            yield section
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    if proc.returncode != 0:
+        sys.exit('Failed to execute {cmd}'.format(cmd=' '.join(command)))
+
+def iter_probe_frames(file_name, fields=PROBE_FIELDS):
+    """
+    Runs ffprobe on file_name and yields one dict (field -> string) per frame.
+    """
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'frame={fields}'.format(fields=','.join(fields)),
+            '-print_format', 'compact=print_section=0',
+            '-i', file_name]
+    return iter_ffprobe_compact(command)
+
+def get_vid_stream_packets(file_name):
+    """
+    Returns pts (float64) and size (int64) of the video packets of file_name.
+    Only demuxes the file, no frame is decoded. The packets are in decoding order.
+    """
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,size',
+            '-print_format', 'compact=print_section=0',
+            '-i', file_name]
+    pts = array('d')
+    sizes = array('q')
+    for packet in iter_ffprobe_compact(command):
+        pts.append(parse_float(packet.get('pts_time', 'N/A')))
+        size = packet.get('size', 'N/A')
+        sizes.append(int(size) if size.isdigit() else 0)
+    return np.frombuffer(pts, dtype=np.float64), np.frombuffer(sizes, dtype=np.int64)
+
+def parse_float(value):
+    try:
+        return float(value)
+    except ValueError:
+        # ffprobe reports missing values as N/A
+        return float('nan')
+
+def get_vid_stream_frames(file_name):
+    """
+    Streaming variant of get_vid_stream_stats. Returns the probed frames as compact
+    numpy arrays: timestamps (float64), pkt_sizes (int64) and pict_types (S1).
+    """
+    timestamps = array('d')
+    pkt_sizes = array('q')
+    pict_types = bytearray()
+    for frame in iter_probe_frames(file_name):
+        timestamps.append(parse_float(frame.get('best_effort_timestamp_time', 'N/A')))
+        pkt_size = frame.get('pkt_size', 'N/A')
+        pkt_sizes.append(int(pkt_size) if pkt_size.isdigit() else 0)
+        pict_types += frame.get('pict_type', '?')[:1].encode('ascii') or b'?'
+    return {
+        'timestamps': np.frombuffer(timestamps, dtype=np.float64),
+        'pkt_sizes': np.frombuffer(pkt_sizes, dtype=np.int64),
+        'pict_types': np.frombuffer(bytes(pict_types), dtype='S1')
+    }
 
 def get_vid_stream_stats(file_name):
-    command = 'ffprobe -show_entries frame -show_streams ' \
-            '-print_format json -show_entries frame ' \
-            '-i {file_name}'.format(file_name=file_name)
-    proc = subprocess.Popen(command.split(), \
-    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stderr = proc.communicate()
-    json_dump = json.loads(stderr[0].decode('utf-8'))
     times = []
-    #print('Frame first: ', len(json_dump['frames']))
-    frames = json_dump['frames']
-    for frame in frames:
-        frame_type = frame['pict_type']
-        if frame_type == 'I':
+    frames = []
+    for frame in iter_probe_frames(file_name):
+        frames.append(frame)
+        if frame.get('pict_type') == 'I':
             times.append(float(frame['best_effort_timestamp_time']))
     return times, frames
 
-def get_segment_by_stamps(frames, begin, end):
-    begin_ = 0
-    end_ = 0
-    for i in range(len(frames)):
-        if begin == float(frames[i]['best_effort_timestamp_time']):
-            begin_ = i
-        if end == float(frames[i]['best_effort_timestamp_time']):
-            end_ = i
-    if begin_ == end_:
-        return frames[begin_:] 
-    return frames[begin_:end_]
-
-def get_segments(input_file):
-    timeline_I,frames = get_vid_stream_stats(input_file)
-    timeline = [0]
-    timeline_test = [0]
-    count = 1
-    segments = []
-    idxs = [0]
+def get_durations(input_file):
+    """
+    Returns the segment durations listed in the m3u8 file.
+    """
     durations = []
     with open(input_file,'r') as m3u8:
         for line in m3u8:
-            if line .startswith('#EXTINF:'):
-                duration = float(line.replace('#EXTINF:','').split(',')[0])
-                durations.append(duration)
-                stamp = timeline[count-1] + duration
-                
-                # get exact I-Frame position
-                idx = (np.abs(np.array(timeline_I) - stamp)).argmin()
-                idxs.append(idx)
+            if line.startswith('#EXTINF:'):
+                durations.append(float(line.replace('#EXTINF:','').split(',')[0]))
+    return durations
 
-                timestamp_I = timeline_I[idx]
-                timeline.append(timeline_I[idx])
+def _last_index_of(order, sorted_stamps, values):
+    # index of the last frame with exactly the given timestamp (0 if there is none)
+    pos = np.searchsorted(sorted_stamps, values, side='right') - 1
+    pos_clipped = np.clip(pos, 0, None)
+    found = (pos >= 0) & (sorted_stamps[pos_clipped] == values)
+    return np.where(found, order[pos_clipped], 0)
 
-                #print(timeline)
-                #print(timeline[count-1],timeline[count])
-                segments.append(get_segment_by_stamps(frames,timeline[count-1],timeline[count]))
+def get_segment_bounds(frames, durations):
+    """
+    Maps the segment durations to frame index ranges.
+
+    Every segment end is snapped to the I-frame closest to the previous segment end
+    plus the segment duration. Returns an (n, 2) array with [begin, end) frame
+    indices per segment. If begin and end snap to the same I-frame, the segment
+    reaches to the last frame.
+    """
+    timestamps = frames['timestamps']
+    timeline_I = np.sort(timestamps[frames['pict_types'] == b'I'])
+    timeline_I = timeline_I[~np.isnan(timeline_I)].tolist()
+    if not timeline_I:
+        raise ValueError('No I-frames found in the stream.')
+
+    timeline = [0]
+    for duration in durations:
+        stamp = timeline[-1] + duration
+        # get exact I-frame position
+        idx = bisect_left(timeline_I, stamp)
+        if idx == len(timeline_I) or (idx > 0 and stamp - timeline_I[idx-1] <= timeline_I[idx] - stamp):
+            idx -= 1
+        timeline.append(timeline_I[idx])
+
+    order = np.argsort(timestamps, kind='stable')
+    idxs = _last_index_of(order, timestamps[order], np.array(timeline, dtype=np.float64))
+
+    begins = idxs[:-1]
+    ends = idxs[1:].copy()
+    ends[begins == ends] = len(timestamps)
+    ends = np.maximum(begins, ends)
+    return np.stack([begins, ends], axis=1)
+
+def segment_frames(frames, bounds):
+    """
+    Returns the frames of every segment as lists of frame dicts (e.g. for segments.json).
+    """
+    timestamps = frames['timestamps'].tolist()
+    pkt_sizes = frames['pkt_sizes'].tolist()
+    pict_types = frames['pict_types'].astype('U1').tolist()
+    segments = []
+    for begin, end in bounds.tolist():
+        segments.append([{
+            'best_effort_timestamp_time': timestamps[i],
+            'pkt_size': pkt_sizes[i],
+            'pict_type': pict_types[i]
+        } for i in range(begin, end)])
+    return segments
 
-                count += 1
-    return segments, durations
+def get_segments(input_file, frames=None):
+    """
+    Returns the probed frames, the segment bounds (see get_segment_bounds) and
+    the segment durations of a m3u8 file. The frames are only probed if they
+    are not given (e.g. from the combined analysis in scripts/analysis.py).
+    """
+    if frames is None:
+        frames = get_vid_stream_frames(input_file)
+    durations = get_durations(input_file)
+    bounds = get_segment_bounds(frames, durations)
+    return frames, bounds, durations
 
 def str2bool(v):
     return v.lower() in ("yes", "true", "t", "1")
@@ -137,9 +296,8 @@ if __name__== "__main__":
         exit()
     input_file=str(sys.argv[1])
     framerate=float(sys.argv[2])
-    segments, durations = get_segments(input_file)
-    stats = calc_stats(segments,framerate, durations)
-    stats_clean = calc_stats(segments[:-1],framerate, durations)
+    frames, bounds, durations = get_segments(input_file)
+    stats, stats_clean = calc_stats_full_clean(frames['pkt_sizes'], bounds, framerate, durations)
     with open('result.json', 'w') as fp:
         json.dump(stats, fp)
     with open('result_clean.json', 'w') as fp:
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+"""
+PSNR and SSIM with numpy, as alternative to the ffmpeg filters for uncompressed
+references (benchmarks/bench_quality.py compares the speed and the values).
+
+The reference (.y4m or .yuv) is memory-mapped (see scripts/y4m.py). The
+distorted video is decoded by one ffmpeg process into the pixel format of the
+reference and read from its stdout in batches of frames, or memory-mapped too if
+it is uncompressed. The metrics of a batch are computed in a few vectorized
+numpy operations over all its frames.
+
+The values follow the psnr and ssim filters of ffmpeg: PSNR from the MSE per
+plane (psnr_avg from the MSE weighted by the plane sizes), SSIM on 8x8 windows
+at a step of 4 pixels (the x264 algorithm), ssim_avg weighted by the plane sizes.
+The csv has the layout of scripts/analysis.py (without VMAF).
+
+  python -m scripts.quality DISTORTED REFERENCE.y4m OUTPUT.csv
+"""
+
+import os, sys
+import time
+import subprocess
+import numpy as np
+from scripts.y4m import Y4MReader, YUVReader, RawVideo, pix_fmt
+from scripts.analysis import PSNR_TAGS, SSIM_TAGS, write_metrics_csv
+
+PLANES = ['y', 'u', 'v']
+
+# the metrics of a batch are computed in chunks of frames, with about this many bytes per
+# integer copy of a chunk (the temporary arrays are a few such copies)
+WORK_BYTES = 16 * 2 ** 20
+
+# the decoded frames of a batch are read into a buffer of at most this many bytes
+BATCH_BYTES = 64 * 2 ** 20
+
+def open_video(path, width=None, height=None, pix_fmt='yuv420p'):
+    """
+    Opens an uncompressed video memory-mapped (.yuv needs the size).
+    """
+    if path.endswith('.yuv'):
+        if not width or not height:
+            raise ValueError('The size of {path} is needed (width and height)'.format(path=path))
+        return YUVReader(path, width, height, pix_fmt=pix_fmt)
+    return Y4MReader(path)
+
+def _chunked(func, ref, dist, *args):
+    # applies func to chunks of frames of the planes, so that the integer copies stay small
+    step = max(1, WORK_BYTES // (ref[0].size * 8))
+    if len(ref) <= step:
+        return func(ref, dist, *args)
+    return np.concatenate([func(ref[i:i + step], dist[i:i + step], *args) for i in range(0, len(ref), step)])
+
+def _plane_mse(ref, dist):
+    diff = ref.astype(np.int32)
+    diff -= dist
+    diff *= diff
+    return diff.reshape(len(diff), -1).sum(axis=1, dtype=np.int64) / float(diff[0].size)
+
+def plane_mse(ref, dist):
+    """
+    Mean squared error of every frame of a batch of planes (count, height, width).
+    """
+    return _chunked(_plane_mse, ref, dist)
+
+def psnr(mse, peak=255):
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(peak * peak / mse)
+
+def _block_sums(plane, dtype):
+    # sums over the 4x4 blocks of a batch (count, height/4, width/4)
+    n, h, w = plane.shape
+    return plane[:, :h // 4 * 4, :w // 4 * 4].reshape(n, h // 4, 4, w // 4, 4).sum(axis=(2, 4), dtype=dtype)
+
+def _windows(blocks):
+    # sums over the 8x8 windows (2x2 blocks) at a step of 4 pixels
+    return blocks[:, :-1, :-1] + blocks[:, 1:, :-1] + blocks[:, :-1, 1:] + blocks[:, 1:, 1:]
+
+def _plane_ssim(ref, dist, peak):
+    # the window sums of up to 10 bit samples fit into 32 bit
+    dtype = np.int32 if peak < 1 << 10 else np.int64
+    a = ref.astype(dtype)
+    b = dist.astype(dtype)
+    s1 = _windows(_block_sums(a, dtype))
+    s2 = _windows(_block_sums(b, dtype))
+    s12 = _windows(_block_sums(a * b, dtype))
+    a *= a
+    b *= b
+    a += b
+    del b
+    ss = _windows(_block_sums(a, dtype))
+    del a
+    c1 = .01 * .01 * peak * peak * 64
+    c2 = .03 * .03 * peak * peak * 64 * 63
+    if peak == 255:
+        # integer constants of the 8 bit version
+        c1, c2 = float(int(c1 + .5)), float(int(c2 + .5))
+    s1 = s1.astype(np.float64)
+    s2 = s2.astype(np.float64)
+    var = ss * 64. - s1 * s1 - s2 * s2
+    covar = s12 * 64. - s1 * s2
+    ssim = (2 * s1 * s2 + c1) * (2 * covar + c2) / ((s1 * s1 + s2 * s2 + c1) * (var + c2))
+    return ssim.reshape(len(ssim), -1).mean(axis=1)
+
+def plane_ssim(ref, dist, peak=255):
+    """
+    SSIM of every frame of a batch of planes, as ffmpeg's ssim filter computes it.
+    """
+    return _chunked(_plane_ssim, ref, dist, peak)
+
+def batch_metrics(ref_planes, dist_planes, peak=255, metrics=('psnr', 'ssim')):
+    """
+    Returns the metrics (csv column -> array over the frames) of a batch. The planes
+    are lists of (count, height, width) arrays.
+    """
+    sizes = np.array([p[0].size for p in ref_planes], dtype=np.float64)
+    weights = sizes / sizes.sum()
+    values = {}
+    if 'psnr' in metrics:
+        mse = [plane_mse(r, d) for r, d in zip(ref_planes, dist_planes)]
+        mse_avg = sum(m * w for m, w in zip(mse, weights))
+        values['mse_avg'] = mse_avg
+        values['psnr_avg'] = psnr(mse_avg, peak)
+        for name, m in zip(PLANES, mse):
+            values['mse_' + name] = m
+            values['psnr_' + name] = psnr(m, peak)
+    if 'ssim' in metrics:
+        ssim = [plane_ssim(r, d, peak) for r, d in zip(ref_planes, dist_planes)]
+        values['ssim_avg'] = sum(s * w for s, w in zip(ssim, weights))
+        for name, s in zip(PLANES, ssim):
+            values['ssim_' + name] = s
+    return values
+
+def decode_batches(distorted, reference, batch=16):
+    """
+    Decodes distorted with ffmpeg into the pixel format and size of the reference and
+    yields the planes of batch frames at a time. The frames are read from the pipe into
+    one buffer, which is reused for every batch.
+    """
+    cmd = ['ffmpeg', '-v', 'error', '-nostdin', '-i', distorted, '-map', '0:v:0', '-f', 'rawvideo',
+        '-pix_fmt', pix_fmt(reference), '-s', '{w}x{h}'.format(w=reference.width, h=reference.height), '-']
+    print('Exec: ', ' '.join(cmd))
+    buf = np.empty((batch, reference.frame_size), dtype=np.uint8)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=0)
+    try:
+        while True:
+            view = memoryview(buf).cast('B')
+            got = 0
+            while got < len(view):
+                n = proc.stdout.readinto(view[got:])
+                if not n:
+                    break
+                got += n
+            count = got // reference.frame_size
+            if count:
+                yield reference.split(buf[:count])
+            if got < len(view):
+                break
+    finally:
+        proc.stdout.close()
+        if proc.wait() != 0:
+            sys.exit('Failed to decode {distorted}'.format(distorted=distorted))
+
+def compute_quality(distorted, reference, csv_path=None, metrics=('psnr', 'ssim'), batch=16):
+    """
+    Computes PSNR and SSIM of distorted against the uncompressed reference.
+
+    @param distorted: Any video ffmpeg decodes, or a RawVideo (memory-mapped, nothing decoded)
+    @param reference: Path of the .y4m reference or a RawVideo
+    @param csv_path: Write the metrics per frame to this csv (layout of scripts/analysis.py)
+    @param batch: Frames per batch (fewer if the batch would exceed BATCH_BYTES)
+    @return: dict csv column -> array over the frames, and the processing time
+    """
+    ref = reference if isinstance(reference, RawVideo) else open_video(reference)
+    batch = max(1, min(batch, BATCH_BYTES // ref.frame_size))
+    start = time.time()
+    if isinstance(distorted, RawVideo):
+        batches = distorted.batches(batch)
+    else:
+        batches = decode_batches(distorted, ref, batch=batch)
+
+    parts = {}
+    pos = 0
+    for dist_planes in batches:
+        count = len(dist_planes[0])
+        ref_planes = ref.planes(pos, count)
+        count = min(count, len(ref_planes[0]))
+        if count == 0:
+            break
+        values = batch_metrics([p[:count] for p in ref_planes], [p[:count] for p in dist_planes], \
+            peak=ref.peak, metrics=metrics)
+        for k, v in values.items():
+            parts.setdefault(k, []).append(v)
+        pos += count
+    values = {k: np.concatenate(v) for k, v in parts.items()}
+    elapsed = time.time() - start
+
+    if csv_path:
+        tags = []
+        if 'psnr' in metrics:
+            tags += [(c, c) for _, c in PSNR_TAGS]
+        if 'ssim' in metrics:
+            tags += [(c, c) for _, c in SSIM_TAGS]
+        rows = [[repr(float(values[c][i])) for _, c in tags] for i in range(pos)]
+        write_metrics_csv(csv_path, rows, [], str(distorted if not isinstance(distorted, RawVideo) \
+            else distorted.path), ref.path, tags=tags)
+
+    return values, elapsed
+
+if __name__== "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='PSNR and SSIM against an uncompressed reference with numpy.')
+    parser.add_argument('distorted', help='Distorted video (decoded with ffmpeg unless .y4m/.yuv).')
+    parser.add_argument('reference', help='Reference video (.y4m, or .yuv with --size).')
+    parser.add_argument('csv', help='Output csv.')
+    parser.add_argument('--size', help='Size of .yuv files, e.g. 1920x1080.', default=None)
+    parser.add_argument('--pix-fmt', help='Pixel format of .yuv files.', default='yuv420p')
+    parser.add_argument('-b', '--batch', help='Frames per batch.', type=int, default=16)
+    args = parser.parse_args()
+
+    width, height = [int(x) for x in args.size.split('x')] if args.size else (None, None)
+    reference = open_video(args.reference, width, height, args.pix_fmt)
+    distorted = args.distorted
+    if os.path.splitext(distorted)[1] in ['.y4m', '.yuv']:
+        distorted = open_video(distorted, width, height, args.pix_fmt)
+    values, elapsed = compute_quality(distorted, reference, args.csv, batch=args.batch)
+    count = len(values['psnr_avg'])
+    print('{n} frames in {t:.2f}s ({fps:.1f} fps), PSNR {psnr:.3f} dB, SSIM {ssim:.5f}'.format(n=count, t=elapsed, \
+        fps=count / elapsed if elapsed else 0, psnr=np.mean(values['psnr_avg']), ssim=np.mean(values['ssim_avg'])))
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""
+Compact binary storage for the per-frame and per-segment statistics.
+
+The arrays are written as an uncompressed .npz file. Since the members of the
+archive are stored as plain .npy files, they can be memory-mapped directly
+from the archive without reading or copying them.
+"""
+
+import os, sys, json
+import struct
+import zipfile
+import numpy as np
+
+# Size of the fixed part of a zip local file header
+ZIP_LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+
+def save_arrays(path, arrays):
+    """
+    Writes the dict of arrays to path (uncompressed .npz).
+    """
+    with open(path, 'wb') as fp:
+        np.savez(fp, **arrays)
+
+def _member_offset(fp, info):
+    fp.seek(info.header_offset)
+    header = ZIP_LOCAL_HEADER.unpack(fp.read(ZIP_LOCAL_HEADER.size))
+    name_len, extra_len = header[9], header[10]
+    return info.header_offset + ZIP_LOCAL_HEADER.size + name_len + extra_len
+
+def load_arrays(path):
+    """
+    Returns a dict with read-only memory maps of the arrays in an .npz file
+    written by save_arrays.
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as npz, open(path, 'rb') as fp:
+        for info in npz.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('{name} in {path} is compressed and cannot be mapped.'.format(\
+                    name=info.filename, path=path))
+            fp.seek(_member_offset(fp, info))
+            version = np.lib.format.read_magic(fp)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+            name = os.path.splitext(info.filename)[0]
+            if int(np.prod(shape)) == 0:
+                arrays[name] = np.empty(shape, dtype=dtype)
+                continue
+            arrays[name] = np.memmap(path, dtype=dtype, mode='r', offset=fp.tell(),
+                shape=shape, order='F' if fortran_order else 'C')
+    return arrays
+
+def load_stats(json_path):
+    """
+    Loads a statistics json file. If it points to an arrays file
+    (compact output), the arrays are mapped as well.
+
+    @return: (stats, arrays) where arrays is None for plain json statistics.
+    """
+    with open(json_path) as fp:
+        stats = json.load(fp)
+    if 'arrays' not in stats:
+        return stats, None
+    arrays = load_arrays(os.path.join(os.path.dirname(json_path), stats['arrays']))
+    return stats, arrays
+
+def segment_bitrates(arrays, segment_count=None):
+    """
+    Returns the per-frame bitrates of every segment as views of the mapped
+    bitrates array (the compact equivalent of 'bitrates_segs').
+    """
+    offsets = arrays['seg_offsets']
+    if segment_count is None:
+        segment_count = len(offsets)
+    ends = np.append(offsets[1:], len(arrays['bitrates']))
+    return [arrays['bitrates'][offsets[i]:ends[i]] for i in range(segment_count)]
+
+if __name__== "__main__":
+    if len(sys.argv) < 2:
+        print('Usage: python statsfile.py [statistics json]')
+        exit()
+    stats, arrays = load_stats(sys.argv[1])
+    print(json.dumps(stats, indent=4))
+    for name, values in (arrays or {}).items():
+        print('{name}: {dtype} {shape}'.format(name=name, dtype=values.dtype, shape=values.shape))
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+"""
+Metadata cache of the source videos.
+
+The cache is a sidecar folder (.vidcache/) in the video folder with two files:
+cache.json with the ffprobe results of the videos for the containers (duration,
+bitrate, fps, resolution and the frame count/keyframe index) and listing.json
+with the listing of the folder for the workers. The listing is read on every
+check of the video folder, so it is kept apart from the (large) indices.
+An entry of a video is keyed by its size and mtime (and optionally a hash of its
+first and last MiB), so it is invalidated when the file changes. The listing is
+keyed by the mtime of the folder (the cache has its own subfolder, so writing it
+does not change the mtime of the video folder).
+
+The file is replaced atomically; concurrent writers merge their entries into the
+current file, a lost update only means a second probe. A read-only video folder
+just disables the cache.
+
+  python -m scripts.vidcache VIDDIR     fills the cache for all videos of a folder
+                                        (run from the repository root, /tools in the container)
+"""
+
+import os, sys, json
+import hashlib
+import math
+
+CACHE_DIR = '.vidcache'
+CACHE_FILE = 'cache.json'
+LISTING_FILE = 'listing.json'
+VERSION = 1
+
+# bytes hashed at the start and the end of a video
+HASH_BYTES = 2 ** 20
+
+def cache_path(viddir):
+    return os.path.join(viddir, CACHE_DIR, CACHE_FILE)
+
+def _load(path):
+    try:
+        with open(path) as fp:
+            data = json.load(fp)
+    except (OSError, ValueError):
+        return None
+    if data.get('version') != VERSION:
+        return None
+    return data
+
+def _save(path, data):
+    # replaces the file atomically, returns False if it could not be written
+    tmp = '{path}.{pid}.tmp'.format(path=path, pid=os.getpid())
+    try:
+        os.makedirs(os.path.dirname(tmp), exist_ok=True)
+        with open(tmp, 'w') as fp:
+            json.dump(data, fp)
+        os.replace(tmp, path)
+    except OSError as e:
+        print('Could not write the video cache {path}: {e}'.format(path=path, e=e))
+        return False
+    return True
+
+def load_cache(viddir):
+    return _load(cache_path(viddir)) or {'version': VERSION, 'videos': {}}
+
+def save_cache(viddir, update):
+    """
+    Merges update (the changed keys, 'videos' entries are merged by name) into the
+    cache file.
+
+    @return: False if the cache could not be written
+    """
+    cache = load_cache(viddir)
+    for k, v in update.items():
+        if k == 'videos':
+            cache['videos'].update(v)
+        else:
+            cache[k] = v
+    return _save(cache_path(viddir), cache)
+
+def content_hash(path):
+    # sha1 of the size, the first and the last HASH_BYTES
+    h = hashlib.sha1()
+    size = os.path.getsize(path)
+    h.update(str(size).encode('ascii'))
+    with open(path, 'rb') as fp:
+        h.update(fp.read(HASH_BYTES))
+        if size > HASH_BYTES:
+            fp.seek(max(HASH_BYTES, size - HASH_BYTES))
+            h.update(fp.read(HASH_BYTES))
+    return h.hexdigest()
+
+def _key(path, verify_hash=False):
+    st = os.stat(path)
+    key = {'size': st.st_size, 'mtime': st.st_mtime_ns}
+    if verify_hash:
+        key['hash'] = content_hash(path)
+    return key
+
+def _matches(entry, key):
+    return all(entry.get(k) == v for k, v in key.items())
+
+def cached(path, field, probe, verify_hash=False):
+    """
+    Returns the cached field (e.g. 'stats') of the video, calls probe(path) and stores
+    the result if it is not cached or the video changed.
+    """
+    viddir, name = os.path.split(os.path.abspath(path))
+    key = _key(path, verify_hash=verify_hash)
+    entry = load_cache(viddir)['videos'].get(name, {})
+    if _matches(entry, key) and field in entry:
+        return entry[field]
+    if not _matches(entry, key):
+        entry = {}
+    entry.update(key)
+    entry[field] = probe(path)
+    save_cache(viddir, {'videos': {name: entry}})
+    return entry[field]
+
+def probe_index(path):
+    """
+    Frame count and keyframe times of a video (by demuxing, nothing is decoded).
+    """
+    # numpy is only needed in the container, the worker imports this module for list_videos
+    from scripts.getStats import iter_ffprobe_compact, parse_float
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags',
+        '-print_format', 'compact=print_section=0', path]
+    pts = []
+    keyframes = []
+    for packet in iter_ffprobe_compact(command):
+        t = parse_float(packet.get('pts_time', 'N/A'))
+        pts.append(t)
+        if 'K' in packet.get('flags', ''):
+            keyframes.append(t)
+    return {'frame_count': len(pts), 'keyframes': sorted(keyframes),
+        'start_time': min((t for t in pts if not math.isnan(t)), default=0.0)}
+
+def video_index(path, verify_hash=False):
+    return cached(path, 'index', probe_index, verify_hash=verify_hash)
+
+def list_videos(viddir):
+    """
+    Returns the file names in the video folder, from the cached listing if the folder
+    did not change since it was listed.
+    """
+    path = os.path.join(viddir, CACHE_DIR, LISTING_FILE)
+    listing = _load(path)
+    mtime = os.stat(viddir).st_mtime_ns
+    if listing is not None and listing.get('dir_mtime') == mtime:
+        return listing['files']
+    files = sorted(f for f in os.listdir(viddir) if not f.startswith('.'))
+    if not os.path.isdir(os.path.join(viddir, CACHE_DIR)):
+        # creating the cache folder changes the mtime once
+        try:
+            os.makedirs(os.path.join(viddir, CACHE_DIR), exist_ok=True)
+        except OSError:
+            return files
+        mtime = os.stat(viddir).st_mtime_ns
+    _save(path, {'version': VERSION, 'files': files, 'dir_mtime': mtime})
+    return files
+
+if __name__== "__main__":
+    # video_encode.py is in the repository root (/tools in the container)
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from video_encode import probe_vid_stats
+    if len(sys.argv) < 2:
+        print('Usage: python -m scripts.vidcache [video folder]')
+        exit()
+    viddir = sys.argv[1]
+    for name in list_videos(viddir):
+        path = os.path.join(viddir, name)
+        stats = cached(path, 'stats', probe_vid_stats)
+        index = video_index(path)
+        print('{name}: {stats}, {frames} frames, {keyframes} keyframes'.format(name=name, stats=stats, \
+            frames=index['frame_count'], keyframes=len(index['keyframes'])))
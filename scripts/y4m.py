@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""
+Memory-mapped reader of uncompressed videos (.y4m and raw .yuv).
+
+The file is mapped once; frames and batches of frames are numpy views into the
+mapping, so a frame is only read from the disk (or the page cache) when its
+pixels are used and never copied.
+
+  video = Y4MReader('/videos/src.y4m')
+  for y, u, v in video:
+      ...
+  y, u, v = video.planes(0, 16)       # planes of 16 frames, shape (16, height, width)
+"""
+
+import os, sys, re
+import numpy as np
+
+# chroma subsampling (horizontal, vertical) of the y4m colorspaces
+CHROMA = {
+    '420': (2, 2), '420jpeg': (2, 2), '420mpeg2': (2, 2), '420paldv': (2, 2),
+    '422': (2, 1), '444': (1, 1), 'mono': None
+}
+
+# raw pixel formats (ffmpeg names) -> (y4m colorspace, bit depth)
+PIX_FMTS = {
+    'yuv420p': ('420', 8), 'yuv422p': ('422', 8), 'yuv444p': ('444', 8), 'gray': ('mono', 8),
+    'yuv420p10le': ('420', 10), 'yuv422p10le': ('422', 10), 'yuv444p10le': ('444', 10),
+}
+
+FRAME_MAGIC = b'FRAME'
+
+class RawVideo(object):
+
+    def __init__(self, path, width, height, colorspace='420', depth=8, offset=0, frame_header=0, fps=None):
+        """
+        Uncompressed planar video in a file: frame i starts at offset + i * (frame_header + frame size).
+
+        @param colorspace: Chroma subsampling ('420', '422', '444' or 'mono')
+        @param depth: Bits per sample (8, or up to 16 with two bytes per sample)
+        @param offset: Bytes before the first frame (the y4m stream header)
+        @param frame_header: Bytes before every frame (the y4m FRAME line)
+        """
+        if colorspace not in CHROMA:
+            raise ValueError('Unsupported colorspace {c}'.format(c=colorspace))
+        self.path = path
+        self.width = width
+        self.height = height
+        self.colorspace = colorspace
+        self.depth = depth
+        self.fps = fps
+        self.dtype = np.dtype(np.uint8) if depth <= 8 else np.dtype('<u2')
+        self.peak = (1 << depth) - 1
+
+        sub = CHROMA[colorspace]
+        self.plane_shapes = [(height, width)]
+        if sub is not None:
+            chroma = (-(-height // sub[1]), -(-width // sub[0]))
+            self.plane_shapes += [chroma, chroma]
+        self.plane_sizes = [h * w * self.dtype.itemsize for h, w in self.plane_shapes]
+        self.frame_size = sum(self.plane_sizes)
+        self.stride = frame_header + self.frame_size
+        self.offset = offset + frame_header
+
+        size = os.path.getsize(path)
+        self.frame_count = max(0, (size - offset) // self.stride)
+        self._mm = np.memmap(path, dtype=np.uint8, mode='r') if self.frame_count else None
+
+    def __len__(self):
+        return self.frame_count
+
+    def frames(self, start=0, count=None):
+        """
+        Returns the raw bytes of the frames [start, start + count) as view of shape (count, frame size).
+        """
+        if count is None:
+            count = self.frame_count - start
+        count = max(0, min(count, self.frame_count - start))
+        return np.lib.stride_tricks.as_strided(self._mm[self.offset + start * self.stride:], \
+            shape=(count, self.frame_size), strides=(self.stride, 1), writeable=False)
+
+    def split(self, frames):
+        """
+        Returns the planes (Y, U, V) of a (count, frame size) array, shape (count, height, width) each.
+        """
+        planes = []
+        start = 0
+        for (h, w), size in zip(self.plane_shapes, self.plane_sizes):
+            plane = frames[:, start:start + size]
+            if self.dtype.itemsize > 1:
+                plane = plane.view(self.dtype)
+            planes.append(plane.reshape(len(frames), h, w))
+            start += size
+        return planes
+
+    def planes(self, start=0, count=None):
+        return self.split(self.frames(start, count))
+
+    def frame(self, idx):
+        return [p[0] for p in self.planes(idx, 1)]
+
+    def batches(self, batch=16, start=0):
+        # planes of batch frames at a time
+        for first in range(start, self.frame_count, batch):
+            yield self.planes(first, batch)
+
+    def __iter__(self):
+        for planes in self.batches():
+            for i in range(len(planes[0])):
+                yield [p[i] for p in planes]
+
+    def close(self):
+        if self._mm is not None:
+            self._mm._mmap.close()
+            self._mm = None
+
+def _parse_header(line):
+    params = {}
+    for token in line.split()[1:]:
+        params[token[0]] = token[1:]
+    return params
+
+def Y4MReader(path):
+    """
+    Opens a .y4m file. The FRAME lines must not carry parameters (as written by ffmpeg),
+    so that all frames have the same stride.
+    """
+    with open(path, 'rb') as fp:
+        head = fp.read(4096)
+    end = head.find(b'\n')
+    if not head.startswith(b'YUV4MPEG2') or end < 0:
+        raise ValueError('{path} is not a y4m file'.format(path=path))
+    params = _parse_header(head[:end].decode('ascii'))
+    colorspace = params.get('C', '420jpeg')
+    depth = 8
+    # high bit depth: e.g. 420p10, mono16
+    deep = re.match(r'^(\d+)p(\d+)$', colorspace) or re.match(r'^(mono)(\d+)$', colorspace)
+    if deep:
+        colorspace, depth = deep.group(1), int(deep.group(2))
+    frame_line = head[end + 1:].split(b'\n', 1)[0] + b'\n'
+    if not frame_line.startswith(FRAME_MAGIC):
+        if len(head) > end + 1:
+            raise ValueError('{path}: no FRAME after the header'.format(path=path))
+        frame_line = FRAME_MAGIC + b'\n'
+    fps = None
+    if 'F' in params:
+        num, _, den = params['F'].partition(':')
+        fps = float(num) / float(den or 1)
+    video = RawVideo(path, int(params['W']), int(params['H']), colorspace=colorspace, depth=depth, \
+        offset=end + 1, frame_header=len(frame_line), fps=fps)
+    if len(frame_line) != len(FRAME_MAGIC) + 1 and video.frame_count > 1:
+        # check that the frame parameters do not change the length of the FRAME lines
+        last = video._mm[video.offset - len(frame_line) + (video.frame_count - 1) * video.stride:][:len(frame_line)]
+        if bytes(last) != frame_line:
+            raise ValueError('{path}: FRAME lines of different length are not supported'.format(path=path))
+    return video
+
+def YUVReader(path, width, height, pix_fmt='yuv420p', fps=None):
+    """
+    Opens a raw .yuv file (no header, the size and pixel format are not stored in the file).
+    """
+    if pix_fmt not in PIX_FMTS:
+        raise ValueError('Unsupported pixel format {pix_fmt}'.format(pix_fmt=pix_fmt))
+    colorspace, depth = PIX_FMTS[pix_fmt]
+    return RawVideo(path, width, height, colorspace=colorspace, depth=depth, fps=fps)
+
+def pix_fmt(video):
+    """
+    Returns the ffmpeg pixel format of the video (to decode another video into the same layout).
+    """
+    for name, (colorspace, depth) in PIX_FMTS.items():
+        if CHROMA[colorspace] == CHROMA[video.colorspace] and depth == video.depth:
+            return name
+    raise ValueError('No pixel format for {c} with {d} bits'.format(c=video.colorspace, d=video.depth))
+
+def write_y4m(path, frames, fps=25, colorspace='420jpeg'):
+    """
+    Writes frames given as (Y, U, V) 8-bit arrays (any iterable, e.g. a generator) into a .y4m file.
+    """
+    with open(path, 'wb') as fp:
+        for i, frame in enumerate(frames):
+            if i == 0:
+                height, width = frame[0].shape
+                fp.write('YUV4MPEG2 W{w} H{h} F{fps}:1 Ip A1:1 C{c}\n'.format(w=width, h=height, fps=fps, \
+                    c=colorspace).encode('ascii'))
+            fp.write(FRAME_MAGIC + b'\n')
+            for plane in frame:
+                fp.write(np.ascontiguousarray(plane, dtype=np.uint8).tobytes())
+
+if __name__== "__main__":
+    if len(sys.argv) < 2:
+        print('Usage: python -m scripts.y4m [video.y4m]')
+        exit()
+    video = Y4MReader(sys.argv[1])
+    print('{w}x{h} {c} {d} bit, {fps} fps, {n} frames'.format(w=video.width, h=video.height, \
+        c=video.colorspace, d=video.depth, fps=video.fps, n=len(video)))
@@ -0,0 +1,402 @@
+import os
+import re
+import json
+import random
+import time
+import logging
+import sqlite3
+from collections import Counter
+from os.path import join as pjoin
+
+from dirjobs import job_source, OrderedPolicy
+
+log = logging.getLogger(__name__)
+
+WAITING = "waiting"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Status -> folder of the DirJobs layout
+STATUS_DIRS = [(WAITING, "00_waiting"), (RUNNING, "01_running"), (DONE, "02_done"), (FAILED, "99_failed")]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    name TEXT PRIMARY KEY,
+    source TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'waiting',
+    priority INTEGER NOT NULL DEFAULT 0,
+    rnd REAL NOT NULL,
+    content TEXT NOT NULL,
+    worker TEXT,
+    claimed REAL,
+    finished REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (status, priority DESC, rnd);
+CREATE INDEX IF NOT EXISTS jobs_source ON jobs (status, source, priority, rnd);
+"""
+
+
+class SqliteJob(object):
+
+    def __init__(self, sj, job, content):
+        self._sj = sj
+        self._job = job
+        self._content = content
+
+    def done(self):
+        return self._sj.on_job_success(self)
+
+    def failed(self):
+        return self._sj.on_job_failed(self)
+
+    def release(self):
+        return self._sj.on_job_released(self)
+
+    def __str__(self):
+        return "Job(%s)" % self.path()
+
+    def path(self):
+        """
+        Returns a pseudo path of the job (there is no job file).
+        """
+        return "%s#%s" % (self._sj._db, self._job)
+
+    def name(self):
+        return self._job
+
+    def name_woext(self):
+        return os.path.splitext(self._job)[0]
+
+    def full_name(self):
+        return "%s.%s" % (self._sj._wid, self._job)
+
+    def load(self):
+        """
+        Returns the job dict.
+        """
+        return json.loads(self._content)
+
+
+class SqliteJobs(object):
+
+    def __init__(self, db, wid="w1", rnd_job=True, job_filter=None, policy=None, max_active=1, timeout=60):
+        """
+        Job queue in a SQLite database with the interface of DirJobs. A job is claimed in
+        one transaction, so no waiting for other workers is needed. The database has to be
+        on a local filesystem (SQLite locking is not reliable on network mounts); workers
+        on other hosts need the job folder (DirJobs).
+
+        @param db: Path of the database (created if missing)
+        @param wid: Worker ID
+        @param rnd_job: Random order within the same priority (otherwise by name)
+        @param job_filter: A function f(path, name) -> boolean to filter jobs. If it has a videos()
+                           method (like worker.VideoIndex), the filter is done in the query.
+        @param policy: Job selection policy (see dirjobs), used within the highest priority
+        @param max_active: Number of jobs the worker may process at the same time.
+        @param timeout: Seconds to wait for the lock of the database
+        """
+
+        self._db = db
+        self._wid = wid
+        self._rnd_job = rnd_job
+        self._job_filter = job_filter
+        self._policy = policy
+        self._max_active = max_active
+        self._active = set()
+        self._counters = Counter()
+
+        if not re.match('^[a-zA-Z0-9]+$', self._wid):
+            raise Exception("Worker ID is only allowed to contain numbers and letters.")
+
+        self._con = sqlite3.connect(db, timeout=timeout, isolation_level=None)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        # Safe with WAL, only the last transactions may be lost on a power failure
+        self._con.execute("PRAGMA synchronous=NORMAL")
+        self._con.executescript(SCHEMA)
+
+    def stats(self):
+        return self._policy.stats() if self._policy else {}
+
+    def counters(self):
+        """
+        Returns the queue counters (claims and the time spent claiming, like DirJobs).
+        """
+        return dict(self._counters)
+
+    def counts(self):
+        """
+        Returns the number of jobs per status.
+        """
+        return dict(self._con.execute("SELECT status, count(*) FROM jobs GROUP BY status"))
+
+    def waiting(self):
+        """
+        Returns the number of waiting jobs.
+        """
+        return self._con.execute("SELECT count(*) FROM jobs WHERE status = ?", (WAITING,)).fetchone()[0]
+
+    def add(self, name, job, priority=None, status=WAITING):
+        """
+        Adds a job. The priority is taken from the job dict (key "priority", default 0)
+        if not given. Existing jobs are not changed.
+
+        @return: True if the job was added.
+        """
+
+        if priority is None:
+            priority = int(job.get("priority", 0))
+
+        # rnd: random order of the jobs, fixed at insert so the claim query can use the index
+        cur = self._con.execute("INSERT OR IGNORE INTO jobs (name, source, status, priority, rnd, content) "
+                                "VALUES (?, ?, ?, ?, ?, ?)",
+                                (name, job_source(name), status, priority, random.random(), json.dumps(job)))
+
+        return cur.rowcount == 1
+
+    def _candidates(self, cur):
+        """
+        Returns the waiting jobs of the highest priority that pass the filter.
+        """
+
+        query = "SELECT name, priority FROM jobs WHERE status = ?"
+        params = [WAITING]
+
+        videos = None
+        if self._job_filter is not None and hasattr(self._job_filter, "videos"):
+            videos = sorted(self._job_filter.videos())
+            query += " AND source IN (%s)" % ",".join("?" * len(videos))
+            params += videos
+
+        order = "rnd" if self._rnd_job and not isinstance(self._policy, OrderedPolicy) else "name"
+
+        if self._job_filter is None or videos is not None:
+            # The database does the whole selection, the write lock is held only for a few index lookups
+            row = cur.execute(query + " ORDER BY priority DESC, %s LIMIT 1" % order, params).fetchone()
+            if row is None:
+                return []
+
+            if hasattr(self._policy, "preferred_sources"):
+                # Preferred sources first (within the highest priority), one lookup per source
+                for source in self._policy.preferred_sources():
+                    if videos is not None and source not in videos:
+                        continue
+                    pref = cur.execute("SELECT name FROM jobs WHERE status = ? AND source = ? AND priority = ? "
+                                       "ORDER BY %s LIMIT 1" % order, (WAITING, source, row[1])).fetchone()
+                    if pref:
+                        return [pref[0]]
+
+            return [row[0]]
+
+        jobs = []
+        top = None
+
+        for name, priority in cur.execute(query + " ORDER BY priority DESC, %s" % order, params):
+
+            if top is not None and priority < top:
+                break
+
+            if videos is None and self._job_filter is not None and not self._job_filter(None, name):
+                continue
+
+            top = priority
+            jobs.append(name)
+
+        return jobs
+
+    def next_and_lock(self, no_wait=False):
+        """
+        Claims the next job in one transaction.
+        """
+
+        if len(self._active) >= self._max_active:
+            log.error("There are already %d active jobs! Please call done() or failed() on a job first." %
+                      len(self._active))
+            return None
+
+        t = time.perf_counter()
+        cur = self._con.cursor()
+
+        # Takes the write lock right away, so two workers never select the same job
+        cur.execute("BEGIN IMMEDIATE")
+
+        try:
+            jobs = self._candidates(cur)
+
+            if not jobs:
+                cur.execute("COMMIT")
+                self._counters['claim_s'] += time.perf_counter() - t
+                self._counters['empty_claims'] += 1
+                return None
+
+            job = self._policy.first(jobs) if self._policy and len(jobs) > 1 else jobs[0]
+
+            cur.execute("UPDATE jobs SET status = ?, worker = ?, claimed = ? WHERE name = ?",
+                        (RUNNING, self._wid, time.time(), job))
+            content = cur.execute("SELECT content FROM jobs WHERE name = ?", (job,)).fetchone()[0]
+
+            cur.execute("COMMIT")
+        except:
+            cur.execute("ROLLBACK")
+            raise
+
+        log.debug("Selected job: %s" % job)
+
+        self._counters['claim_s'] += time.perf_counter() - t
+        self._counters['claims'] += 1
+
+        self._active.add(job)
+
+        if self._policy:
+            self._policy.started(job)
+
+        return SqliteJob(self, job, content)
+
+    def _finish(self, job, status):
+
+        self._con.execute("UPDATE jobs SET status = ?, finished = ? WHERE name = ? AND worker = ?",
+                          (status, time.time(), job.name(), self._wid))
+
+        self._active.discard(job.name())
+
+        if self._policy:
+            self._policy.finished(job.name())
+
+    def on_job_failed(self, job):
+        log.debug("Job failed: %s" % job)
+        self._finish(job, FAILED)
+
+    def on_job_success(self, job):
+        log.debug("Job finished: %s" % job)
+        self._finish(job, DONE)
+
+    def on_job_released(self, job):
+        log.debug("Job released: %s" % job)
+
+        self._con.execute("UPDATE jobs SET status = ?, worker = NULL, claimed = NULL WHERE name = ? AND worker = ?",
+                          (WAITING, job.name(), self._wid))
+
+        self._active.discard(job.name())
+
+        if self._policy:
+            self._policy.finished(job.name())
+
+    def release(self):
+        # Jobs are claimed one by one, nothing is reserved
+        pass
+
+    def renew_reservations(self):
+        pass
+
+    def invalidate(self):
+        pass
+
+    def requeue(self, wid=None):
+        """
+        Puts running jobs (of a worker that died) back to waiting.
+
+        @return: Number of jobs put back
+        """
+
+        query = "UPDATE jobs SET status = ?, worker = NULL, claimed = NULL WHERE status = ?"
+        params = [WAITING, RUNNING]
+
+        if wid is not None:
+            query += " AND worker = ?"
+            params.append(wid)
+
+        return self._con.execute(query, params).rowcount
+
+    def import_dir(self, jobsdir, job_ext=".txt"):
+        """
+        Imports the jobs of a DirJobs folder (00_waiting/, 01_running/, 02_done/, 99_failed/).
+        Running jobs are imported as waiting. The folder itself is not changed.
+
+        @return: Number of imported jobs
+        """
+
+        count = 0
+
+        self._con.execute("BEGIN")
+
+        try:
+            for status, folder in STATUS_DIRS:
+
+                path = pjoin(jobsdir, folder)
+
+                if not os.path.isdir(path):
+                    continue
+
+                for f in sorted(os.listdir(path)):
+
+                    if not f.endswith(job_ext):
+                        continue
+
+                    with open(pjoin(path, f)) as fp:
+                        job = json.load(fp)
+
+                    if status == RUNNING:
+                        # <wid>.<name>
+                        f = f.split(".", 1)[1]
+
+                    count += self.add(f, job, status=WAITING if status == RUNNING else status)
+
+            self._con.execute("COMMIT")
+        except:
+            self._con.execute("ROLLBACK")
+            raise
+
+        return count
+
+    def export_dir(self, jobsdir):
+        """
+        Writes the jobs into the DirJobs folder layout (running jobs as <wid>.<name>).
+
+        @return: Number of exported jobs
+        """
+
+        for _, folder in STATUS_DIRS:
+            os.makedirs(pjoin(jobsdir, folder), exist_ok=True)
+
+        folders = dict(STATUS_DIRS)
+        count = 0
+
+        for name, status, worker, content in self._con.execute("SELECT name, status, worker, content FROM jobs"):
+
+            if status == RUNNING:
+                name = "%s.%s" % (worker, name)
+
+            with open(pjoin(jobsdir, folders[status], name), "w") as f:
+                f.write(content)
+
+            count += 1
+
+        return count
+
+
+if __name__ == "__main__":
+
+    logconf = {'format': '[%(asctime)s.%(msecs)-3d: %(name)-16s - %(levelname)-5s] %(message)s', 'datefmt': "%H:%M:%S"}
+    logging.basicConfig(level=logging.INFO, **logconf)
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Manage a SQLite job queue.")
+    parser.add_argument('db', help="Job database.")
+    parser.add_argument('command', help="import: add the jobs of a job folder, export: write the jobs into a job "
+                                        "folder, requeue: put running jobs back to waiting, stats: count the jobs.",
+                        choices=["import", "export", "requeue", "stats"])
+    parser.add_argument('-j', '--jobdir', help="Jobs folder (import/export).", default="samples/jobs/")
+    parser.add_argument('-i', '--worker-id', help="Only requeue the jobs of this worker.", default=None)
+
+    args = parser.parse_args()
+
+    sj = SqliteJobs(args.db)
+
+    if args.command == "import":
+        log.info("Imported %d jobs from %s" % (sj.import_dir(args.jobdir), args.jobdir))
+    elif args.command == "export":
+        log.info("Exported %d jobs to %s" % (sj.export_dir(args.jobdir), args.jobdir))
+    elif args.command == "requeue":
+        log.info("Put %d running jobs back to waiting." % sj.requeue(args.worker_id))
+
+    log.info("Jobs: %s" % sj.counts())
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from os.path import join as pjoin
+
+log = logging.getLogger(__name__)
+
+# Prefix of the exported metrics
+PREFIX = "video_worker"
+
+
+class Telemetry(object):
+
+    def __init__(self, wid, textfile=None, eventlog=None):
+        """
+        Per-phase timers, counters and gauges of a worker. The metrics are written as
+        Prometheus text file (for the textfile collector of the node exporter) and every
+        phase and event is appended as json line to the event log. Both are optional,
+        without them the metrics are only kept in memory (see snapshot()).
+
+        Thread-safe: the slots of the supervisor and the upload thread share one instance.
+
+        @param wid: Worker ID (label of all metrics)
+        @param textfile: Path of the Prometheus text file (*.prom), rewritten by write()
+        @param eventlog: Path of the JSONL event log (appended)
+        """
+
+        self._wid = wid
+        self._host = socket.gethostname()
+        self._textfile = textfile
+        self._lock = threading.Lock()
+
+        # phase -> [count, seconds]
+        self._phases = {}
+        self._counters = {}
+        self._gauges = {}
+
+        self._events = None
+        if eventlog:
+            os.makedirs(os.path.dirname(os.path.abspath(eventlog)), exist_ok=True)
+            self._events = open(eventlog, "a")
+
+    @classmethod
+    def for_worker(cls, wid, telemetry_dir=None):
+        """
+        Returns the telemetry of a worker writing <dir>/worker_<wid>.prom and
+        <dir>/worker_<wid>.events.jsonl (or in memory only if no folder is given).
+        """
+
+        if not telemetry_dir:
+            return cls(wid)
+
+        os.makedirs(telemetry_dir, exist_ok=True)
+
+        return cls(wid, textfile=pjoin(telemetry_dir, "worker_%s.prom" % wid),
+                   eventlog=pjoin(telemetry_dir, "worker_%s.events.jsonl" % wid))
+
+    @property
+    def enabled(self):
+        """
+        True if the metrics are written somewhere (text file or event log).
+        """
+
+        return bool(self._textfile) or self._events is not None
+
+    def event(self, name, **fields):
+        """
+        Appends an event to the event log.
+        """
+
+        if self._events is None:
+            return
+
+        record = {'ts': time.time(), 'host': self._host, 'worker': self._wid, 'event': name}
+        record.update(fields)
+
+        line = json.dumps(record, sort_keys=True, default=str)
+
+        with self._lock:
+            self._events.write(line + "\n")
+            self._events.flush()
+
+    def observe(self, phase, seconds, **fields):
+        """
+        Adds the duration of a phase (e.g. measured elsewhere, like the container runtime).
+        """
+
+        with self._lock:
+            entry = self._phases.setdefault(phase, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+
+        self.event("phase", phase=phase, seconds=seconds, **fields)
+
+    @contextmanager
+    def phase(self, phase, **fields):
+        """
+        Times the enclosed block as phase. The duration is recorded also if the block raises.
+        """
+
+        t = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(phase, time.perf_counter() - t, **fields)
+
+    def inc(self, counter, value=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self._gauges[name] = value
+
+    def snapshot(self):
+        """
+        Returns the current metrics as dict.
+        """
+
+        with self._lock:
+            return {'phases': {p: {'count': c, 'seconds': s} for p, (c, s) in self._phases.items()},
+                    'counters': dict(self._counters),
+                    'gauges': dict(self._gauges)}
+
+    def _exposition(self):
+
+        labels = 'host="%s",worker="%s"' % (self._host, self._wid)
+        snap = self.snapshot()
+        lines = []
+
+        lines.append("# HELP %s_phase_seconds_total Time spent per phase of the worker." % PREFIX)
+        lines.append("# TYPE %s_phase_seconds_total counter" % PREFIX)
+        for phase, p in sorted(snap['phases'].items()):
+            lines.append('%s_phase_seconds_total{%s,phase="%s"} %f' % (PREFIX, labels, phase, p['seconds']))
+
+        lines.append("# HELP %s_phase_count_total Number of times a phase was run." % PREFIX)
+        lines.append("# TYPE %s_phase_count_total counter" % PREFIX)
+        for phase, p in sorted(snap['phases'].items()):
+            lines.append('%s_phase_count_total{%s,phase="%s"} %d' % (PREFIX, labels, phase, p['count']))
+
+        for counter, value in sorted(snap['counters'].items()):
+            lines.append("# TYPE %s_%s_total counter" % (PREFIX, counter))
+            lines.append("%s_%s_total{%s} %s" % (PREFIX, counter, labels, value))
+
+        for gauge, value in sorted(snap['gauges'].items()):
+            lines.append("# TYPE %s_%s gauge" % (PREFIX, gauge))
+            lines.append("%s_%s{%s} %s" % (PREFIX, gauge, labels, value))
+
+        lines.append("# TYPE %s_last_update_seconds gauge" % PREFIX)
+        lines.append("%s_last_update_seconds{%s} %f" % (PREFIX, labels, time.time()))
+
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        """
+        Rewrites the Prometheus text file. The file is replaced atomically, so the node
+        exporter never reads a half-written file.
+        """
+
+        if not self._textfile:
+            return
+
+        tmp = "%s.%d.tmp" % (self._textfile, os.getpid())
+
+        try:
+            with open(tmp, "w") as f:
+                f.write(self._exposition())
+            os.replace(tmp, self._textfile)
+        except OSError as e:
+            log.warning("Could not write the metrics to %s: %s" % (self._textfile, e))
+
+    def close(self):
+
+        self.write()
+
+        if self._events is not None:
+            with self._lock:
+                self._events.close()
+                self._events = None
@@ -0,0 +1,813 @@
+import os
+import re
+import json
+import time
+import queue
+import random
+import hashlib
+import shutil
+import logging
+import posixpath
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join as pjoin
+
+log = logging.getLogger(__name__)
+
+# Scheme of a local folder used instead of an SFTP host (for testing)
+LOCAL_SCHEME = "file://"
+
+# Files that reference the segments, uploaded after everything else
+MANIFEST_EXTS = (".mpd", ".m3u8")
+
+# Transfer manifest of a job folder (size, mtime and sha256 of every uploaded file)
+TRANSFER_MANIFEST = ".transfer.json"
+
+# Marker of a job folder whose upload was given up by the worker (see drain())
+UPLOAD_FAILED = ".upload_failed"
+
+CHUNK_SIZE = 1 << 20
+
+
+class LocalAttr(object):
+
+    def __init__(self, filename, st_size):
+        self.filename = filename
+        self.st_size = st_size
+
+
+class LocalDirClient(object):
+    """
+    Stand-in for paramiko.SFTPClient that writes into a local folder. Remote paths are
+    relative to the root folder, like the paths of an SFTP session in the home folder.
+    """
+
+    def __init__(self, root):
+        self._root = root
+
+    def _path(self, remote):
+        return pjoin(self._root, remote.lstrip("/"))
+
+    def mkdir(self, remote):
+        os.mkdir(self._path(remote))
+
+    def stat(self, remote):
+        return os.stat(self._path(remote))
+
+    def listdir_attr(self, remote):
+        return [LocalAttr(e.name, e.stat().st_size) for e in os.scandir(self._path(remote))]
+
+    def open(self, remote, mode="r"):
+        return open(self._path(remote), mode)
+
+    def put(self, local, remote):
+        shutil.copyfile(local, self._path(remote))
+
+    def close(self):
+        pass
+
+
+class SftpPool(object):
+
+    def __init__(self, host, port=22, username=None, password=None, size=4):
+        """
+        Pool of SFTP sessions to one target. The sessions are channels of one persistent
+        SSH transport, which is reconnected if it breaks. A host of the form file://<folder>
+        uses a local folder instead (for testing without an SFTP server).
+
+        @param size: Maximum number of sessions (files in flight)
+        """
+
+        self._host = host
+        self._port = int(port)
+        self._username = username
+        self._password = password
+        self._size = size
+        self._transport = None
+        self._idle = []
+        self._created = 0
+        # guards _idle and _created, waited on for a free session
+        self._cond = threading.Condition()
+        self._lock = threading.Lock()
+
+    def __str__(self):
+        return "%s@%s:%d" % (self._username, self._host, self._port)
+
+    def _connect(self):
+
+        if self._host.startswith(LOCAL_SCHEME):
+            return LocalDirClient(self._host[len(LOCAL_SCHEME):])
+
+        import paramiko
+
+        with self._lock:
+            if self._transport is None or not self._transport.is_active():
+                log.debug("SFTP connecting to %s" % self)
+                self._transport = paramiko.Transport((self._host, self._port))
+                self._transport.connect(username=self._username, password=self._password)
+
+            return paramiko.SFTPClient.from_transport(self._transport)
+
+    def acquire(self):
+        """
+        Returns an idle session. Opens a new one if the pool is not full yet, else waits
+        until a session is released (or a broken one closed, which frees a slot).
+        """
+
+        with self._cond:
+            while not self._idle and self._created >= self._size:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._created += 1
+
+        try:
+            return self._connect()
+        except:
+            with self._cond:
+                self._created -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, client, broken=False):
+        """
+        Returns the session to the pool. Broken sessions are closed and replaced later.
+        """
+
+        if broken:
+            try:
+                client.close()
+            except:
+                pass
+
+        with self._cond:
+            if broken:
+                self._created -= 1
+            else:
+                self._idle.append(client)
+            self._cond.notify()
+
+    def close(self):
+
+        with self._cond:
+            while self._idle:
+                self._idle.pop().close()
+            self._created = 0
+
+        with self._lock:
+            if self._transport is not None:
+                self._transport.close()
+                self._transport = None
+
+
+def _mkdir(client, remote):
+    """
+    Creates the remote folder, an existing one is fine.
+    """
+    try:
+        client.mkdir(remote)
+    except IOError:
+        # Fails if it exists as well, so check before giving up
+        client.stat(remote)
+
+
+def _remote_path(rdir, rel):
+    return rdir if rel == "." else posixpath.join(rdir, *rel.split(os.sep))
+
+
+def _remote_sizes(client, folder):
+    """
+    Returns the sizes of the files in a remote folder (one request for the whole folder).
+    """
+    try:
+        return {a.filename: a.st_size for a in client.listdir_attr(folder)}
+    except IOError:
+        return {}
+
+
+class TransferManifest(object):
+
+    def __init__(self, local_dir):
+        """
+        Per-file record (size, mtime, sha256) of the uploads of a job folder, stored as
+        .transfer.json in the folder. A file is only skipped in a later upload if it is
+        unchanged locally and has the recorded size remotely. Files that were started
+        but not finished can be resumed.
+        """
+
+        self._path = pjoin(local_dir, TRANSFER_MANIFEST)
+        self._lock = threading.Lock()
+        self._files = {}
+
+        if os.path.exists(self._path):
+            try:
+                with open(self._path) as f:
+                    self._files = json.load(f)['files']
+            except (ValueError, KeyError):
+                log.warning("Ignoring broken transfer manifest %s" % self._path)
+
+    def _matches(self, rel, st):
+        e = self._files.get(rel)
+        return e is not None and e['size'] == st.st_size and e['mtime'] == st.st_mtime
+
+    def done(self, rel, st):
+        return self._matches(rel, st) and self._files[rel]['sha256'] is not None
+
+    def started(self, rel, st):
+        return self._matches(rel, st) and self._files[rel]['sha256'] is None
+
+    def start(self, rel, st):
+        with self._lock:
+            self._files[rel] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha256': None}
+
+    def record(self, rel, st, sha256):
+        with self._lock:
+            self._files[rel] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha256': sha256}
+
+    def save(self):
+        with self._lock:
+            with open(self._path + ".tmp", "w") as f:
+                json.dump({'files': self._files}, f, indent=1, sort_keys=True)
+            os.rename(self._path + ".tmp", self._path)
+
+
+def _remote_sha256(client, remote, size=None):
+    # sha256 of the remote file, or of its first size bytes
+    h = hashlib.sha256()
+    remaining = size
+    with client.open(remote, "rb") as rf:
+        while remaining is None or remaining > 0:
+            chunk = rf.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            h.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return h.hexdigest()
+
+
+def transfer_file(client, local, remote, offset=0, verify="size"):
+    """
+    Copies a local file to the remote path, starting at offset (resume of a partial
+    remote file). The part already on the remote side is read back and compared with
+    the local file first, on a mismatch the whole file is copied again. The sha256 of
+    the local file is computed on the way.
+
+    @param verify: "size": check the remote size afterwards, "sha256": read the remote
+                   file back and compare the hash as well
+    @return: sha256 of the file
+    """
+
+    h = hashlib.sha256()
+
+    with open(local, "rb") as f:
+
+        # The part that is already there only needs to be hashed
+        remaining = offset
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+
+        if offset and _remote_sha256(client, remote, size=offset) != h.hexdigest():
+            log.warning("Partial %s does not match the local file. Uploading it again." % remote)
+            offset = 0
+            h = hashlib.sha256()
+            f.seek(0)
+
+        with client.open(remote, "ab" if offset else "wb") as rf:
+
+            if hasattr(rf, "set_pipelined"):
+                rf.set_pipelined(True)
+
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                h.update(chunk)
+                rf.write(chunk)
+
+        size = os.fstat(f.fileno()).st_size
+
+    rsize = client.stat(remote).st_size
+    if rsize != size:
+        raise IOError("Size of %s is %d instead of %d" % (remote, rsize, size))
+
+    sha256 = h.hexdigest()
+
+    if verify == "sha256" and _remote_sha256(client, remote) != sha256:
+        raise IOError("Checksum mismatch of %s" % remote)
+
+    return sha256
+
+
+def put_file(pool, manifest, local, rel, remote, remote_size=None, retries=5, backoff=1.0, verify="size"):
+    """
+    Uploads one file of a job folder. Skips it if the manifest and the remote size say it
+    is there already, resumes a partial upload and retries with exponential backoff.
+
+    @param remote_size: Remote size of the file if known (None: does not exist)
+    @return: True if the file is on the remote side.
+    """
+
+    st = os.stat(local)
+
+    if remote_size == st.st_size and manifest.done(rel, st):
+        log.debug("SFTP SKIP (present): %s" % remote)
+        return True
+
+    for attempt in range(retries + 1):
+
+        if attempt:
+            wait = min(60, backoff * 2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+            log.warning("Retrying %s in %.1fs (attempt %d/%d)." % (remote, wait, attempt, retries))
+            time.sleep(wait)
+
+        try:
+            client = pool.acquire()
+        except:
+            log.warning("SFTP Connection failed: %s" % traceback.format_exc().splitlines()[-1])
+            continue
+
+        try:
+            offset = 0
+
+            # Resume only what we started ourselves with the same local file
+            if manifest.started(rel, st):
+                try:
+                    rsize = client.stat(remote).st_size
+                except IOError:
+                    rsize = 0
+                if rsize < st.st_size:
+                    offset = rsize
+
+            manifest.start(rel, st)
+
+            log.debug("SFTP PUT: %s%s" % (remote, " (resuming at %d)" % offset if offset else ""))
+
+            sha256 = transfer_file(client, local, remote, offset=offset, verify=verify)
+
+        except:
+            log.warning("Failed to put %s: %s" % (remote, traceback.format_exc().splitlines()[-1]))
+            pool.release(client, broken=True)
+            continue
+
+        pool.release(client)
+        manifest.record(rel, st, sha256)
+
+        return True
+
+    log.error("Failed to put %s on the sftp server!" % remote)
+
+    return False
+
+
+def upload_dir(pool, local_dir, target_dir, parallel=4, retries=5, verify="size"):
+    """
+    Uploads a folder (with subfolders) into target_dir with several files in flight.
+    Files that are already there (see TransferManifest) are skipped, partial ones are
+    resumed. The manifests (.mpd, .m3u8) are uploaded after the segments, so a client
+    never sees a manifest that references missing segments. The transfer manifest comes
+    last and marks the folder as complete.
+
+    @return: True if all files were uploaded.
+    """
+
+    ldirname = os.path.basename(os.path.normpath(local_dir))
+    rdir = posixpath.join(target_dir, ldirname)
+
+    log.debug("SFTP CPY: %s to %s:%s" % (local_dir, pool, rdir))
+
+    manifest = TransferManifest(local_dir)
+
+    folders = []
+    files = []
+    manifests = []
+
+    for root, _, names in os.walk(local_dir):
+        rel = os.path.relpath(root, local_dir)
+        rroot = _remote_path(rdir, rel)
+        folders.append(rroot)
+        for n in names:
+            if n.startswith(TRANSFER_MANIFEST) or n == UPLOAD_FAILED:
+                continue
+            item = (pjoin(root, n), os.path.normpath(pjoin(rel, n)), posixpath.join(rroot, n))
+            (manifests if n.endswith(MANIFEST_EXTS) else files).append(item)
+
+    try:
+        client = pool.acquire()
+    except:
+        log.error("SFTP Connection failed!")
+        log.error(traceback.format_exc())
+        return False
+
+    try:
+        sizes = {}
+        for folder in folders:
+            _mkdir(client, folder)
+            sizes.update({posixpath.join(folder, n): size for n, size in _remote_sizes(client, folder).items()})
+    except:
+        log.error("Could not create %s !" % folder)
+        log.error(traceback.format_exc())
+        pool.release(client, broken=True)
+        return False
+
+    pool.release(client)
+
+    def put(item):
+        local, rel, remote = item
+        return put_file(pool, manifest, local, rel, remote, remote_size=sizes.get(remote),
+                        retries=retries, verify=verify)
+
+    try:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            if not all(list(executor.map(put, files))):
+                return False
+            if not all(list(executor.map(put, manifests))):
+                return False
+    finally:
+        manifest.save()
+
+    try:
+        client = pool.acquire()
+    except:
+        log.error("SFTP Connection failed!")
+        log.error(traceback.format_exc())
+        return False
+
+    try:
+        transfer_file(client, pjoin(local_dir, TRANSFER_MANIFEST), posixpath.join(rdir, TRANSFER_MANIFEST))
+    except:
+        log.error("Failed to put the transfer manifest of %s!" % local_dir)
+        pool.release(client, broken=True)
+        return False
+
+    pool.release(client)
+
+    return True
+
+
+def playlist_segments(playlist):
+    """
+    Returns the files referenced by an HLS media playlist (init segment and media segments).
+    ffmpeg only adds a segment to the playlist after it was written completely.
+    """
+
+    segments = []
+
+    with open(playlist) as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("#EXT-X-MAP:"):
+                m = re.search(r'URI="([^"]+)"', line)
+                if m:
+                    segments.append(m.group(1))
+            elif line and not line.startswith("#"):
+                segments.append(line)
+
+    return segments
+
+
+class SegmentPublisher(object):
+
+    def __init__(self, pool, local_dir, target_dir, poll=2.0):
+        """
+        Uploads the segments of a running encode as soon as they are complete. The media
+        playlists (media_*.m3u8, written by ffmpeg with -hls_playlist) tell which segments
+        are complete. The uploads are recorded in the transfer manifest, so the final
+        upload of the folder skips them. The manifests are left for the final upload.
+
+        @param pool: SftpPool of the target
+        @param local_dir: Job folder in the tmp folder
+        @param target_dir: Target folder on the host
+        @param poll: Interval in seconds to check the playlists
+        """
+
+        self._pool = pool
+        self._local_dir = local_dir
+        self._rdir = posixpath.join(target_dir, os.path.basename(os.path.normpath(local_dir)))
+        self._poll = poll
+        self._manifest = TransferManifest(local_dir)
+        self._shipped = set()
+        self._folders = set()
+        self._mtimes = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="publish", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+
+        while not self._stop.wait(self._poll):
+            try:
+                self.publish()
+            except:
+                log.warning("Publishing segments of %s failed, retrying later." % self._local_dir)
+                log.debug(traceback.format_exc())
+
+    def _new_segments(self):
+
+        for root, _, names in os.walk(self._local_dir):
+            for n in names:
+
+                if not (n.startswith("media_") and n.endswith(".m3u8")):
+                    continue
+
+                playlist = pjoin(root, n)
+                mtime = os.stat(playlist).st_mtime
+
+                if self._mtimes.get(playlist) == mtime:
+                    continue
+
+                self._mtimes[playlist] = mtime
+
+                for seg in playlist_segments(playlist):
+                    rel = os.path.normpath(os.path.relpath(pjoin(root, seg), self._local_dir))
+                    if rel not in self._shipped:
+                        yield rel
+
+    def publish(self):
+        """
+        Uploads the segments that were completed since the last call.
+        """
+
+        new = list(self._new_segments())
+
+        if not new:
+            return
+
+        client = self._pool.acquire()
+
+        try:
+            for folder in set(_remote_path(self._rdir, os.path.dirname(rel) or ".") for rel in new):
+                if folder not in self._folders:
+                    _mkdir(client, self._rdir)
+                    _mkdir(client, folder)
+                    self._folders.add(folder)
+        except:
+            self._pool.release(client, broken=True)
+            self._mtimes = {}
+            raise
+
+        self._pool.release(client)
+
+        for rel in new:
+
+            if not put_file(self._pool, self._manifest, pjoin(self._local_dir, rel), rel,
+                            _remote_path(self._rdir, rel), retries=1):
+                # Playlists are parsed again next time
+                self._mtimes = {}
+                break
+
+            self._shipped.add(rel)
+
+        self._manifest.save()
+
+    def stop(self):
+        """
+        Stops watching the playlists and publishes the segments completed so far.
+        """
+
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join()
+
+        try:
+            self.publish()
+        except:
+            log.warning("Publishing segments of %s failed, leaving them to the final upload." % self._local_dir)
+
+    def shipped(self):
+        """
+        Returns the uploaded files (relative to the job folder).
+        """
+        return set(self._shipped)
+
+
+class UploadQueue(object):
+
+    def __init__(self, pool, target_dir, parallel=4, max_pending=2, keep_tmp=False, retries=5, verify="size",
+                 telemetry=None):
+        """
+        Uploads finished job folders in the background, so the worker can start the next
+        job during the upload. Uploaded folders are deleted, failed ones are kept locally
+        (see drain()).
+
+        @param pool: SftpPool of the target
+        @param target_dir: Target folder on the host
+        @param parallel: Files in flight per job folder
+        @param max_pending: Maximum number of folders waiting for the upload. submit() blocks
+                            if it is reached, which bounds the space used in the tmp folder.
+        @param keep_tmp: Do not delete the uploaded folders
+        @param retries: Retries per file
+        @param verify: Verification of the uploaded files ("size" or "sha256", see transfer_file)
+        @param telemetry: Telemetry of the worker (upload and cleanup phases, uploaded bytes)
+        """
+
+        self._pool = pool
+        self._target_dir = target_dir
+        self._parallel = parallel
+        self._keep_tmp = keep_tmp
+        self._retries = retries
+        self._verify = verify
+        self._telemetry = telemetry
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._failed = []
+
+        self._thread = threading.Thread(target=self._run, name="upload", daemon=True)
+        self._thread.start()
+
+    def publisher(self, local_dir):
+        """
+        Returns a SegmentPublisher that uploads the segments of a running encode to the
+        same target. Submit the folder when the encode is done.
+        """
+        return SegmentPublisher(self._pool, local_dir, self._target_dir)
+
+    def submit(self, local_dir):
+        """
+        Queues a folder for the upload. Blocks while max_pending folders are waiting.
+        """
+
+        log.debug("Queueing upload of %s (%d waiting)." % (local_dir, self._queue.qsize()))
+
+        self._queue.put(local_dir)
+
+    def _run(self):
+
+        while True:
+
+            local_dir = self._queue.get()
+
+            try:
+                if local_dir is None:
+                    return
+
+                self._upload(local_dir)
+            except Exception:
+                # Keep the upload thread alive, otherwise submit() and close() block forever
+                log.error("Upload of %s failed !" % local_dir)
+                log.error(traceback.format_exc())
+                mark_failed(local_dir)
+                self._failed.append(local_dir)
+            finally:
+                self._queue.task_done()
+
+    def _upload(self, local_dir):
+
+        t = time.perf_counter()
+
+        ok = upload_dir(self._pool, local_dir, self._target_dir, parallel=self._parallel,
+                        retries=self._retries, verify=self._verify)
+
+        dur = time.perf_counter() - t
+
+        log.debug("Upload of %s took %.1fs." % (local_dir, dur))
+
+        if self._telemetry is not None:
+            size = sum(os.path.getsize(pjoin(root, f)) for root, _, files in os.walk(local_dir) for f in files)
+            self._telemetry.observe("upload", dur, dir=os.path.basename(local_dir), bytes=size, ok=ok)
+            self._telemetry.inc("bytes_uploaded" if ok else "uploads_failed", size if ok else 1)
+
+        if ok and not self._keep_tmp:
+            log.debug("SFTP upload completed. Deleting local %s." % local_dir)
+            t = time.perf_counter()
+            shutil.rmtree(local_dir)
+            if self._telemetry is not None:
+                self._telemetry.observe("cleanup", time.perf_counter() - t, dir=os.path.basename(local_dir))
+        elif not ok:
+            log.error("SFTP Upload of %s failed ! Keeping it locally." % local_dir)
+            mark_failed(local_dir)
+            self._failed.append(local_dir)
+
+    def pending(self):
+        """
+        Returns the number of folders waiting for the upload.
+        """
+        return self._queue.qsize()
+
+    def failed(self):
+        return list(self._failed)
+
+    def join(self):
+        """
+        Waits until all queued folders are uploaded.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Uploads the queued folders and stops the upload thread.
+        """
+
+        self._queue.put(None)
+        self._thread.join()
+        self._pool.close()
+
+
+def mark_failed(local_dir):
+    """
+    Marks a job folder whose upload failed for good, so drain() may take it over. The
+    transfer manifest is no such signal: it is written while the folder is still encoded
+    or uploaded.
+    """
+
+    try:
+        with open(pjoin(local_dir, UPLOAD_FAILED), "w") as f:
+            json.dump({'ts': time.time(), 'pid': os.getpid()}, f)
+    except OSError as e:
+        log.warning("Could not mark the failed upload of %s: %s" % (local_dir, e))
+
+
+def leftover_dirs(tmpdir, all_dirs=False):
+    """
+    Returns the job folders in the tmp folder that were not uploaded completely. Hidden
+    folders (job server spools, locality state) are never uploaded. Without all_dirs, only
+    folders the worker gave up on (marked with mark_failed()) are returned; the others
+    may belong to a job that is still running or being uploaded.
+    """
+
+    dirs = []
+
+    for name in sorted(os.listdir(tmpdir)):
+
+        path = pjoin(tmpdir, name)
+
+        if name.startswith(".") or not os.path.isdir(path):
+            continue
+
+        if all_dirs or os.path.exists(pjoin(path, UPLOAD_FAILED)):
+            dirs.append(path)
+
+    return dirs
+
+
+def drain(pool, tmpdir, target_dir, parallel=4, keep_tmp=False, all_dirs=False, retries=5, verify="size"):
+    """
+    Uploads the leftover job folders of the tmp folder (e.g. after failed uploads).
+
+    @return: Folders that still could not be uploaded.
+    """
+
+    failed = []
+
+    for path in leftover_dirs(tmpdir, all_dirs=all_dirs):
+
+        log.info("Draining %s" % path)
+
+        if not upload_dir(pool, path, target_dir, parallel=parallel, retries=retries, verify=verify):
+            log.error("Upload of %s failed ! Keeping it locally." % path)
+            failed.append(path)
+        elif not keep_tmp:
+            shutil.rmtree(path)
+        elif os.path.exists(pjoin(path, UPLOAD_FAILED)):
+            os.remove(pjoin(path, UPLOAD_FAILED))
+
+    return failed
+
+
+if __name__ == "__main__":
+
+    logconf = {'format': '[%(asctime)s.%(msecs)-3d: %(name)-16s - %(levelname)-5s] %(message)s', 'datefmt': "%H:%M:%S"}
+    logging.basicConfig(level=logging.INFO, **logconf)
+
+    import argparse
+    parser = argparse.ArgumentParser(description="Uploads the leftover job folders of a tmp folder.")
+    parser.add_argument('--drain', help="Tmp folder to drain.", required=True)
+    parser.add_argument('--sftp-target-dir', help="Target directory on the SFTP host.", default=".")
+    parser.add_argument('--sftp-host', help="SFTP Host (or file://<folder> for a local folder).", required=True)
+    parser.add_argument('--sftp-port', help="Port of SFTP host.", default=22)
+    parser.add_argument('--sftp-user', help="User of SFTP host.")
+    parser.add_argument('--sftp-password', help="Password of the SFTP host.")
+    parser.add_argument('--parallel', help="Files in flight.", type=int, default=4)
+    parser.add_argument('--verify', help="Verification of the uploaded files.", choices=["size", "sha256"], default="size")
+    parser.add_argument('--all', help="Also upload folders that were not marked as failed upload (no worker may run "
+                                      "on this tmp folder!).", action="store_true")
+    parser.add_argument('--keep-tmp', help="Keep the uploaded folders.", action="store_true")
+    parser.add_argument('--interval', help="Drain again every N seconds (0: once).", type=int, default=0)
+
+    args = parser.parse_args()
+
+    pool = SftpPool(args.sftp_host, args.sftp_port, args.sftp_user, args.sftp_password, size=args.parallel)
+
+    try:
+        while True:
+
+            failed = drain(pool, args.drain, args.sftp_target_dir, parallel=args.parallel,
+                           keep_tmp=args.keep_tmp, all_dirs=args.all, verify=args.verify)
+
+            if failed:
+                log.error("Could not upload: %s" % failed)
+
+            if not args.interval:
+                break
+
+            time.sleep(args.interval)
+    finally:
+        pool.close()
@@ -1,20 +1,27 @@
 #!/usr/bin/env python3
 
-import os, sys, re
-import subprocess
+import os, sys
 import json
 import time
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ThreadPoolExecutor
 from math import ceil
 from scripts.cmdhandling import exec_cmd
-from scripts.getStats import calc_stats, get_segments
+import numpy as np
+from scripts.getStats import calc_stats_arrays, calc_stats_full_clean, get_segments, segment_frames
+from scripts.statsfile import save_arrays
+from scripts.analysis import analyse_representation, sampled_quality, METRICS
+from scripts.vidcache import cached, video_index
+from scripts.quality import compute_quality
 
 RESULTS="/results"
 TMP="/tmpdir"
 #TMP="testing"
 TIMINGS="timings.json"
 
-def run_ffmpeg_cmd(video, cmd, output=True):
-    cmd = 'ffmpeg -i {video} {cmd}'.format(video=video, cmd=cmd)
+def run_ffmpeg_cmd(video, cmd, output=True, input_opts=''):
+    cmd = 'ffmpeg {input_opts}-i {video} {cmd}'.format(input_opts=input_opts, video=video, cmd=cmd)
     print(cmd)
     proc, stdout, stderr = exec_cmd(cmd, output=output)
     if 'error' in stdout.lower() or 'error' in stderr.lower():
@@ -36,16 +43,45 @@ def save_confs(vid_opts, vid_stats):
     with open(vid_opts['vid_stats'], 'w') as fp:
         json.dump(vid_stats, fp)
 
-def calc_get_stats(vid_opts, vid_stats):
-    segments, durations = get_segments(vid_opts['m3u8'])
-    stats = calc_stats(segments,vid_stats['fps'], durations)
-    stats_clean = calc_stats(segments[:-1],vid_stats['fps'], durations)
+def calc_get_stats(vid_opts, vid_stats, frames=None):
+    frames, bounds, durations = get_segments(vid_opts['m3u8'], frames=frames)
+    if vid_opts['stats_format'] == 'npz':
+        calc_get_stats_compact(vid_opts, vid_stats, frames, bounds, durations)
+        return
+    stats, stats_clean = calc_stats_full_clean(frames['pkt_sizes'], bounds, vid_stats['fps'], durations)
     with open(vid_opts['stats'], 'w') as fp:
         json.dump(stats, fp)
     with open(vid_opts['stats_clean'], 'w') as fp:
         json.dump(stats_clean, fp)
     with open(vid_opts['segments'], 'w') as fp:
-        json.dump(segments, fp)
+        json.dump(segment_frames(frames, bounds), fp)
+
+def calc_get_stats_compact(vid_opts, vid_stats, frames, bounds, durations):
+    # large arrays go into one binary file, the json files only keep the summaries
+    arrays = calc_stats_arrays(frames['pkt_sizes'], bounds, vid_stats['fps'])
+    stats, stats_clean = calc_stats_full_clean(frames['pkt_sizes'], bounds, vid_stats['fps'], durations, \
+        arrays=arrays, summary_only=True)
+    arrays.update({
+        'timestamps': frames['timestamps'],
+        'pkt_sizes': frames['pkt_sizes'],
+        'pict_types': frames['pict_types'],
+        'seg_bounds': bounds,
+        'durations': np.array(durations)
+    })
+    save_arrays(vid_opts['stats_arrays'], arrays)
+    stats['arrays'] = stats_clean['arrays'] = os.path.basename(vid_opts['stats_arrays'])
+    with open(vid_opts['stats'], 'w') as fp:
+        json.dump(stats, fp)
+    with open(vid_opts['stats_clean'], 'w') as fp:
+        json.dump(stats_clean, fp)
+
+def calc_ssim_psnr_numpy(vid_opts):
+    # PSNR and SSIM against the memory-mapped reference, no VMAF
+    print('Calculating ssim and psnr with numpy')
+    values, elapsed = compute_quality(vid_opts['output'], vid_opts['reference_video'], vid_opts['psnr_ssim_vmaf'], \
+        metrics=[m for m in vid_opts['metrics'] if m in ['psnr', 'ssim']])
+    print('Finished ssim, psnr ({count} frames in {elapsed:.1f}s)'.format(count=len(values['psnr_avg']) \
+        if 'psnr_avg' in values else len(values.get('ssim_avg', [])), elapsed=elapsed))
 
 def calc_ssim_psnr_vmaf(vid_opts):
     # 4k model ist used that is located under
@@ -65,7 +101,16 @@ def calc_ssim_psnr_vmaf(vid_opts):
         f.write(stdout)
     print('Finished ssim, psnr, vmaf')
     
-def extract_vid_stats(video):
+def extract_vid_stats(video, use_cache=True):
+    """
+    Returns duration, bitrate, fps and resolution of the video, from the metadata
+    cache of the video folder if the video did not change (see scripts/vidcache.py).
+    """
+    if use_cache:
+        return cached(video, 'stats', probe_vid_stats)
+    return probe_vid_stats(video)
+
+def probe_vid_stats(video):
     vid_stats = {}
     _, stdtout, stderr = run_ffprobe_cmd(video, \
         '-show_entries format=duration,bit_rate ' \
@@ -83,10 +128,14 @@ def extract_vid_stats(video):
     vid_stats['resolution'] = '{w}x{h}'.format(w=json_dump['streams'][0]['width'], h=json_dump['streams'][0]['height'])
     return vid_stats
 
-def encode_video_var(vid_opts,vid_stats):
+def output_args_var(vid_opts,vid_stats,pass_nr=0):
+    """
+    ffmpeg output options for variable segment durations.
+    pass_nr 0 is a single pass (crf) encoding, 1 and 2 are the passes of a cbr encoding.
+    """
     key_int_max = int(ceil(vid_opts['min_dur'] * vid_stats['fps']))
     key_int_min = int(ceil(vid_opts['max_dur'] * vid_stats['fps']))
-    cmd = '-nostats -map 0:0 -threads 1 -vcodec lib{codec} '.format(codec=vid_opts['codec'])
+    cmd = '-map 0:0 -threads 1 -vcodec lib{codec} '.format(codec=vid_opts['codec'])
     if 'key_frames_t' in vid_opts:
         # turnoff scenecut detection!
         cmd_split = '-{codec}-params keyint={key_int_max}:min-keyint={key_int_min}:scenecut=-1 -force_key_frames {key_frames_t} '.format(\
@@ -105,45 +154,30 @@ def encode_video_var(vid_opts,vid_stats):
         '-use_timeline 1 -use_template 1 -hls_playlist 1 -seg_duration 0 ' \
         ' -use_timeline 1 '
 
-    if not 'cst_bitrate' in vid_opts:
-        count = 0
-        out_name = 'f'
+    if pass_nr == 0:
         cmd += '-crf {crf_val} '.format(crf_val=vid_opts['crf_val'])
-    
-    if 'cst_bitrate' in vid_opts:
-        first_pass = '-pass {pass_nr} -b:v {cst_bitrate} -maxrate {maxrate} -bufsize {bufsize} '.format(\
-            pass_nr=1,
-            cst_bitrate=vid_opts['cst_bitrate'], \
-            maxrate=1.25*float(vid_opts['cst_bitrate']),
-            bufsize=2*float(vid_opts['cst_bitrate']),
-        )
-        second_pass = '-pass {pass_nr} -b:v {cst_bitrate} -maxrate {maxrate} -bufsize {bufsize} '.format(\
-            pass_nr=2,
-            cst_bitrate=vid_opts['cst_bitrate'], \
-            maxrate=1.25*float(vid_opts['cst_bitrate']),
-            bufsize=2*float(vid_opts['cst_bitrate']),
-        )
-        cmd_first = cmd + cmd_split + first_pass + ' -f null -'.format(\
-            output = '/dev/null'
-        )
-        cmd_second = cmd + cmd_split + second_pass  + ' -f dash {output}'.format(\
-            output = vid_opts['output']
-        )
-        print("Doing Firstpass")
-        print(run_ffmpeg_cmd(vid_opts['vid_id'],cmd_first,output=True))
-        print("Doing Secondpass")
-        print(run_ffmpeg_cmd(vid_opts['vid_id'],cmd_second,output=True))
-    else:
-        cmd += cmd_split
-        cmd += '-f dash {output}'.format(output=vid_opts['output'])
-        print(run_ffmpeg_cmd(vid_opts['vid_id'],cmd,output=True))
-    #print(cmd)
+        return cmd + cmd_split + '-f dash {output}'.format(output=vid_opts['output'])
+
+    cbr_pass = '-pass {pass_nr} -b:v {cst_bitrate} -maxrate {maxrate} -bufsize {bufsize} '.format(\
+        pass_nr=pass_nr,
+        cst_bitrate=vid_opts['cst_bitrate'], \
+        maxrate=1.25*float(vid_opts['cst_bitrate']),
+        bufsize=2*float(vid_opts['cst_bitrate']),
+    )
+    if 'passlogfile' in vid_opts:
+        cbr_pass += '-passlogfile {passlogfile} '.format(passlogfile=vid_opts['passlogfile'])
+    if pass_nr == 1:
+        return cmd + cmd_split + cbr_pass + ' -f null -'
+    return cmd + cmd_split + cbr_pass + ' -f dash {output}'.format(output=vid_opts['output'])
 
-def encode_video_fixed(vid_opts,vid_stats):
+def output_args_fixed(vid_opts,vid_stats,pass_nr=0):
+    """
+    ffmpeg output options for fixed segment durations (see output_args_var).
+    """
     key_int_max = int(ceil(vid_opts['min_dur'] * vid_stats['fps']))
     key_int_min = int(ceil(vid_opts['max_dur'] * vid_stats['fps']))
 
-    cmd = '-nostats -threads 1 -map 0:0 -vcodec lib{codec} '
+    cmd = '-threads 1 -map 0:0 -vcodec lib{codec} '
     cmd = cmd.format(\
         codec=vid_opts['codec']\
     )
@@ -156,64 +190,252 @@ def encode_video_fixed(vid_opts,vid_stats):
         key_int_min=key_int_min,\
         target_seg_length=vid_opts['target_seg_length']\
     )
-    # Add First Pass (if CBR)
-    if 'cst_bitrate' in vid_opts:
-        first_pass = '-pass {pass_nr} -b:v {cst_bitrate} '.format(\
-            pass_nr=1,
-            cst_bitrate=vid_opts['cst_bitrate']\
+    if pass_nr == 0:
+        cmd += cmd_split
+        cmd += '-crf {crf_val} '.format(\
+            crf_val=vid_opts['crf_val']\
         )
-        second_pass = '-pass {pass_nr} -b:v {cst_bitrate} '.format(\
-            pass_nr=2,
-            cst_bitrate=vid_opts['cst_bitrate']\
+        cmd += ' {output}'.format(\
+            output=vid_opts['output']\
         )
-        cmd_first = cmd + cmd_split + first_pass + '-f null -'.format(\
-            output = '/dev/null'
+        return cmd
+
+    cbr_pass = '-pass {pass_nr} -b:v {cst_bitrate} '.format(\
+        pass_nr=pass_nr,
+        cst_bitrate=vid_opts['cst_bitrate']\
+    )
+    if 'passlogfile' in vid_opts:
+        cbr_pass += '-passlogfile {passlogfile} '.format(passlogfile=vid_opts['passlogfile'])
+    if pass_nr == 1:
+        return cmd + cmd_split + cbr_pass + '-f null -'
+    return cmd + cmd_split + cbr_pass + '-f dash {output}'.format(\
+        output = vid_opts['output']
         )
-        cmd_second = cmd + cmd_split + second_pass + '-f dash {output}'.format(\
-            output = vid_opts['output']
-            )
+
+def output_args(vid_opts,vid_stats,pass_nr=0):
+    if vid_opts['target_seg_length'] == 0:
+        return output_args_var(vid_opts,vid_stats,pass_nr)
+    return output_args_fixed(vid_opts,vid_stats,pass_nr)
+
+def encode_renditions(renditions,vid_stats):
+    """
+    Encodes all renditions of the same source with one decode of the source
+    (one ffmpeg call with an output per rendition, two calls if a rendition is cbr).
+    """
+    cbr = [r for r in renditions if 'cst_bitrate' in r]
+    if cbr:
+        cmd = '-nostats ' + ' '.join(output_args(r,vid_stats,pass_nr=1) for r in cbr)
         print("Doing Firstpass")
-        print(run_ffmpeg_cmd(vid_opts['vid_id'],cmd_first,output=True))
-        print("Doing Secondpass", cmd_first)
-        print(run_ffmpeg_cmd(vid_opts['vid_id'],cmd_second,output=True))
-        return
-    cmd += cmd_split
-    cmd += '-crf {crf_val} '.format(\
-        crf_val=vid_opts['crf_val']\
-    )
-    cmd += ' {output}'.format(\
+        print(run_ffmpeg_cmd(renditions[0]['vid_id'],cmd,output=True))
+        print("Doing Secondpass")
+    cmd = '-nostats ' + ' '.join(output_args(r,vid_stats,pass_nr=2 if 'cst_bitrate' in r else 0) for r in renditions)
+    print(run_ffmpeg_cmd(renditions[0]['vid_id'],cmd,output=True))
+
+def keyframe_numbers(vid_opts,vid_stats,frame_count):
+    """
+    Returns the frames that start a segment (the forced keyframes), None if the
+    segment boundaries are left to the encoder (variable durations without timestamps).
+    """
+    fps = vid_stats['fps']
+    if vid_opts['target_seg_length'] > 0:
+        # first frame with gte(t,n_forced*target_seg_length)
+        step = vid_opts['target_seg_length'] * fps
+        numbers = [int(ceil(i * step - 1e-6)) for i in range(int(ceil(frame_count / step)))]
+    elif 'key_frames_t' in vid_opts:
+        times = [float(t) for t in vid_opts['key_frames_t'].split(',') if t.strip()]
+        numbers = [int(ceil(t * fps - 1e-6)) for t in times]
+    else:
+        return None
+    return sorted(set([0] + [n for n in numbers if 0 <= n < frame_count]))
+
+def chunk_ranges(keyframes,frame_count,chunks):
+    """
+    Splits the frames into chunks of about the same length at segment boundaries.
+    Returns (first frame, end frame, keyframes relative to the first frame) per chunk.
+    """
+    chunks = max(1, min(chunks, len(keyframes)))
+    starts = sorted(set(keyframes[min(range(len(keyframes)), key=lambda k: abs(keyframes[k] - i * frame_count / chunks))] \
+        for i in range(chunks)))
+    ends = starts[1:] + [frame_count]
+    return [(start, end, [k - start for k in keyframes if start <= k < end]) for start, end in zip(starts, ends)]
+
+def chunk_encoder_args(vid_opts,vid_stats,keyframes,output,pass_nr=0):
+    """
+    ffmpeg encoder options of a chunk (see output_args_var and output_args_fixed),
+    the keyframes are forced by frame number, the segmenting is left to the concat.
+    """
+    key_int_max = int(ceil(vid_opts['min_dur'] * vid_stats['fps']))
+    key_int_min = int(ceil(vid_opts['max_dur'] * vid_stats['fps']))
+    cmd = '-map 0:0 -threads 1 -vcodec lib{codec} -{codec}-params keyint={key_int_max}:min-keyint={key_int_min}{scenecut} ' \
+        '-force_key_frames \'expr:{expr}\' '.format(\
+            codec=vid_opts['codec'],\
+            key_int_max=key_int_max,\
+            key_int_min=key_int_min,\
+            scenecut=':scenecut=-1' if 'key_frames_t' in vid_opts else '',\
+            expr='+'.join('eq(n,{n})'.format(n=n) for n in keyframes)\
+        )
+    if pass_nr == 0:
+        return cmd + '-crf {crf_val} {output}'.format(crf_val=vid_opts['crf_val'], output=output)
+    cmd += '-pass {pass_nr} -b:v {cst_bitrate} '.format(pass_nr=pass_nr, cst_bitrate=vid_opts['cst_bitrate'])
+    if vid_opts['target_seg_length'] == 0:
+        cmd += '-maxrate {maxrate} -bufsize {bufsize} '.format(\
+            maxrate=1.25*float(vid_opts['cst_bitrate']),
+            bufsize=2*float(vid_opts['cst_bitrate'])
+        )
+    cmd += '-passlogfile {output}.pass '.format(output=output)
+    if pass_nr == 1:
+        return cmd + '-f null -'
+    return cmd + output
+
+def segmenter_args(vid_opts):
+    # dash/hls options of output_args_var and output_args_fixed
+    if vid_opts['target_seg_length'] == 0:
+        return '-use_timeline 1 -use_template 1 -hls_playlist 1 -seg_duration 0 '
+    return '-use_timeline 0 -use_template 0 -hls_playlist 1 -seg_duration {target_seg_length} '.format(\
+        target_seg_length=vid_opts['target_seg_length'])
+
+def chunk_path(vid_opts,idx):
+    return '{TMP}/chunk_{idx:03d}.mp4'.format(TMP=vid_opts['tmp_dir'], idx=idx)
+
+def encode_chunk(renditions,vid_stats,idx,chunk):
+    """
+    Encodes the frames [start, end) of the source for all renditions (one decode
+    per pass like encode_renditions).
+    """
+    start, end, keyframes = chunk
+    # seek half a frame early, the first decoded frame is then the first frame of the chunk
+    seek = '-ss {ss:.6f} '.format(ss=max(0.0, (start - 0.5) / vid_stats['fps'])) if start > 0 else ''
+    frames = '-frames:v {count} '.format(count=end - start)
+    cbr = [r for r in renditions if 'cst_bitrate' in r]
+    if cbr:
+        cmd = '-nostats ' + ' '.join(frames + chunk_encoder_args(r,vid_stats,keyframes,chunk_path(r,idx),pass_nr=1) \
+            for r in cbr)
+        run_ffmpeg_cmd(renditions[0]['vid_id'],cmd,output=True,input_opts=seek)
+    cmd = '-nostats ' + ' '.join(frames + chunk_encoder_args(r,vid_stats,keyframes,chunk_path(r,idx), \
+        pass_nr=2 if 'cst_bitrate' in r else 0) for r in renditions)
+    run_ffmpeg_cmd(renditions[0]['vid_id'],cmd,output=True,input_opts=seek)
+    print('Encoded chunk {idx} (frames {start}-{end})'.format(idx=idx, start=start, end=end - 1))
+
+def concat_chunks(vid_opts,count):
+    """
+    Joins the encoded chunks (stream copy) into the dash/hls output.
+    """
+    concat_list = '{TMP}/chunks.txt'.format(TMP=vid_opts['tmp_dir'])
+    with open(concat_list, 'w') as fp:
+        for idx in range(count):
+            fp.write('file \'{path}\'\n'.format(path=os.path.abspath(chunk_path(vid_opts,idx))))
+    cmd = 'ffmpeg -y -nostats -f concat -safe 0 -i {concat_list} -map 0:0 -c copy {segmenter}-f dash {output}'.format(\
+        concat_list=concat_list,\
+        segmenter=segmenter_args(vid_opts),\
         output=vid_opts['output']\
-    )        
-    print(run_ffmpeg_cmd(vid_opts['vid_id'],cmd,output=True))
+    )
+    _, stdout, stderr = exec_cmd(cmd, output=True)
+    if 'error' in stdout.lower() or 'error' in stderr.lower():
+        # the chunks are kept for a look
+        sys.exit('Failed to execute {cmd}'.format(cmd=cmd))
+    for idx in range(count):
+        os.remove(chunk_path(vid_opts,idx))
+        for suffix in ['.pass-0.log', '.pass-0.log.mbtree']:
+            if os.path.exists(chunk_path(vid_opts,idx) + suffix):
+                os.remove(chunk_path(vid_opts,idx) + suffix)
+    os.remove(concat_list)
+
+def encode_renditions_chunked(renditions,vid_stats,chunks):
+    """
+    Splits the source at segment boundaries into chunks, encodes the chunks in
+    parallel (one encoder per core of the container) and joins them per rendition.
+    The segment boundaries are the same as with encode_renditions. A cbr rendition
+    gets a 2-pass encoding per chunk, so the bitrate is met per chunk.
+
+    @return: Number of chunks, 0 if the source could not be split
+    """
+    frame_count = video_index(renditions[0]['vid_id'])['frame_count']
+    keyframes = keyframe_numbers(renditions[0],vid_stats,frame_count)
+    if keyframes is None:
+        print('Segment boundaries are chosen by the encoder, not splitting into chunks')
+        return 0
+    ranges = chunk_ranges(keyframes,frame_count,chunks)
+    cores = len(os.sched_getaffinity(0))
+    print('Encoding {count} chunks on {cores} cores'.format(count=len(ranges), cores=cores))
+    with ThreadPoolExecutor(max_workers=cores) as pool:
+        # result() raises the SystemExit of a failed ffmpeg call
+        for future in [pool.submit(encode_chunk, renditions, vid_stats, idx, chunk) for idx, chunk in enumerate(ranges)]:
+            future.result()
+    for r in renditions:
+        concat_chunks(r,len(ranges))
+    return len(ranges)
 
 def encode_video(vid_opts,vid_stats):
-    if vid_opts['target_seg_length'] == 0:
-        encode_video_var(vid_opts,vid_stats)
-    else:
-        encode_video_fixed(vid_opts,vid_stats)
+    encode_renditions([vid_opts],vid_stats)
+
+def split_options(argv):
+    """
+    Splits optional --key=value arguments from the positional arguments.
+    Values are parsed as json if possible, a --key without value is True.
+    """
+    args = []
+    options = {}
+    for arg in argv:
+        if not arg.startswith('--'):
+            args.append(arg)
+            continue
+        key, sep, value = arg[2:].partition('=')
+        if not sep:
+            value = True
+        else:
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        options[key.replace('-', '_')] = value
+    return args, options
 
-def extract_vid_opts():
+def extract_vid_opts(argv=None, tmp_dir=TMP, results_dir=RESULTS):
     vid_opts = {}
-    if len(sys.argv) < 4:
+    argv, options = split_options(sys.argv if argv is None else argv)
+    if len(argv) < 4:
         print('Usage: python video_encode.py ')
         exit()
-    vid_opts['steady_id'] = str(sys.argv[1])
+    vid_opts['steady_id'] = str(argv[1])
     vid_opts['vid_id'] = str('/videos/') + vid_opts['steady_id'] # vid_opts['steady_id']
-    vid_opts['reference_video'] = str('/videos/') + str(sys.argv[2])
-    vid_opts['crf_val'] = int(str(sys.argv[3]))
-    vid_opts['min_dur'] = float(sys.argv[4])
-    vid_opts['max_dur'] = float(sys.argv[5])
-    vid_opts['target_seg_length'] = float(sys.argv[6])
-    vid_opts['codec'] = str(sys.argv[7])
-
-    if len(sys.argv) > 8:
+    vid_opts['reference_video'] = str('/videos/') + str(argv[2])
+    vid_opts['crf_val'] = int(str(argv[3]))
+    vid_opts['min_dur'] = float(argv[4])
+    vid_opts['max_dur'] = float(argv[5])
+    vid_opts['target_seg_length'] = float(argv[6])
+    vid_opts['codec'] = str(argv[7])
+
+    if len(argv) > 8:
         if vid_opts['target_seg_length'] == 0.0:
             # TODO: Keyfreames have always to be there ...
-            vid_opts['key_frames_t'] = str(sys.argv[8])
-            if len(sys.argv) > 9:
-                vid_opts['cst_bitrate'] = float(sys.argv[9])
+            vid_opts['key_frames_t'] = str(argv[8])
+            if len(argv) > 9:
+                vid_opts['cst_bitrate'] = float(argv[9])
         else:
-            vid_opts['cst_bitrate'] = float(sys.argv[8])
+            vid_opts['cst_bitrate'] = float(argv[8])
+
+    # optional arguments
+    vid_opts['stats_format'] = options.get('stats_format', 'json')
+    vid_opts['single_decode'] = bool(options.get('single_decode', False))
+    vid_opts['metrics'] = options.get('metrics', METRICS)
+    vid_opts['frame_step'] = int(options.get('frame_step', 1))
+    vid_opts['segment_samples'] = int(options.get('segment_samples', 0))
+    vid_opts['metrics_validate'] = bool(options.get('metrics_validate', False))
+    vid_opts['chunks'] = int(options.get('chunks', 0))
+    vid_opts['vidcache'] = bool(options.get('vidcache', True))
+    vid_opts['quality_engine'] = options.get('quality_engine', 'ffmpeg')
+    if vid_opts['quality_engine'] not in ['ffmpeg', 'numpy']:
+        sys.exit('Unknown quality_engine {engine} (ffmpeg or numpy)'.format(engine=vid_opts['quality_engine']))
+    if vid_opts['quality_engine'] == 'numpy':
+        # the numpy engine memory-maps a .y4m reference and computes no VMAF
+        if os.path.splitext(vid_opts['reference_video'])[1] != '.y4m':
+            print('quality_engine numpy needs a .y4m reference, using ffmpeg for {ref}'.format( \
+                ref=vid_opts['reference_video']))
+            vid_opts['quality_engine'] = 'ffmpeg'
+        elif 'vmaf' in vid_opts['metrics']:
+            print('quality_engine numpy computes no VMAF, using ffmpeg for {metrics}'.format( \
+                metrics=', '.join(vid_opts['metrics'])))
+            vid_opts['quality_engine'] = 'ffmpeg'
 
     # TODO: Extract bitrate
     # vid_opts['const_bitrate'] = 0
@@ -224,6 +446,14 @@ def extract_vid_opts():
             .replace('[', '')\
             .replace(']', '')\
         )
+    vid_opts['encoding_id'] = get_encoding_id(vid_opts, out_name)
+    vid_opts['renditions'] = options.get('renditions', [])
+
+    set_output_paths(vid_opts, tmp_dir, results_dir, out_name)
+
+    return vid_opts
+
+def get_encoding_id(vid_opts, out_name):
     encoding_id='{steady_id}_{codec}_{crf_val}_{min_dur}_{max_dur}_{target_seg_length}'.format( \
         steady_id = vid_opts['steady_id'], \
         codec = vid_opts['codec'], \
@@ -234,55 +464,193 @@ def extract_vid_opts():
     )
     if 'cst_bitrate' in vid_opts:
         encoding_id += '_cbr_{cst_bitrate}'.format(cst_bitrate=vid_opts['cst_bitrate'])
+    return encoding_id
 
-    vid_opts['encoding_id'] = encoding_id
-    
+def set_output_paths(vid_opts, tmp_dir, results_dir, out_name):
     # output paths
-    if not os.path.exists('{TMP}'.format(TMP=TMP)): os.makedirs('{TMP}'.format(TMP=TMP))
-    #output_dir = '{TMP}/{encoding_id}'.format(TMP=TMP,encoding_id=encoding_id)
-    output_dir = '{TMP}'.format(TMP=TMP)
-    if not os.path.exists(output_dir): os.makedirs(output_dir)
-    
+    if not os.path.exists(tmp_dir): os.makedirs(tmp_dir)
+    vid_opts['tmp_dir'] = tmp_dir
+
     # this should go in some tmp folder...
-    vid_opts['output'] = '{TMP}/{out_name}.mpd'.format(TMP=output_dir,out_name=out_name)
-    vid_opts['m3u8'] = '{TMP}/media_0.m3u8'.format(TMP=output_dir)
+    vid_opts['output'] = '{TMP}/{out_name}.mpd'.format(TMP=tmp_dir,out_name=out_name)
+    vid_opts['m3u8'] = '{TMP}/media_0.m3u8'.format(TMP=tmp_dir)
+
+    if not os.path.exists(results_dir): os.makedirs(results_dir)
+    vid_opts['results_dir'] = results_dir
+    RESULTS_DIR = results_dir
 
-    if not os.path.exists('{RESULTS}'.format(RESULTS=RESULTS)): os.makedirs('{RESULTS}'.format(RESULTS=RESULTS))
-    #RESULTS_DIR = '{RESULTS}/{encoding_id}'.format(RESULTS=RESULTS,encoding_id=encoding_id)
-    RESULTS_DIR = '{RESULTS}'.format(RESULTS=RESULTS)
-    if not os.path.exists(RESULTS_DIR): os.makedirs(RESULTS_DIR)
-    
     vid_opts['stats'] = '{RESULTS}/{out_name}'.format(RESULTS=RESULTS_DIR,out_name='video_statistics.json')
     vid_opts['stats_clean'] = '{RESULTS}/{out_name}'.format(RESULTS=RESULTS_DIR,out_name='video_statistics_clean.json')
     #vid_opts['ssim'] = '{RESULTS}/ssim.log'.format(RESULTS=RESULTS_DIR)
     #vid_opts['psnr'] = '{RESULTS}/psnr.log'.format(RESULTS=RESULTS_DIR)
     vid_opts['psnr_ssim_vmaf'] = '{RESULTS}/psnr_ssim_vmaf.csv'.format(RESULTS=RESULTS_DIR)
+    vid_opts['metrics_frames'] = '{RESULTS}/{out_name}'.format(RESULTS=RESULTS_DIR,out_name='metrics_frames.json')
     vid_opts['conf'] = '{RESULTS}/{out_name}'.format(RESULTS=RESULTS_DIR,out_name='vid_opts.json')
     vid_opts['vid_stats'] = '{RESULTS}/{out_name}'.format(RESULTS=RESULTS_DIR,out_name='vid_stats.json')
     vid_opts['times'] = '{RESULTS}/{out_name}'.format(RESULTS=RESULTS_DIR,out_name=TIMINGS)
     vid_opts['segments'] = '{RESULTS}/{out_name}'.format(RESULTS=RESULTS_DIR,out_name='segments.json')
+    vid_opts['stats_arrays'] = '{RESULTS}/{out_name}'.format(RESULTS=RESULTS_DIR,out_name='video_statistics.npz')
 
-    return vid_opts
+def rendition_opts(vid_opts):
+    """
+    Returns the options of every rendition of a multi-rendition job. The renditions
+    share the source and the keyframe settings, each one has its own crf/cst_bitrate
+    and its own subfolder in the tmp and results folder.
+    """
+    renditions = []
+    for idx, rendition in enumerate(vid_opts['renditions']):
+        r_opts = {k: v for k, v in vid_opts.items() if k not in ['renditions', 'cst_bitrate']}
+        r_opts['crf_val'] = int(rendition.get('crf', vid_opts['crf_val']))
+        if 'cst_bitrate' in rendition:
+            r_opts['cst_bitrate'] = float(rendition['cst_bitrate'])
+        out_name = 'crf_{crf}'.format(crf=r_opts['crf_val'])
+        name = '{idx:02d}_{out_name}'.format(idx=idx, out_name=out_name)
+        if 'cst_bitrate' in r_opts:
+            name += '_cbr_{cst_bitrate}'.format(cst_bitrate=r_opts['cst_bitrate'])
+        r_opts['rendition'] = name
+        r_opts['encoding_id'] = get_encoding_id(r_opts, out_name)
+        set_output_paths(r_opts, '{TMP}/{name}'.format(TMP=vid_opts['tmp_dir'], name=name), \
+            '{RESULTS}/{name}'.format(RESULTS=vid_opts['results_dir'], name=name), out_name)
+        r_opts['passlogfile'] = '{TMP}/ffmpeg2pass'.format(TMP=r_opts['tmp_dir'])
+        renditions.append(r_opts)
+    return renditions
 
-if __name__== "__main__":
-    times = {}
-    vid_opts = extract_vid_opts()
-    print(vid_opts)
-    print('Extracting Video Stats')
-    vid_stats = extract_vid_stats(vid_opts['vid_id'])
-    print('Encode Video')
-    enc_start = time.time()
-    encode_video(vid_opts,vid_stats)
-    times['enc_time'] = time.time() - enc_start
-    print('Calculate PSNR and SSIM')
-    calc_ssim_psnr_start = time.time()
-    calc_ssim_psnr_vmaf(vid_opts)
-    times['calc_ssim_psnr_time'] = time.time() - calc_ssim_psnr_start
+def sampled_metrics(vid_opts):
+    # only some frames are evaluated or the full evaluation is run for comparison
+    return vid_opts['frame_step'] > 1 or vid_opts['segment_samples'] > 0 or vid_opts['metrics_validate']
+
+def calc_sampled_metrics(vid_opts):
+    report = sampled_quality(vid_opts['m3u8'], vid_opts['reference_video'], vid_opts['psnr_ssim_vmaf'], \
+        playlist=vid_opts['m3u8'] if vid_opts['segment_samples'] > 0 else None, \
+        metrics=vid_opts['metrics'], \
+        frame_step=vid_opts['frame_step'], \
+        segment_samples=vid_opts['segment_samples'], \
+        validate=vid_opts['metrics_validate'] \
+    )
+    print('Evaluated {evaluated} of {frame_count} frames'.format(**report))
+    with open(vid_opts['metrics_frames'], 'w') as fp:
+        json.dump(report, fp)
+
+def analyse_rendition(vid_opts, vid_stats, times):
+    if vid_opts['single_decode'] and not sampled_metrics(vid_opts):
+        print('Analyse representation ({metrics} and frame statistics)'.format(metrics=', '.join(vid_opts['metrics'])))
+        analysis_start = time.time()
+        frames = analyse_representation(vid_opts['m3u8'], vid_opts['reference_video'], vid_opts['psnr_ssim_vmaf'], \
+            metrics=vid_opts['metrics'])
+        times['analysis_time'] = time.time() - analysis_start
+    elif vid_opts['quality_engine'] == 'numpy' and not sampled_metrics(vid_opts):
+        print('Calculate PSNR and SSIM (numpy)')
+        calc_ssim_psnr_start = time.time()
+        calc_ssim_psnr_numpy(vid_opts)
+        times['calc_ssim_psnr_time'] = time.time() - calc_ssim_psnr_start
+        frames = None
+    elif sampled_metrics(vid_opts) or sorted(vid_opts['metrics']) != sorted(METRICS):
+        print('Calculate {metrics} on sampled frames'.format(metrics=', '.join(vid_opts['metrics'])))
+        calc_sampled_start = time.time()
+        calc_sampled_metrics(vid_opts)
+        times['calc_sampled_metrics_time'] = time.time() - calc_sampled_start
+        frames = None
+    else:
+        print('Calculate PSNR and SSIM')
+        calc_ssim_psnr_start = time.time()
+        calc_ssim_psnr_vmaf(vid_opts)
+        times['calc_ssim_psnr_time'] = time.time() - calc_ssim_psnr_start
+        frames = None
     print('Calculate Statistics')
     calc_stats_start = time.time()
-    calc_get_stats(vid_opts,vid_stats)
+    calc_get_stats(vid_opts,vid_stats,frames=frames)
     times['calc_stats_time'] = time.time() - calc_stats_start
     print('Save Configs')
     save_confs(vid_opts,vid_stats)
     save_times(vid_opts,times)
+
+def run(argv=None, tmp_dir=TMP, results_dir=RESULTS):
+    times = {}
+    vid_opts = extract_vid_opts(argv, tmp_dir, results_dir)
+    print(vid_opts)
+    print('Extracting Video Stats')
+    vid_stats = extract_vid_stats(vid_opts['vid_id'], use_cache=vid_opts['vidcache'])
+    renditions = rendition_opts(vid_opts) if vid_opts['renditions'] else [vid_opts]
+    print('Encode Video ({count} renditions)'.format(count=len(renditions)))
+    enc_start = time.time()
+    chunks = encode_renditions_chunked(renditions,vid_stats,vid_opts['chunks']) if vid_opts['chunks'] > 1 else 0
+    if not chunks:
+        encode_renditions(renditions,vid_stats)
+    times['enc_time'] = time.time() - enc_start
+    if chunks:
+        times['enc_chunks'] = chunks
+    if vid_opts['renditions']:
+        # the encoding time is shared by all renditions
+        times['enc_renditions'] = len(renditions)
+    for rendition in renditions:
+        analyse_rendition(rendition, vid_stats, dict(times))
+    if vid_opts['renditions']:
+        save_confs(vid_opts,vid_stats)
+        save_times(vid_opts,times)
     print('Finished')
+
+def run_dry(argv=None, tmp_dir=TMP, results_dir=RESULTS):
+    # only checks the arguments and writes the options, nothing is encoded
+    vid_opts = extract_vid_opts(argv, tmp_dir, results_dir)
+    print(vid_opts)
+    with open(vid_opts['conf'], 'w') as fp:
+        json.dump(vid_opts, fp)
+    print('Finished (dry-run)')
+
+def serve_job(spool, spec_file, tmp_root=TMP, results_root=RESULTS, dryrun=False):
+    job_id = spec_file[:-len('.json')]
+    running = os.path.join(spool, job_id + '.running')
+    os.rename(os.path.join(spool, spec_file), running)
+    with open(running) as fp:
+        spec = json.load(fp)
+
+    tmp_dir = os.path.join(tmp_root, spec['dir'])
+    results_dir = os.path.join(results_root, spec['dir'])
+    if not os.path.exists(results_dir): os.makedirs(results_dir)
+
+    result = {'ok': True}
+    start = time.time()
+    with open(os.path.join(results_dir, 'docker_run_stdout.txt'), 'a') as out, \
+         open(os.path.join(results_dir, 'docker_run_stderr.txt'), 'a') as err, \
+         redirect_stdout(out), redirect_stderr(err):
+        try:
+            (run_dry if dryrun else run)(['video_encode.py'] + spec['args'], tmp_dir, results_dir)
+        except SystemExit as e:
+            if e.code not in [None, 0]:
+                result = {'ok': False, 'error': str(e.code)}
+        except Exception:
+            traceback.print_exc()
+            result = {'ok': False, 'error': traceback.format_exc()}
+    result['runtime'] = time.time() - start
+
+    with open(running, 'w') as fp:
+        json.dump(result, fp)
+    os.rename(running, os.path.join(spool, job_id + '.result'))
+
+def serve(spool, tmp_root=TMP, results_root=RESULTS, dryrun=False, poll=0.5):
+    """
+    Processes the job specs (<job id>.json) written to the spool folder one after
+    another in this interpreter, until a file STOP appears in the spool folder.
+    The result of a job is written to <job id>.result.
+    """
+    print('Serving jobs from {spool}'.format(spool=spool))
+    if not os.path.exists(spool): os.makedirs(spool)
+    while not os.path.exists(os.path.join(spool, 'STOP')):
+        specs = sorted(f for f in os.listdir(spool) if f.endswith('.json'))
+        if not specs:
+            time.sleep(poll)
+            continue
+        for spec_file in specs:
+            serve_job(spool, spec_file, tmp_root, results_root, dryrun=dryrun)
+            sys.stdout.flush()
+    print('Stopped serving jobs')
+
+if __name__== "__main__":
+    _, options = split_options(sys.argv)
+    if 'serve' in options:
+        serve(options['serve'] if options['serve'] is not True else '/spool', \
+            tmp_root=options.get('tmp_root', TMP), \
+            results_root=options.get('results_root', RESULTS), \
+            dryrun=options.get('dry_run', False))
+    else:
+        run()
@@ -0,0 +1,188 @@
+import os
+import time
+import errno
+import random
+import select
+import logging
+import ctypes
+import ctypes.util
+from os.path import join as pjoin
+
+log = logging.getLogger(__name__)
+
+# Name of the doorbell file in the job folder. Touch it after adding jobs on network
+# mounts, where inotify does not see changes of other hosts.
+DOORBELL = "DOORBELL"
+
+# inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+
+class Inotify(object):
+
+    def __init__(self, path, mask=IN_CLOSE_WRITE | IN_MOVED_TO):
+        """
+        Minimal inotify watch of one folder with ctypes. Raises OSError if inotify is
+        not available.
+
+        By default only completely written (IN_CLOSE_WRITE) and moved in (IN_MOVED_TO)
+        files are reported, so a job is not read before it was written.
+        """
+
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            raise OSError("libc not found")
+
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("inotify is not available")
+
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        if libc.inotify_add_watch(self._fd, os.fsencode(path), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(err, "inotify_add_watch failed for %s" % path)
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for events. Returns True if there were events.
+        """
+
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+
+        if not readable:
+            return False
+
+        # Drain the queued events, we only care that something happened
+        while True:
+            try:
+                if not os.read(self._fd, 65536):
+                    break
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+
+        return True
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class Waiter(object):
+
+    def __init__(self, jobsdir, min_wait=2, max_wait=90, doorbell_interval=5, use_inotify=True):
+        """
+        Waits for new jobs of an idle worker. The wait ends early if a job appears in
+        00_waiting/ (inotify, local filesystems) or the doorbell file in the job folder
+        is touched. Otherwise the waits grow exponentially (with jitter) from min_wait
+        to max_wait, so idle workers on a network mount poll less and less.
+
+        @param jobsdir: Job folder
+        @param min_wait: First wait in seconds after a job was found
+        @param max_wait: Maximum wait in seconds
+        @param doorbell_interval: Interval in seconds to check the doorbell file (0: off)
+        @param use_inotify: Use inotify if it is available
+        """
+
+        self._jobsdir = jobsdir
+        self._min_wait = min_wait
+        self._max_wait = max_wait
+        self._doorbell = pjoin(jobsdir, DOORBELL)
+        self._doorbell_interval = doorbell_interval
+        self._misses = 0
+        self._wakeups = {}
+
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = Inotify(pjoin(jobsdir, "00_waiting"))
+            except OSError as e:
+                log.warning("No inotify (%s). Using backoff polling only." % e)
+
+        self._doorbell_mtime = self._ring_time()
+
+    def _ring_time(self):
+        try:
+            return os.stat(self._doorbell).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def reset(self):
+        """
+        A job was found, start again with the shortest wait.
+        """
+        self._misses = 0
+
+    def next_delay(self):
+        delay = min(self._max_wait, self._min_wait * 2 ** self._misses)
+        return delay * random.uniform(0.5, 1.5)
+
+    def wait(self, interrupt=None, tick=1.0):
+        """
+        Waits until new jobs may be available.
+
+        @param interrupt: A function f() -> boolean, checked every tick seconds, that ends the wait
+        @return: Reason of the wakeup: "inotify", "doorbell", "interrupt" or "timeout"
+        """
+
+        delay = self.next_delay()
+        self._misses += 1
+
+        log.debug("No job found. Waiting up to %.1f seconds." % delay)
+
+        end = time.monotonic() + delay
+        reason = "timeout"
+
+        while True:
+
+            remaining = end - time.monotonic()
+
+            if remaining <= 0:
+                break
+
+            if interrupt is not None and interrupt():
+                reason = "interrupt"
+                break
+
+            step = remaining
+            if interrupt is not None:
+                step = min(step, tick)
+            if self._doorbell_interval:
+                step = min(step, self._doorbell_interval)
+
+            if self._inotify is not None:
+                if self._inotify.wait(step):
+                    reason = "inotify"
+                    break
+            else:
+                time.sleep(step)
+
+            if self._doorbell_interval:
+                mtime = self._ring_time()
+                if mtime != self._doorbell_mtime:
+                    self._doorbell_mtime = mtime
+                    reason = "doorbell"
+                    break
+
+        self._wakeups[reason] = self._wakeups.get(reason, 0) + 1
+
+        log.debug("Woke up: %s" % reason)
+
+        return reason
+
+    def stats(self):
+        return dict(self._wakeups)
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
@@ -1,21 +1,36 @@
 import os
 import sys
 import logging
-import random
 import json
 import time
 import subprocess
 import re
 import traceback
 import shutil
-from functools import partial
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from os.path import join as pjoin
-from dirjobs import DirJobs
+from dirjobs import DirJobs, RandomPolicy, LocalityPolicy
+from sqlitejobs import SqliteJobs
+from jobserver import JobServer, JobServerError, resolve_digest
+from wakeup import Waiter
+from upload import SftpPool, UploadQueue, upload_dir, mark_failed, LOCAL_SCHEME
+from telemetry import Telemetry
+from cgroupstats import CgroupSampler, cpuset_size
+from scripts.vidcache import list_videos
 
 log = logging.getLogger(__name__)
 
 VID_EXTS = ['y4m', 'yuv', 'mov', 'mkv', 'avi']
 
+# Interval in seconds to renew the reservations of prefetched jobs while jobs run
+RENEW_INTERVAL = 60
+
+# Optional job keys that are passed to the container as --key=value arguments
+CONTAINER_OPTS = ['stats_format', 'single_decode', 'renditions', 'metrics', 'frame_step', 'segment_samples',
+                  'metrics_validate', 'chunks', 'vidcache', 'quality_engine']
+
 
 def sftp_upload_tmp(host, port, username, password, local_dir, target_dir):
     """
@@ -30,60 +45,95 @@ def sftp_upload_tmp(host, port, username, password, local_dir, target_dir):
     :return:
     """
 
-    log.debug("SFTP CPY: %s to %s@%s:%d:%s" %
-              (local_dir, username, host, int(port), target_dir))
-
-    import paramiko
+    pool = SftpPool(host, port, username, password, size=1)
 
     try:
-        t = paramiko.Transport((host, int(port)))
+        return upload_dir(pool, local_dir, target_dir, parallel=1)
+    finally:
+        pool.close()
 
-        t.connect(username=username, password=password)
 
-        sftp = paramiko.SFTPClient.from_transport(t)
-    except:
-        log.error("SFTP Connection failed!")
-        log.error(traceback.format_exc())
-        return False
+class VideoIndex(object):
 
-    # Local directory name
-    ldirname = os.path.basename(os.path.normpath(local_dir))
+    def __init__(self, viddir, check_interval=10):
+        """
+        In-memory set of the locally available videos, used as job filter for DirJobs.
+        The video folder is only listed again if its mtime changed (checked at most
+        every check_interval seconds).
 
-    try:
-        sftp.chdir(target_dir)
-        sftp.mkdir(ldirname)
-        sftp.chdir(ldirname)
-    except:
-        log.error("Could not create %s !" % (target_dir + "/" + ldirname))
-        log.error(traceback.format_exc())
-        sftp.close()
-        return False
+        @param viddir: Video folder
+        @param check_interval: Minimum time in seconds between two checks of the mtime
+        """
 
-    try:
-        for item in os.listdir(local_dir):
-            itemabs = os.path.join(local_dir, item)
-            if os.path.isfile(itemabs):
-                log.debug("SFTP PUT: %s" % item)
-                sftp.put(itemabs, item)
-    except:
-        log.error("Failed to put items on the sftp server!")
-        log.error(traceback.format_exc())
-        sftp.close()
-        return False
+        self._viddir = viddir
+        self._check_interval = check_interval
+        self._mtime = None
+        self._checked = 0
+        self._videos = set()
+        self._generation = 0
 
-    sftp.close()
+        self.refresh(force=True)
 
-    return True
+    @property
+    def generation(self):
+        """
+        Incremented on every change of the available videos, lets DirJobs cache the filter results.
+        """
+        self.refresh()
+        return self._generation
+
+    def refresh(self, force=False):
 
+        now = time.time()
+
+        if not force and now - self._checked < self._check_interval:
+            return
+
+        self._checked = now
+
+        mtime = os.stat(self._viddir).st_mtime
+
+        if not force and mtime == self._mtime:
+            return
+
+        self._mtime = mtime
+
+        # The listing is cached next to the videos (keyed by the mtime of the folder)
+        videos = set(os.path.splitext(v)[0] for v in list_videos(self._viddir)
+                     if os.path.splitext(v)[1][1:] in VID_EXTS)
+
+        if videos != self._videos:
+            log.debug("Available videos changed: %s" % sorted(videos))
+            self._videos = videos
+            self._generation += 1
+
+    def videos(self):
+        return self._videos
+
+    def __contains__(self, video):
+        self.refresh()
+        return video in self._videos
+
+    def __call__(self, path, name):
+        # Get video name from job name
+        return name.split('_')[0] in self
 
-def process_job(job, wargs, dryrun=False):
+
+def process_job(job, wargs, dryrun=False, server=None, skip_pull=False, uploader=None, telemetry=None):
     """
     Processes a job with the docker container.
 
     @param job: The job to process
     @param wargs: Arguments for the worker (container)
+    @param server: JobServer to run the job in (instead of a new container)
+    @param skip_pull: The image was already pulled (by the supervisor)
+    @param uploader: UploadQueue for the SFTP upload in the background (or for streaming to the sshfs folder)
+    @param telemetry: Telemetry of the worker (pull, container, upload and cleanup phases)
     """
 
+    if telemetry is None:
+        telemetry = Telemetry(wargs['id'])
+
     ts = int(time.time())
 
     stats = {'ts': ts,
@@ -95,8 +145,7 @@ def process_job(job, wargs, dryrun=False):
     log.info("Processing %s" % job)
 
     try:
-        with open(job.path()) as f:
-            j = json.load(f)
+        j = job.load()
 
         stats['job_dict'] = j
 
@@ -121,29 +170,64 @@ def process_job(job, wargs, dryrun=False):
         else:
             cst_bitrate = None
             log.info("NO CST BITRATE GIVEN!")
-        ret = _docker_run(stats, tdir, wargs['viddir'], rdir, wargs['container'],
-                          j["video"], j["reference_video"], j["crf"], j["min_length"],
-                          j["max_length"], j["target_seg_length"],
-                          j["encoder"], timestamps, cst_bitrate,
-                          dryrun=dryrun, processor=wargs['processor'])
+        options = {k: j[k] for k in CONTAINER_OPTS if k in j}
+
+        # Upload the segments while the container is still encoding
+        publisher = None
+        if uploader is not None and wargs['stream_upload'] and not dryrun:
+            publisher = uploader.publisher(tdir)
+            publisher.start()
+
+        try:
+            if server:
+                args = _container_args(wargs['viddir'], j["video"], j["reference_video"], j["crf"],
+                                       j["min_length"], j["max_length"], j["target_seg_length"],
+                                       j["encoder"], timestamps, cst_bitrate, options=options)
+                ret = server.run_job(stats, d, args)
+            else:
+                ret = _docker_run(stats, tdir, wargs['viddir'], rdir, wargs['container'],
+                                  j["video"], j["reference_video"], j["crf"], j["min_length"],
+                                  j["max_length"], j["target_seg_length"],
+                                  j["encoder"], timestamps, cst_bitrate,
+                                  dryrun=dryrun, processor=wargs['processor'], skip_pull=skip_pull,
+                                  options=options, docker=wargs['docker_bin'],
+                                  cgroup_root=wargs['cgroup_root'], cgroup_interval=wargs['cgroup_interval'])
+        finally:
+            if publisher is not None:
+                publisher.stop()
 
         dur = time.perf_counter() - t
         stats['container_runtime'] = dur
 
         log.info("Container runtime: %.1fs" % dur)
 
+        # The pull is part of the container runtime
+        if 'docker_pull_time' in stats:
+            telemetry.observe("pull", stats['docker_pull_time'], job=job.name())
+        telemetry.observe("container", dur - stats.get('docker_pull_time', 0), job=job.name(), ok=ret)
+
+        if publisher is not None:
+            stats['streamed_files'] = len(publisher.shipped())
+
+    except JobServerError:
+        # Not a failure of the job, the caller puts it back
+        raise
     except:
         log.critical(traceback.format_exc())
         log.critical("Failed to process job!")
         return False
 
-    stats['tmpsize'] = sum(os.path.getsize(pjoin(tdir, f)) for f in os.listdir(tdir) if os.path.isfile(pjoin(tdir, f)))
+    stats['tmpsize'] = sum(os.path.getsize(pjoin(root, f)) for root, _, files in os.walk(tdir) for f in files)
 
     with open(pjoin(rdir, "stats.json"), "w") as f:
         json.dump(stats, f, indent=4, sort_keys=True)
 
+    # The upload queue deletes the folder after the upload
+    if uploader is not None and not dryrun:
+        uploader.submit(tdir)
+
     # If SFTP upload is specified.
-    if wargs['sftp_host'] and not dryrun:
+    elif wargs['sftp_host'] and not dryrun:
 
         t = time.perf_counter()
 
@@ -153,31 +237,39 @@ def process_job(job, wargs, dryrun=False):
 
         dur = time.perf_counter() - t
 
-        log.debug("Upload took %.1fs." % dur)
+        log.info("Upload took %.1fs." % dur)
+
+        telemetry.observe("upload", dur, job=job.name(), bytes=stats['tmpsize'], ok=sftp_ret)
+        telemetry.inc("bytes_uploaded" if sftp_ret else "uploads_failed", stats['tmpsize'] if sftp_ret else 1)
 
         if sftp_ret and not wargs['keep_tmp']:
             log.debug("SFTP upload completed. Deleting local %s." % tdir)
-            shutil.rmtree(tdir)
+            with telemetry.phase("cleanup", job=job.name()):
+                shutil.rmtree(tdir)
         elif not sftp_ret:
-            log.error("SFTP Upload of %s failed ! Keeping it locally.")
+            log.error("SFTP Upload of %s failed ! Keeping it locally." % tdir)
+            mark_failed(tdir)
 
     # If sshfs folder is specified.
-    if wargs['sshfs_dir'] and not dryrun:
+    elif wargs['sshfs_dir'] and not dryrun:
         log.debug("SFTP upload completed. Deleting local %s." % tdir)
-        shutil.move(tdir, wargs['sshfs_dir'])
+        with telemetry.phase("upload", job=job.name(), bytes=stats['tmpsize']):
+            shutil.move(tdir, wargs['sshfs_dir'])
+        telemetry.inc("bytes_uploaded", stats['tmpsize'])
 
     if not wargs['sshfs_dir'] and not wargs['sftp_host'] and not wargs['keep_tmp'] and not dryrun:
         log.debug("Deleting %s." % tdir)
-        shutil.rmtree(tdir)
+        with telemetry.phase("cleanup", job=job.name()):
+            shutil.rmtree(tdir)
 
     return ret
 
 
-def _docker_pull(resultdir, container, dryrun=False):
+def _docker_pull(resultdir, container, dryrun=False, docker="docker"):
 
     log.info("Checking for newer version of %s" % container)
 
-    cmd = ["docker", "pull", container]
+    cmd = [docker, "pull", container]
 
     log.debug("RUN: %s" % " ".join(cmd))
 
@@ -199,13 +291,46 @@ def _docker_pull(resultdir, container, dryrun=False):
     return True
 
 
+def _container_args(viddir, video_id, reference_video, crf_value, key_int_min, key_int_max, target_seg_length,
+                    encoder, timestamps=None, cst_bitrate=None, options=None):
+    """
+    Returns the arguments for video_encode.py in the container.
+    """
+
+    if not os.path.exists(pjoin(viddir, video_id)):
+        raise Exception("Could not find video %s !!" % video_id)
+
+    args = [video_id, reference_video, str(crf_value), str(key_int_min), str(key_int_max), str(target_seg_length), encoder]
+
+    if timestamps != None:
+        args.append(timestamps)
+
+    if cst_bitrate != None:
+        args.append(str(cst_bitrate))
+
+    for k, v in sorted((options or {}).items()):
+        args.append("--%s=%s" % (k.replace("_", "-"), v if isinstance(v, str) else json.dumps(v)))
+
+    return args
+
+
 def _docker_run(stats, tmpdir, viddir, resultdir, container,
                 video_id, reference_video, crf_value, key_int_min, key_int_max, target_seg_length, encoder, timestamps=None, cst_bitrate=None,
-                dryrun=False, processor=None, skip_pull=False):
+                dryrun=False, processor=None, skip_pull=False, options=None, docker="docker",
+                cgroup_root=None, cgroup_interval=1.0):
+    """
+    Runs the job in a new container.
+
+    @param cgroup_root: Sample the cgroup of the container below this root (e.g. /sys/fs/cgroup)
+                        and store the samples and a summary as stats['cgroup']. None: no sampling.
+    @param cgroup_interval: Time in seconds between two cgroup samples
+    """
 
     if not skip_pull:
 
-        ret = _docker_pull(resultdir, container, dryrun=dryrun)
+        t = time.perf_counter()
+        ret = _docker_pull(resultdir, container, dryrun=dryrun, docker=docker)
+        stats['docker_pull_time'] = time.perf_counter() - t
 
         if not ret:
             return False
@@ -219,24 +344,29 @@ def _docker_run(stats, tmpdir, viddir, resultdir, container,
     if processor:
         docker_opts += ["--cpuset-cpus=%s" % processor]
 
-    docker_opts += [container]
+    # docker writes the container id into this file, the sampler finds the cgroup with it
+    cidfile = None
+    if cgroup_root:
+        cidfile = pjoin(os.path.abspath(resultdir), "docker.cid")
+        if os.path.exists(cidfile):
+            os.remove(cidfile)
+        docker_opts += ["--cidfile", cidfile]
 
-    if not os.path.exists(pjoin(viddir, video_id)):
-        raise Exception("Could not find video %s !!" % video_id)
+    docker_opts += [container]
 
-    cmd = ["docker", "run"] + docker_opts + \
-          [video_id, reference_video,str(crf_value), str(key_int_min), str(key_int_max), str(target_seg_length), encoder]
-    
-    if timestamps != None:
-        cmd.append(timestamps)
-    
-    if cst_bitrate != None:
-        cmd.append(str(cst_bitrate))
+    cmd = [docker, "run"] + docker_opts + \
+          _container_args(viddir, video_id, reference_video, crf_value, key_int_min, key_int_max,
+                          target_seg_length, encoder, timestamps, cst_bitrate, options)
 
     log.debug("RUN: %s" % " ".join(cmd))
 
     if not dryrun:
 
+        sampler = None
+        if cidfile:
+            sampler = CgroupSampler(cidfile, cgroup_root, interval=cgroup_interval, cpus=cpuset_size(processor))
+            sampler.start()
+
         try:
             with open(pjoin(resultdir, "docker_run_stdout.txt"), "wt") as fout, \
                  open(pjoin(resultdir, "docker_run_stderr.txt"), "wt") as ferr:
@@ -248,6 +378,12 @@ def _docker_run(stats, tmpdir, viddir, resultdir, container,
             log.error("Check the logs in %s for details." % resultdir)
             return False
 
+        finally:
+            if sampler is not None:
+                sampler.stop()
+                stats['cgroup'] = {'summary': sampler.summary(), 'samples': sampler.samples()}
+                log.info("Container resources: %s" % stats['cgroup']['summary'])
+
     else:
         log.warning("Dryrun selected. Not starting docker container!")
 
@@ -258,77 +394,423 @@ def _docker_run(stats, tmpdir, viddir, resultdir, container,
 
 def worker_loop(args):
 
-    videos = [os.path.splitext(v)[0] for v in os.listdir(args.viddir) if not v.startswith(".")]
-    log.info("Currently available videos: %s" % videos)
-
     # Select only jobs where we have the video locally available
-    def video_filter(viddir, path, name):
-
-        # Get video name from job name
-        vid = name.split('_')[0]
-
-        # Check if it exists
-        return any([os.path.exists(pjoin(viddir, vid + "." + e)) for e in VID_EXTS])
+    video_filter = VideoIndex(args.viddir)
+    log.info("Currently available videos: %s" % sorted(video_filter.videos()))
 
-    dj = DirJobs(args.jobdir,
-                 wid=args.id,
-                 worker_sync=not args.dry_run,
-                 sync_time=70,
-                 job_filter=partial(video_filter, args.viddir))
+    # Prefer jobs of sources that are still in the page cache of this host
+    if args.select == "locality":
+        policy = LocalityPolicy(pjoin(args.tmpdir, ".recent_sources"), wid=args.id)
+    else:
+        policy = RandomPolicy()
+
+    if args.sqlite:
+        # Random selection is done by the database itself
+        dj = SqliteJobs(args.sqlite,
+                        wid=args.id,
+                        max_active=args.slots,
+                        job_filter=video_filter,
+                        policy=policy if args.select == "locality" else None)
+    else:
+        dj = DirJobs(args.jobdir,
+                     wid=args.id,
+                     max_active=args.slots,
+                     worker_sync=not args.dry_run,
+                     sync_time=args.sync_time,
+                     job_filter=video_filter,
+                     claim=args.claim,
+                     prefetch=args.prefetch,
+                     policy=policy)
 
     running = True
 
     # Worker arguments
     fields = ['tmpdir', 'viddir', 'resultdir', 'container', 'id', 'processor', 'keep_tmp',
-              'sftp_host', 'sftp_user', 'sftp_port', 'sftp_password', 'sftp_target_dir', 'sshfs_dir']
+              'sftp_host', 'sftp_user', 'sftp_port', 'sftp_password', 'sftp_target_dir', 'sshfs_dir',
+              'stream_upload', 'docker_bin', 'cgroup_interval']
     wargs = {k: getattr(args, k) for k in fields}
+    wargs['cgroup_root'] = args.cgroup_root if args.cgroup_stats else None
+
+    # Per-phase timers and counters (Prometheus text file and event log)
+    telemetry = Telemetry.for_worker(args.id, args.telemetry_dir)
+    telemetry.event("worker_start", slots=args.slots, claim=args.claim, sqlite=args.sqlite)
 
+    uploader = None
     if wargs['sftp_host'] and not args.dry_run:
 
         log.info("Using SFTP upload to %s." % wargs['sftp_host'])
 
-        try:
-            import paramiko
-        except ImportError:
-            log.critical("Python module paramiko not installed !!!")
+        if not wargs['sftp_host'].startswith(LOCAL_SCHEME):
+            try:
+                import paramiko
+            except ImportError:
+                log.critical("Python module paramiko not installed !!!")
+                return
+
+        # Upload in the background, the next job starts during the upload
+        pool = SftpPool(wargs['sftp_host'], wargs['sftp_port'], wargs['sftp_user'], wargs['sftp_password'],
+                        size=args.upload_parallel)
+        uploader = UploadQueue(pool, wargs['sftp_target_dir'], parallel=args.upload_parallel,
+                               max_pending=args.upload_queue, keep_tmp=wargs['keep_tmp'],
+                               verify=args.upload_verify, telemetry=telemetry)
+
+    elif args.stream_upload and wargs['sshfs_dir'] and not args.dry_run:
+
+        # Streaming into the sshfs folder uses the same upload queue with a local target
+        pool = SftpPool(LOCAL_SCHEME + os.path.abspath(wargs['sshfs_dir']), size=args.upload_parallel)
+        uploader = UploadQueue(pool, ".", parallel=args.upload_parallel,
+                               max_pending=args.upload_queue, keep_tmp=wargs['keep_tmp'],
+                               verify=args.upload_verify, telemetry=telemetry)
+
+    # Wakes up idle workers when new jobs arrive
+    if args.sqlite:
+        # No inotify on the database, the doorbell is next to it
+        waiter = Waiter(os.path.dirname(os.path.abspath(args.sqlite)), max_wait=args.max_wait, use_inotify=False)
+    else:
+        waiter = Waiter(args.jobdir, max_wait=args.max_wait, use_inotify=not args.no_inotify)
+
+    server = None
+
+    try:
+
+        # Persistent container or supervisor: pull/verify the image once.
+        image = args.container
+        if args.persistent or args.slots > 1:
+
+            with telemetry.phase("pull"):
+                image = resolve_digest(args.container, dryrun=args.dry_run, docker=args.docker_bin)
+
+            if image is None:
+                log.critical("Could not get the image %s !!!" % args.container)
+                return
+
+            wargs['container'] = image
+
+        if args.slots > 1:
+            supervisor_loop(args, dj, wargs, waiter, uploader, telemetry)
             return
 
-    while running:
+        # Persistent container: run all jobs in one container.
+        if args.persistent:
 
-        if os.path.exists("STOP_WORKERS"):
-            log.warning("File STOP_WORKERS exists in working directory. Quitting..")
-            break
+            server = JobServer(args.id, args.tmpdir, args.viddir, args.resultdir, image,
+                               processor=args.processor, dryrun=args.dry_run, docker=args.docker_bin)
+            server.start()
 
-        try:
-            job = dj.next_and_lock(no_wait=args.one_job)
+        while running:
+
+            if os.path.exists("STOP_WORKERS"):
+                log.warning("File STOP_WORKERS exists in working directory. Quitting..")
+                break
+
+            try:
+                with telemetry.phase("claim"):
+                    job = dj.next_and_lock(no_wait=args.one_job)
 
-            if job:
-                ret = process_job(job, wargs, dryrun=args.dry_run)
+                if job:
+                    waiter.reset()
 
-                if ret:
-                    job.done()
+                    try:
+                        with _renewing(dj), telemetry.phase("job", job=job.name()):
+                            ret = process_job(job, wargs, dryrun=args.dry_run, server=server, uploader=uploader,
+                                              telemetry=telemetry)
+                    except JobServerError as e:
+                        _server_down(job, e, telemetry)
+                        break
+
+                    _job_finished(dj, job, ret, telemetry, uploader)
                 else:
-                    log.error("Encoding job failed !!")
-                    job.failed()
-            else:
-                pt = random.randint(30, 90)
-                log.debug("No job found. Pausing for %d seconds." % pt)
-                time.sleep(pt)
+                    _idle(dj, waiter, telemetry)
 
-        except KeyboardInterrupt:
+            except KeyboardInterrupt:
 
-            log.warning("Received keyboard interrupt. Quitting after current job.")
-            running = False
+                log.warning("Received keyboard interrupt. Quitting after current job.")
+                running = False
 
-        if args.one_job or args.dry_run:
-            log.warning("One job only option is set. Exiting loop.")
-            running = False
+            if args.one_job or args.dry_run:
+                log.warning("One job only option is set. Exiting loop.")
+                running = False
 
+    finally:
 
-if __name__ == "__main__":
+        # Give back the jobs we reserved but did not start, also if the loop failed
+        dj.release()
+        log.info("Job queue: %s" % dj.counters())
+        waiter.close()
 
-    logconf = {'format': '[%(asctime)s.%(msecs)-3d: %(name)-16s - %(levelname)-5s] %(message)s', 'datefmt': "%H:%M:%S"}
-    logging.basicConfig(level=logging.DEBUG, **logconf)
+        if server:
+            server.stop()
+
+        _close_uploader(uploader)
+        _close_telemetry(telemetry, dj)
+
+
+def _job_finished(dj, job, ret, telemetry, uploader=None):
+    """
+    Marks the job as done or failed and updates the telemetry.
+    """
+
+    if ret:
+        job.done()
+    else:
+        log.error("Encoding job %s failed !!" % job)
+        job.failed()
+
+    telemetry.inc("jobs_done" if ret else "jobs_failed")
+    telemetry.event("job_done" if ret else "job_failed", job=job.name())
+
+    _write_telemetry(telemetry, dj, uploader)
+
+    if dj.stats():
+        log.info("Job selection: %s" % dj.stats())
+
+
+@contextmanager
+def _renewing(dj, interval=RENEW_INTERVAL):
+    """
+    Renews the reservations of the prefetched jobs in the background while a job runs. The
+    caller must not use dj meanwhile.
+    """
+
+    stop = threading.Event()
+
+    def renew():
+        while not stop.wait(interval):
+            try:
+                dj.renew_reservations()
+            except Exception:
+                log.error(traceback.format_exc())
+
+    thread = threading.Thread(target=renew, name="renew", daemon=True)
+    thread.start()
+
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _server_down(job, error, telemetry):
+    """
+    Puts the job back to waiting when the job server is down, instead of failing it (and
+    all the following jobs). The worker stops taking jobs.
+    """
+
+    log.critical("%s. Releasing %s and quitting." % (error, job))
+
+    job.release()
+
+    telemetry.inc("jobs_released")
+    telemetry.event("job_released", job=job.name(), error=str(error))
+
+
+def _idle(dj, waiter, telemetry, interrupt=None):
+    """
+    Waits for new jobs (see Waiter.wait) and records the idle time.
+    """
+
+    t = time.perf_counter()
+    reason = waiter.wait(interrupt=interrupt)
+
+    telemetry.observe("idle", time.perf_counter() - t, reason=reason)
+
+    if reason in ("doorbell", "inotify"):
+        dj.invalidate()
+
+    _write_telemetry(telemetry, dj)
+
+
+def _write_telemetry(telemetry, dj, uploader=None):
+    """
+    Updates the queue gauges (waiting jobs, pending uploads, DirJobs counters) and writes the text file.
+    Does nothing (in particular, does not count the waiting jobs) if the telemetry is not written.
+    """
+
+    if not telemetry.enabled:
+        return
+
+    telemetry.gauge("jobs_waiting", dj.waiting())
+
+    if uploader is not None:
+        telemetry.gauge("uploads_pending", uploader.pending())
+
+    for name, value in dj.counters().items():
+        telemetry.gauge("queue_%s" % name, value)
+
+    telemetry.write()
+
+
+def _close_telemetry(telemetry, dj):
+
+    _write_telemetry(telemetry, dj)
+
+    telemetry.event("worker_stop", **telemetry.snapshot())
+    telemetry.close()
+
+
+def _close_uploader(uploader):
+
+    if uploader is None:
+        return
+
+    log.info("Waiting for the running uploads.")
+    uploader.close()
+
+    if uploader.failed():
+        log.error("Failed uploads (kept locally): %s" % uploader.failed())
+
+
+def slot_cpusets(slots, cpusets=None):
+    """
+    Returns the CPU set of every execution slot.
+
+    @param slots: Number of slots
+    @param cpusets: CPU sets separated by ";" (e.g. "1-2;3-4"). Default: one core per slot,
+                    starting with core 1 (core 0 is left to the system, like run_workers_template.sh)
+    """
+
+    if cpusets:
+        cpusets = cpusets.split(";")
+        if len(cpusets) != slots:
+            raise Exception("Got %d CPU sets for %d slots." % (len(cpusets), slots))
+        return cpusets
+
+    cpus = sorted(os.sched_getaffinity(0))
+
+    if len(cpus) <= slots:
+        log.warning("Only %d cores for %d slots. Not pinning the slots." % (len(cpus), slots))
+        return [None] * slots
+
+    return [str(c) for c in cpus[1:slots + 1]]
+
+
+def supervisor_loop(args, dj, wargs, waiter, uploader=None, telemetry=None):
+    """
+    Runs up to args.slots jobs at the same time, each pinned to its CPU set. All slots
+    share the DirJobs index, the image and the upload queue. The job folder is only polled when a slot
+    is free, so more slots do not add polling load.
+    """
+
+    if telemetry is None:
+        telemetry = Telemetry(args.id)
+
+    cpusets = slot_cpusets(args.slots, args.cpusets)
+
+    servers = []
+
+    try:
+
+        if args.persistent:
+            for slot, cpuset in enumerate(cpusets):
+                server = JobServer("%sx%d" % (args.id, slot), args.tmpdir, args.viddir, args.resultdir,
+                                   wargs['container'], processor=cpuset, dryrun=args.dry_run,
+                                   docker=args.docker_bin)
+                server.start()
+                servers.append(server)
+
+        log.info("Supervising %d slots. CPU sets: %s" % (args.slots, cpusets))
+
+        _supervise(args, dj, waiter, wargs, cpusets, servers, uploader, telemetry)
+
+    finally:
+        for server in servers:
+            server.stop()
+
+
+def _supervise(args, dj, waiter, wargs, cpusets, servers, uploader, telemetry):
+    """
+    Fills the free slots with jobs until there are no jobs (one job/dry run) or STOP_WORKERS.
+    """
+
+    free = list(range(args.slots))
+    running = {}
+    stopping = False
+
+    with ThreadPoolExecutor(max_workers=args.slots) as pool:
+
+        while True:
+
+            # The running jobs may take longer than the reservation timeout
+            dj.renew_reservations()
+
+            if not stopping and os.path.exists("STOP_WORKERS"):
+                log.warning("File STOP_WORKERS exists in working directory. Waiting for %d running jobs and quitting.." %
+                            len(running))
+                stopping = True
+
+            try:
+                no_job = False
+
+                # Fill the free slots
+                while free and not stopping:
+
+                    with telemetry.phase("claim"):
+                        job = dj.next_and_lock(no_wait=args.one_job)
+
+                    if not job:
+                        no_job = True
+                        break
+
+                    waiter.reset()
+
+                    slot = free.pop(0)
+
+                    log.info("Slot %d: starting %s" % (slot, job))
+
+                    swargs = dict(wargs, processor=cpusets[slot])
+                    server = servers[slot] if servers else None
+
+                    future = pool.submit(process_job, job, swargs, dryrun=args.dry_run, server=server,
+                                         skip_pull=True, uploader=uploader, telemetry=telemetry)
+                    running[future] = (slot, job)
+
+                if args.one_job or args.dry_run:
+                    stopping = True
+
+                if not running:
+
+                    if stopping:
+                        break
+
+                    _idle(dj, waiter, telemetry)
+                    continue
+
+                if no_job and not stopping:
+                    # Wait for new jobs or a finished slot, whatever comes first
+                    _idle(dj, waiter, telemetry, interrupt=lambda: any(f.done() for f in running))
+                    done = [f for f in running if f.done()]
+                else:
+                    done, _ = wait(running, timeout=RENEW_INTERVAL, return_when=FIRST_COMPLETED)
+
+            except KeyboardInterrupt:
+
+                log.warning("Received keyboard interrupt. Quitting after the running jobs.")
+                stopping = True
+                continue
+
+            for future in done:
+
+                slot, job = running.pop(future)
+                free.append(slot)
+
+                try:
+                    ret = future.result()
+                except JobServerError as e:
+                    _server_down(job, e, telemetry)
+                    stopping = True
+                    continue
+                except:
+                    log.critical(traceback.format_exc())
+                    ret = False
+
+                _job_finished(dj, job, ret, telemetry, uploader)
+
+
+def arg_parser():
+    """
+    Returns the argument parser of the worker (also used by the benchmarks).
+    """
 
     import argparse
     parser = argparse.ArgumentParser(description="Encoding worker.")
@@ -337,25 +819,70 @@ if __name__ == "__main__":
     parser.add_argument('-t', '--tmpdir', help="Temporary folder.", default="samples/tmpdir")
     parser.add_argument('-r', '--resultdir', help="Results folder.", default="samples/results")
     parser.add_argument('-c', '--container', help="Container to use.", default="fginet/docker-video-encoding:latest")
+    parser.add_argument('--docker-bin', help="Docker command (e.g. benchmarks/fake_docker.py).", default="docker")
     parser.add_argument('--sftp-target-dir', help="Target directory on the SFTP host.", default=".")
     parser.add_argument('--sftp-host', help="SFTP Host to upload encoded videos to.")
     parser.add_argument('--sftp-port', help="Port of SFTP host.", default=22)
     parser.add_argument('--sftp-user', help="User of SFTP host.")
     parser.add_argument('--sftp-password', help="Password of the SFTP host.")
+    parser.add_argument('--upload-parallel', help="Files in flight during the SFTP upload.", type=int, default=4)
+    parser.add_argument('--upload-queue', help="Maximum number of finished jobs waiting for the SFTP upload.",
+                        type=int, default=2)
+    parser.add_argument('--upload-verify', help="Check the size of uploaded files (size) or read them back and "
+                                               "compare the sha256 (sha256).", choices=["size", "sha256"], default="size")
+    parser.add_argument('--stream-upload', help="Upload the segments to the SFTP host (or sshfs folder) while "
+                                               "the video is still encoding.", action="store_true")
     parser.add_argument('--sshfs-dir', help="Target directory on ssh host.", default=".")
     parser.add_argument('--one-job', help="Run only one job and quit.", action="store_true")
     parser.add_argument('--dry-run', help="Dry-run. Do not run docker.", action="store_true")
+    parser.add_argument('--sqlite', help="Take the jobs from this SQLite job database instead of the jobs folder "
+                                        "(see sqlitejobs.py).", default=None)
+    parser.add_argument('--claim', help="How jobs are claimed: lock file (excl), hard link lock file (link) "
+                                        "or move and wait for conflicting workers (rename).",
+                        choices=["excl", "link", "rename"], default="excl")
+    parser.add_argument('--sync-time', help="Time in seconds to wait for conflicting workers (--claim rename).",
+                        type=float, default=70)
+    parser.add_argument('--prefetch', help="Number of jobs to reserve per claim round (needs --claim excl or link).",
+                        type=int, default=1)
+    parser.add_argument('--select', help="Job selection: prefer sources recently used on this host (locality) "
+                                         "or pick randomly (random).",
+                        choices=["locality", "random"], default="locality")
+    parser.add_argument('--slots', help="Run a supervisor with this many execution slots (jobs at the same time).",
+                        type=int, default=1)
+    parser.add_argument('--cpusets', help="CPU sets of the slots, separated by ';' (default: one core per slot "
+                                          "starting with core 1).", default=None)
+    parser.add_argument('--max-wait', help="Maximum time in seconds an idle worker waits before it looks for jobs again.",
+                        type=int, default=90)
+    parser.add_argument('--no-inotify', help="Do not use inotify to wake up idle workers.", action="store_true")
+    parser.add_argument('--persistent', help="Run all jobs in one long-lived container.", action="store_true")
+    parser.add_argument('--telemetry-dir', help="Write the phase timers and counters of the worker to this folder "
+                                               "(worker_<id>.prom for the node exporter textfile collector and "
+                                               "worker_<id>.events.jsonl).", default=None)
+    parser.add_argument('--cgroup-stats', help="Sample CPU time, memory and I/O of the container from its cgroup "
+                                              "and store them in stats.json.", action="store_true")
+    parser.add_argument('--cgroup-root', help="Root of the cgroup (v2) hierarchy.", default="/sys/fs/cgroup")
+    parser.add_argument('--cgroup-interval', help="Time in seconds between two cgroup samples.", type=float,
+                        default=1.0)
     parser.add_argument('--keep-tmp', help="Keep encoded files in tmp folder.", action="store_true")
     parser.add_argument('--log', help="Create a worker log in the home folder.", action="store_true")
     parser.add_argument('-i', '--id', help="Worker identifier.", default="w1")
     parser.add_argument('-p', '--processor', help="Which CPU to use.", default=None)
 
+    return parser
+
+
+if __name__ == "__main__":
+
+    logconf = {'format': '[%(asctime)s.%(msecs)-3d: %(name)-16s - %(levelname)-5s] %(message)s', 'datefmt': "%H:%M:%S"}
+    logging.basicConfig(level=logging.DEBUG, **logconf)
+
+    parser = arg_parser()
     args = parser.parse_args()
 
     log.info("Starting worker %s." % args.id)
 
     # Sanity check for video filename
-    if any(["_" in v for v in os.listdir(args.viddir)]):
+    if any(["_" in v for v in list_videos(args.viddir)]):
         log.error("Sanity check failed: A video contains '_' in the filename! This is not allowed!")
         sys.exit(-1)
 